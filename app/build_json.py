@@ -271,6 +271,11 @@ def main():
     group_general.add_argument("-log", type=str2bool, help="true/false")
     group_general.add_argument("-multi", type=float)
     group_general.add_argument("-target_resolution", type=float)
+    group_general.add_argument("-engine", choices=["otb", "numpy"],
+                               help="processing engine of the snow detection passes")
+    group_general.add_argument("-fused", type=str2bool, help="true/false")
+    group_general.add_argument("-zero_copy_inputs", type=str2bool, help="true/false")
+    group_general.add_argument("-warped_vrt", type=str2bool, help="true/false")
 
 
     group_inputs = parser.add_argument_group('inputs', 'input files')
@@ -295,6 +300,9 @@ def main():
     group_cloud.add_argument("-red_darkcloud", type=int)
     group_cloud.add_argument("-red_backtocloud", type=int)
     group_cloud.add_argument("-strict_cloud_mask", type=str2bool, help="true/false")
+    group_cloud.add_argument("-rm_snow_inside_cloud", type=str2bool, help="true/false")
+    group_cloud.add_argument("-rm_snow_inside_cloud_tile_size", type=int)
+    group_cloud.add_argument("-coarse_red_by_blocks", type=str2bool, help="true/false")
 
     args = parser.parse_args()
 
@@ -359,6 +367,14 @@ def main():
             jsonData["general"]["multi"] = args.multi
         if args.target_resolution:
             jsonData["general"]["target_resolution"] = args.target_resolution
+        if args.engine:
+            jsonData["general"]["engine"] = args.engine
+        if args.fused is not None:
+            jsonData["general"]["fused"] = args.fused
+        if args.zero_copy_inputs is not None:
+            jsonData["general"]["zero_copy_inputs"] = args.zero_copy_inputs
+        if args.warped_vrt is not None:
+            jsonData["general"]["warped_vrt"] = args.warped_vrt
 
         # Override dem location
         if args.dem:
@@ -401,6 +417,12 @@ def main():
             jsonData["cloud"]["red_backtocloud"] = args.red_backtocloud
         if args.strict_cloud_mask:
             jsonData["cloud"]["strict_cloud_mask"] = args.strict_cloud_mask
+        if args.rm_snow_inside_cloud is not None:
+            jsonData["cloud"]["rm_snow_inside_cloud"] = args.rm_snow_inside_cloud
+        if args.rm_snow_inside_cloud_tile_size:
+            jsonData["cloud"]["rm_snow_inside_cloud_tile_size"] = args.rm_snow_inside_cloud_tile_size
+        if args.coarse_red_by_blocks is not None:
+            jsonData["cloud"]["coarse_red_by_blocks"] = args.coarse_red_by_blocks
 
         if not jsonData["inputs"].get("dem"):
             logging.error("No DEM found!")
@@ -49,7 +49,10 @@ def main(argv):
 
     # Run the snow detector
     snow_annual_map_evaluation_app = snow_annual_map_evaluation.snow_annual_map_evaluation(data)
-    snow_annual_map_evaluation_app.run()
+    if data.get("incremental", False):
+        snow_annual_map_evaluation_app.run_incremental()
+    else:
+        snow_annual_map_evaluation_app.run()
 
     if data.get("run_comparison_evaluation", False):
         snow_annual_map_evaluation_app.run_evaluation()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import logging
+from s2snow import snow_detector_batch
+from s2snow.version import VERSION
+
+# ----------------- MAIN ---------------------------------------------------
+
+
+def main(argv):
+    """ main script of the batch snow extraction procedure"""
+    parser = argparse.ArgumentParser(description='This script is used to run the snow detector \
+                                     on a list of configuration files (see build_json.py) \
+                                     in a pool of worker processes sharing the ram and threads \
+                                     of the node.')
+    parser.add_argument("configs", nargs="*", help="json configuration files")
+    parser.add_argument("-list", help="text file listing the json configuration files, one per line")
+    parser.add_argument("-nb_workers", type=int, default=1, help="number of products processed concurrently")
+    parser.add_argument("-ram", type=int, help="ram of the node in MB, shared between the workers")
+    parser.add_argument("-nb_threads", type=int, help="threads of the node, shared between the workers")
+    parser.add_argument("-summary", help="json summary of the batch")
+    parser.add_argument("-version", action="version", version=VERSION)
+    args = parser.parse_args(argv[1:])
+
+    # Set logging level and format.
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, \
+        format=snow_detector_batch.LOG_FORMAT)
+    logging.info("Start run_snow_detector_batch.py")
+
+    config_files = list(args.configs)
+    if args.list:
+        config_files.extend(snow_detector_batch.read_config_list(args.list))
+    if not config_files:
+        parser.error("no configuration file to process")
+
+    summaries = snow_detector_batch.run_batch(config_files,
+                                              args.nb_workers,
+                                              args.ram,
+                                              args.nb_threads,
+                                              args.summary)
+    logging.info("End run_snow_detector_batch.py")
+
+    # non zero exit status if a product failed
+    if any(summary["status"] != "done" for summary in summaries):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import logging
+from s2snow import snow_detector_service
+from s2snow.snow_detector_batch import LOG_FORMAT
+from s2snow.version import VERSION
+
+# ----------------- MAIN ---------------------------------------------------
+
+
+def main(argv):
+    """ main script of the snow detection service"""
+    parser = argparse.ArgumentParser(description='This script runs the snow detector as a service \
+                                     processing the json configuration files (see build_json.py) \
+                                     dropped in the incoming directory of a queue, which can be shared by \
+                                     several services. Create the file <queue>/stop to stop all the \
+                                     services (remove it before starting them again), or \
+                                     <queue>/stop_<host>_<pid> to stop one service.')
+    parser.add_argument("queue", help="queue directory")
+    parser.add_argument("-nb_workers", type=int, default=1, help="number of products processed concurrently")
+    parser.add_argument("-ram", type=int, help="ram of the node in MB, shared between the workers")
+    parser.add_argument("-nb_threads", type=int, help="threads of the node, shared between the workers")
+    parser.add_argument("-poll_interval", type=float, default=5, help="delay between two checks of the queue (s)")
+    parser.add_argument("-once", action="store_true", help="stop when the queue is empty")
+    parser.add_argument("-version", action="version", version=VERSION)
+    args = parser.parse_args(argv[1:])
+
+    # Set logging level and format.
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=LOG_FORMAT)
+
+    service = snow_detector_service.snow_detector_service(args.queue,
+                                                          args.nb_workers,
+                                                          args.ram,
+                                                          args.nb_threads,
+                                                          args.poll_interval)
+    service.run(args.once)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -65,6 +65,8 @@ class prepare_data_for_snow_annual_map():
         self.mission_tags = ["SENTINEL2"]#["LANDSAT"]#
 
         self.snow_products_dir = str(params.get("snow_products_dir"))
+        # sqlite catalog of the snow products (see s2snow/snow_product_catalog.py)
+        self.catalog = params.get("catalog", None)
         self.path_tmp = str(params.get("path_tmp", os.environ.get('TMPDIR')))
 
         self.input_products_list=params.get("input_products_list",[]).copy()
@@ -104,6 +106,17 @@ class prepare_data_for_snow_annual_map():
         resulting_df = None
         snow_processing_requested = 0
 
+        # the available snow products are found in the catalog if provided,
+        # instead of checking the existence of each product directory
+        catalog_products = None
+        if self.catalog:
+            from s2snow.snow_product_catalog import snow_product_catalog
+            catalog = snow_product_catalog(self.catalog)
+            catalog_products = dict((row["product_name"], row["path"]) for row in
+                                    catalog.query(self.tile_id, search_start_date, search_stop_date))
+            catalog.close()
+            logging.info(str(len(catalog_products)) + " snow products found in the catalog " + self.catalog)
+
         # loop on the different type of products to require
         for mission_tag in self.mission_tags:
             # use amalthee to request the products from Theia catalogues
@@ -138,11 +151,17 @@ class prepare_data_for_snow_annual_map():
 
                     # check snow product availability
                     expected_snow_product_path = op.join(self.snow_products_dir, self.tile_id, product_id)
+                    if catalog_products is not None:
+                        is_snow_product_available = product_id in catalog_products
+                        if is_snow_product_available:
+                            expected_snow_product_path = catalog_products[product_id]
+                    else:
+                        is_snow_product_available = op.exists(expected_snow_product_path)
                     df.loc[product_id, 'snow_product'] = expected_snow_product_path
                     logging.info(expected_snow_product_path)
 
                     # the snow product is already available
-                    if op.exists(expected_snow_product_path):
+                    if is_snow_product_available:
                         logging.info(product_id + " is available as snow product")
                         snow_product_available += 1
                         df.loc[product_id, 'snow_product_available'] = True
@@ -264,6 +283,8 @@ def main():
               "densification_products_list":[],
               # the following parameters are only use in this script, and doesn't affect snow_annual_map processing
               "snow_products_dir":"/work/OT/siaa/Theia/Neige/PRODUITS_NEIGE_LIS_develop_1.5",
+              # optional sqlite catalog of the snow products dir (snow_product_catalog.py)
+              #"catalog":"",
               "data_availability_check":False}
 
     with open('selectNeigeSyntheseMultitemp.csv', 'r') as csvfile:
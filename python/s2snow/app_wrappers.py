@@ -20,6 +20,17 @@ import logging
 # OTB Applications
 import otbApplication as otb
 
+def set_input_image(app, key, image):
+    """ Set an input image parameter of an OTB application
+
+    The image is either a filename or an in-memory image obtained
+    from the output of another application (see get_app_output)
+    """
+    if isinstance(image, basestring):
+        app.SetParameterString(key, image)
+    else:
+        app.SetParameterInputImage(key, image)
+
 def band_math(il, out, exp, ram=None, out_type=None):
     """ Create and configure the band math application
         using otb.Registry.CreateApplication("BandMath")
@@ -95,11 +106,11 @@ def compute_snow_mask(pass1, pass2, cloud_pass1, cloud_refine, initial_clouds, \
         using otb.Registry.CreateApplication("ComputeSnowMask")
 
     Keyword arguments:
-    pass1 -- the input pass1 image
-    pass2 -- the input pass2 image
-    cloud_pass1 -- the input cloud pass1 image
-    cloud_refine -- the input cloud refine image
-    initial_clouds -- the inital all cloud image
+    pass1 -- the input pass1 image (filename or in-memory image)
+    pass2 -- the input pass2 image (filename or in-memory image)
+    cloud_pass1 -- the input cloud pass1 image (filename or in-memory image)
+    cloud_refine -- the input cloud refine image (filename or in-memory image)
+    initial_clouds -- the inital all cloud image (filename or in-memory image)
     out -- the output image
     slope_flag -- the status of the slope
     ram -- the ram limitation (not mandatory)
@@ -107,19 +118,19 @@ def compute_snow_mask(pass1, pass2, cloud_pass1, cloud_refine, initial_clouds, \
     """
     if pass1 and pass2 and cloud_pass1 and cloud_refine and out:
         logging.info("Processing ComputeSnowMask with args:")
-        logging.info("pass1 = " + pass1)
-        logging.info("pass2 = " + pass2)
-        logging.info("cloud_pass1 = " + cloud_pass1)
-        logging.info("cloud_refine = " + cloud_refine)
-        logging.info("initial_clouds = " + initial_clouds)
+        logging.info("pass1 = " + str(pass1))
+        logging.info("pass2 = " + str(pass2))
+        logging.info("cloud_pass1 = " + str(cloud_pass1))
+        logging.info("cloud_refine = " + str(cloud_refine))
+        logging.info("initial_clouds = " + str(initial_clouds))
         logging.info("out = " + out)
 
         snowMaskApp = otb.Registry.CreateApplication("ComputeSnowMask")
-        snowMaskApp.SetParameterString("pass1", pass1)
-        snowMaskApp.SetParameterString("pass2", pass2)
-        snowMaskApp.SetParameterString("cloudpass1", cloud_pass1)
-        snowMaskApp.SetParameterString("cloudrefine", cloud_refine)
-        snowMaskApp.SetParameterString("initialallcloud", initial_clouds)
+        set_input_image(snowMaskApp, "pass1", pass1)
+        set_input_image(snowMaskApp, "pass2", pass2)
+        set_input_image(snowMaskApp, "cloudpass1", cloud_pass1)
+        set_input_image(snowMaskApp, "cloudrefine", cloud_refine)
+        set_input_image(snowMaskApp, "initialallcloud", initial_clouds)
         snowMaskApp.SetParameterString("out", out)
         if slope_flag is not None:
             logging.info("slope_flag = " + slope_flag)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Simon Gascoin
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+import logging
+
+import gdal
+from gdalconst import GA_ReadOnly
+
+# this allows GDAL to throw Python Exceptions
+gdal.UseExceptions()
+
+# GDAL creation options equivalent to the otb extended filename
+# "?&gdal:co:NBITS=1&gdal:co:COMPRESS=DEFLATE" used for binary masks
+GDAL_CO_MASK = ["NBITS=1", "COMPRESS=DEFLATE"]
+
+# Number of bytes per pixel and per layer used to estimate the memory
+# needed to process a block (kernels work on float64 arrays and create
+# a few temporaries)
+BYTES_PER_PIXEL = 8 * 4
+
+
+def get_block_lines(xsize, nb_layers, ram):
+    """ Return the number of lines of a block fitting in ram (in MB)
+
+    Keyword arguments:
+    xsize -- the number of columns of the processed images
+    nb_layers -- the number of input and output layers of a block
+    ram -- the ram limitation in MB
+    """
+    bytes_per_line = max(1, xsize * max(1, nb_layers) * BYTES_PER_PIXEL)
+    return max(1, int(ram) * 1024 * 1024 // bytes_per_line)
+
+
+def iter_windows(xsize, ysize, block_lines):
+    """ Yield the windows (xoff, yoff, width, height) covering the image
+    by blocks of block_lines full lines
+    """
+    for yoff in range(0, ysize, block_lines):
+        yield 0, yoff, xsize, min(block_lines, ysize - yoff)
+
+
+def create_raster(path, reference, datatype=gdal.GDT_Byte, nb_bands=1,
+                  options=None, nodata=None):
+    """ Create a GTiff with the same footprint and projection than
+    the reference image and return the opened dataset
+
+    Keyword arguments:
+    path -- the output image
+    reference -- the reference image (filename or gdal dataset)
+    datatype -- the output pixel type (gdal type)
+    nb_bands -- the number of bands of the output
+    options -- the GTiff creation options
+    nodata -- the no-data value of the output (not mandatory)
+    """
+    if isinstance(reference, basestring):
+        reference = gdal.Open(reference, GA_ReadOnly)
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(path,
+                            reference.RasterXSize,
+                            reference.RasterYSize,
+                            nb_bands,
+                            datatype,
+                            options or [])
+    dataset.SetGeoTransform(reference.GetGeoTransform())
+    dataset.SetProjection(reference.GetProjection())
+    if nodata is not None:
+        for band in range(1, nb_bands + 1):
+            dataset.GetRasterBand(band).SetNoDataValue(nodata)
+    return dataset
+
+
+def process_by_blocks(inputs, outputs, kernel, ram=512, block_lines=None):
+    """ Apply a numpy kernel to the input images block by block
+    and write the results into the output images
+
+    The images are streamed by windows of full lines, so that only
+    one block of each layer is loaded in memory at once.
+
+    Keyword arguments:
+    inputs -- list of (filename, band number) tuples, the corresponding
+              block arrays are given to the kernel in the same order
+    outputs -- list of (filename, gdal type, creation options) tuples
+    kernel -- function of the input arrays returning one array per output
+              (or a single array when there is only one output)
+    ram -- the ram limitation in MB, used when block_lines is not set
+    block_lines -- the number of lines of a block (not mandatory)
+    """
+    if not inputs or not outputs:
+        logging.error("Parameters inputs and outputs are required")
+        return
+
+    # Open each input file once, even when several of its bands are used
+    datasets = {}
+    for path, band_number in inputs:
+        if path not in datasets:
+            datasets[path] = gdal.Open(path, GA_ReadOnly)
+    bands = [datasets[path].GetRasterBand(band_number)
+             for path, band_number in inputs]
+
+    reference = datasets[inputs[0][0]]
+    xsize = reference.RasterXSize
+    ysize = reference.RasterYSize
+
+    out_datasets = [create_raster(path, reference, datatype, 1, options)
+                    for path, datatype, options in outputs]
+    out_bands = [dataset.GetRasterBand(1) for dataset in out_datasets]
+
+    if not block_lines:
+        block_lines = get_block_lines(xsize, len(inputs) + len(outputs), ram)
+    logging.info("Processing " + ", ".join([o[0] for o in outputs]) +
+                 " by blocks of " + str(block_lines) + " lines")
+
+    for xoff, yoff, width, height in iter_windows(xsize, ysize, block_lines):
+        arrays = [band.ReadAsArray(xoff, yoff, width, height) for band in bands]
+        results = kernel(*arrays)
+        if not isinstance(results, (list, tuple)):
+            results = [results]
+        for out_band, result in zip(out_bands, results):
+            out_band.WriteArray(result, xoff, yoff)
+
+    out_bands = None
+    out_datasets = None
+    bands = None
+    datasets = None
+
+
+def process_stack_by_blocks(inputs, outputs, kernel, ram=512, block_lines=None):
+    """ Apply a numpy kernel to each input image block by block and write
+    the results as the successive bands of multi-band output images
+
+    The band i of each output image is computed from the input i, each
+    input image being read once. The outputs are created with one band
+    per input.
+
+    Keyword arguments:
+    inputs -- list of (filename, band number) tuples
+    outputs -- list of (filename, gdal type, creation options) tuples
+    kernel -- function of an input array returning one array per output
+              (or a single array when there is only one output)
+    ram -- the ram limitation in MB, used when block_lines is not set
+    block_lines -- the number of lines of a block (not mandatory)
+    """
+    if not inputs or not outputs:
+        logging.error("Parameters inputs and outputs are required")
+        return
+
+    datasets = [gdal.Open(path, GA_ReadOnly) for path, _ in inputs]
+    bands = [dataset.GetRasterBand(band_number)
+             for dataset, (_, band_number) in zip(datasets, inputs)]
+
+    reference = datasets[0]
+    xsize = reference.RasterXSize
+    ysize = reference.RasterYSize
+
+    out_datasets = [create_raster(path, reference, datatype, len(inputs),
+                                  options)
+                    for path, datatype, options in outputs]
+
+    if not block_lines:
+        # one input block and its output blocks are processed at once
+        block_lines = get_block_lines(xsize, 1 + len(outputs), ram)
+    logging.info("Processing " + ", ".join([o[0] for o in outputs]) +
+                 " (" + str(len(inputs)) + " bands) by blocks of " +
+                 str(block_lines) + " lines")
+
+    for xoff, yoff, width, height in iter_windows(xsize, ysize, block_lines):
+        for index, band in enumerate(bands):
+            results = kernel(band.ReadAsArray(xoff, yoff, width, height))
+            if not isinstance(results, (list, tuple)):
+                results = [results]
+            for out_dataset, result in zip(out_datasets, results):
+                out_dataset.GetRasterBand(index + 1).WriteArray(result,
+                                                                xoff, yoff)
+
+    out_datasets = None
+    bands = None
+    datasets = None
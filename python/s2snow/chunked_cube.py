@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Chunked time series cube of the snow annual map
+
+The cube is a directory holding several layers (binary snow, binary cloud
+and gap filled snow masks) of shape (dates, lines, columns), each layer
+being split into chunks of (dates, lines, columns) compressed with zlib:
+
+    <cube>/metadata.json
+    <cube>/<layer>/<t>.<y>.<x>
+
+where t, y and x are the chunk indexes. The reader only decompresses the
+chunks intersecting the requested slice.
+"""
+import os
+import os.path as op
+import json
+import zlib
+
+import numpy as np
+
+METADATA = "metadata.json"
+
+
+def chunk_name(t, y, x):
+    return str(t) + "." + str(y) + "." + str(x)
+
+
+class chunked_cube_writer(object):
+    """ Write the layers of a chunked cube by blocks of full lines
+    """
+    def __init__(self, path, xsize, ysize, chunk_shape=(32, 256, 256),
+                 geotransform=None, projection=None, compression_level=6):
+        self.path = path
+        self.metadata = {"xsize": int(xsize),
+                         "ysize": int(ysize),
+                         "chunk_shape": [int(size) for size in chunk_shape],
+                         "geotransform": list(geotransform) if geotransform else None,
+                         "projection": projection,
+                         "layers": {}}
+        self.compression_level = compression_level
+        if not op.exists(path):
+            os.makedirs(path)
+
+    @property
+    def chunk_lines(self):
+        return self.metadata["chunk_shape"][1]
+
+    def add_layer(self, name, dates, dtype="uint8"):
+        """ Declare a layer with one band per date
+        """
+        self.metadata["layers"][name] = {"dates": [str(date) for date in dates],
+                                         "dtype": dtype}
+        layer_path = op.join(self.path, name)
+        if not op.exists(layer_path):
+            os.mkdir(layer_path)
+
+    def write(self, name, yoff, array):
+        """ Write a block of full lines of a layer
+
+        Keyword arguments:
+        name -- the layer name
+        yoff -- the first line of the block, multiple of the chunk lines
+        array -- the block, array of shape (dates, lines, columns)
+        """
+        chunk_t, chunk_y, chunk_x = self.metadata["chunk_shape"]
+        nb_dates, nb_lines, nb_columns = array.shape
+        if yoff % chunk_y or (nb_lines % chunk_y and
+                              yoff + nb_lines != self.metadata["ysize"]):
+            raise ValueError("The block at line " + str(yoff) +
+                             " is not aligned on the chunks of " + self.path)
+
+        dtype = self.metadata["layers"][name]["dtype"]
+        for t in range(0, nb_dates, chunk_t):
+            for y in range(0, nb_lines, chunk_y):
+                for x in range(0, nb_columns, chunk_x):
+                    chunk = np.ascontiguousarray(
+                        array[t:t+chunk_t, y:y+chunk_y, x:x+chunk_x],
+                        dtype=dtype)
+                    chunk_path = op.join(self.path, name,
+                                         chunk_name(t // chunk_t,
+                                                    (yoff + y) // chunk_y,
+                                                    x // chunk_x))
+                    with open(chunk_path, "wb") as stream:
+                        stream.write(zlib.compress(chunk.tobytes(),
+                                                   self.compression_level))
+
+    def close(self):
+        """ Write the metadata of the cube
+        """
+        with open(op.join(self.path, METADATA), "w") as stream:
+            json.dump(self.metadata, stream)
+
+
+class chunked_layer(object):
+    """ Lazy access to a layer of a chunked cube with numpy slicing
+    """
+    def __init__(self, path, name, metadata):
+        self.path = op.join(path, name)
+        self.name = name
+        self.dates = metadata["layers"][name]["dates"]
+        self.dtype = np.dtype(str(metadata["layers"][name]["dtype"]))
+        self.chunk_shape = metadata["chunk_shape"]
+        self.shape = (len(self.dates), metadata["ysize"], metadata["xsize"])
+
+    def read_chunk(self, t, y, x):
+        """ Return the chunk of indexes (t, y, x)
+        """
+        shape = [min(chunk, size - index * chunk)
+                 for index, chunk, size in zip((t, y, x), self.chunk_shape,
+                                               self.shape)]
+        with open(op.join(self.path, chunk_name(t, y, x)), "rb") as stream:
+            data = zlib.decompress(stream.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+
+        indexes = []
+        for item, size in zip(key, self.shape):
+            if isinstance(item, slice):
+                indexes.append(np.arange(*item.indices(size)))
+            else:
+                index = item + size if item < 0 else item
+                if not 0 <= index < size:
+                    raise IndexError("Index " + str(item) + " is out of range")
+                indexes.append(np.array([index]))
+
+        # read the bounding box of the requested indexes chunk by chunk
+        if min([index.size for index in indexes]) == 0:
+            box = np.zeros([0, 0, 0], dtype=self.dtype)
+            starts = [0, 0, 0]
+        else:
+            starts = [int(index.min()) for index in indexes]
+            stops = [int(index.max()) + 1 for index in indexes]
+            box = np.zeros([stop - start for start, stop in zip(starts, stops)],
+                           dtype=self.dtype)
+            first = [start // size for start, size in zip(starts, self.chunk_shape)]
+            last = [(stop - 1) // size for stop, size in zip(stops, self.chunk_shape)]
+            for t in range(first[0], last[0] + 1):
+                for y in range(first[1], last[1] + 1):
+                    for x in range(first[2], last[2] + 1):
+                        chunk = self.read_chunk(t, y, x)
+                        origins = [index * size for index, size in
+                                   zip((t, y, x), self.chunk_shape)]
+                        lows = [max(start, origin) for start, origin in
+                                zip(starts, origins)]
+                        highs = [min(stop, origin + size) for stop, origin, size in
+                                 zip(stops, origins, chunk.shape)]
+                        box[tuple(slice(low - start, high - start) for low, high, start
+                                  in zip(lows, highs, starts))] = \
+                            chunk[tuple(slice(low - origin, high - origin) for low, high, origin
+                                        in zip(lows, highs, origins))]
+
+        result = box[np.ix_(*[index - start for index, start in zip(indexes, starts)])]
+        # drop the dimensions indexed by an integer
+        return result[tuple(slice(None) if isinstance(item, slice) else 0
+                            for item in key)]
+
+    def read_date(self, date):
+        """ Return the band of a date (YYYYMMDD string or index)
+        """
+        if not isinstance(date, (int, np.integer)):
+            date = self.dates.index(str(date))
+        return self[date]
+
+
+class chunked_cube_reader(object):
+    """ Read a chunked cube
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(op.join(path, METADATA)) as stream:
+            self.metadata = json.load(stream)
+        self.xsize = self.metadata["xsize"]
+        self.ysize = self.metadata["ysize"]
+        self.geotransform = self.metadata["geotransform"]
+        self.projection = self.metadata["projection"]
+        self.layers = sorted(self.metadata["layers"])
+
+    def layer(self, name):
+        """ Return the lazy layer of the given name
+        """
+        return chunked_layer(self.path, name, self.metadata)
@@ -3,34 +3,138 @@
 
 import os, sys
 import os.path as op
-from lxml import etree
+import csv
+import time
+import logging
+import argparse
+from multiprocessing.pool import ThreadPool
+
+from s2snow.snow_product_catalog import snow_product_catalog
+from s2snow.snow_product_parser import read_quality_indices, LIS_METADATA_FILES
+
+QUALITY_INDICES = ["SnowPercent", "CloudPercent"]
+CSV_HEADER = ["product_folder", "snow_percent", "cloud_percent"]
+
+def list_directory(path):
+	""" Return the sub directories and the LIS metadata files of a directory
+	"""
+	directories = []
+	metadata_files = []
+	try:
+		names = os.listdir(path)
+	except OSError as e:
+		logging.warning("Unable to list " + path + ": " + str(e))
+		return directories, metadata_files
+	for name in names:
+		full_path = op.join(path, name)
+		if name in LIS_METADATA_FILES:
+			metadata_files.append(full_path)
+		elif op.isdir(full_path) and not op.islink(full_path):
+			directories.append(full_path)
+	return directories, metadata_files
+
+def read_candidate(metadata_file):
+	""" Return the (product folder, snow percent, cloud percent) of a LIS
+	metadata file, None if the quality indices are not found
+	"""
+	indices = read_quality_indices(metadata_file, QUALITY_INDICES)
+	if len(indices) != len(QUALITY_INDICES):
+		logging.warning("No snow and cloud percents in " + metadata_file)
+		return None
+	product_folder = op.dirname(metadata_file)
+	# the metadata of the LIS outputs are in <product>/LIS_PRODUCTS
+	if op.basename(product_folder).upper() == "LIS_PRODUCTS":
+		product_folder = op.dirname(product_folder)
+	return (product_folder, indices["SnowPercent"], indices["CloudPercent"])
+
+def scan_directories(roots, nb_threads=8):
+	""" Return the (product folder, snow percent, cloud percent) of the
+	LIS metadata files found under the root directories
+
+	The directories of a same depth are listed concurrently, and the metadata
+	files are parsed concurrently, stopping at the two quality indices.
+	"""
+	pool = ThreadPool(nb_threads)
+	directories = list(roots)
+	metadata_files = []
+	while directories:
+		listed = pool.map(list_directory, directories)
+		directories = [directory for sub_directories, _ in listed for directory in sub_directories]
+		metadata_files.extend([name for _, names in listed for name in names])
+	candidates = pool.map(read_candidate, metadata_files)
+	pool.close()
+	pool.join()
+	return sorted(candidate for candidate in candidates if candidate is not None)
+
+def query_catalog(catalog_file, tile_id=None, snow_range=(None, None), cloud_range=(None, None)):
+	""" Return the (product folder, snow percent, cloud percent) of the
+	snow products of a catalog (see snow_product_catalog.py) whose snow and
+	cloud percents are in the ranges, without parsing any metadata file
+	"""
+	candidates = []
+	catalog = snow_product_catalog(catalog_file)
+	for row in catalog.query(tile_id=tile_id, snow_percent=snow_range, cloud_percent=cloud_range):
+		if row["snow_percent"] is not None and row["cloud_percent"] is not None:
+			candidates.append((row["path"], row["snow_percent"], row["cloud_percent"]))
+	catalog.close()
+	return candidates
+
+def in_range(value, value_range):
+	""" Return True if value is in the range (min, max), bounds excluded
+	"""
+	minimum, maximum = value_range
+	return (minimum is None or value > minimum) and (maximum is None or value < maximum)
+
+def find_ref_candidates(roots=["."], snow_range=(None, None), cloud_range=(None, None),
+                        catalog_file=None, tile_id=None, nb_threads=8):
+	""" Return the (product folder, snow percent, cloud percent) of the
+	snow products whose snow and cloud percents are in the ranges
+
+	Keyword arguments:
+	roots -- the directories to scan
+	snow_range -- the (min, max) snow percent, bounds excluded (None for no bound)
+	cloud_range -- the (min, max) cloud percent, bounds excluded (None for no bound)
+	catalog_file -- a catalog to query instead of scanning the directories
+	tile_id -- the tile of the products, with a catalog only
+	nb_threads -- the number of directories listed and files parsed concurrently
+	"""
+	if catalog_file is not None:
+		return query_catalog(catalog_file, tile_id, snow_range, cloud_range)
+	candidates = scan_directories(roots, nb_threads)
+	return [candidate for candidate in candidates
+	        if in_range(candidate[1], snow_range) and in_range(candidate[2], cloud_range)]
 
 def main(argv):
-	minsnowthreshold = argv[1]
-	maxsnowthreshold = argv[2]
-	mincloudthreshold = argv[3]
-	maxcloudthreshold = argv[4]
-	
-	total_images = 0
-	
-	for root, dirs, files in os.walk("."):
-		for name in files:
-			if name == "metadata.xml":
-				tree = etree.parse(op.join(root, name))
-				snow_percent = float(tree.find("./Global_Index_List/QUALITY_INDEX/[@name='SnowPercent']").text)
-				cloud_percent = float(tree.find("./Global_Index_List/QUALITY_INDEX/[@name='CloudPercent']").text)
-				
-				# Find potential
-				if snow_percent > minsnowthreshold and cloud_percent > mincloudthreshold and snow_percent < maxsnowthreshold and cloud_percent < maxcloudthreshold :
-					print root
-					print "snow percent: " + str(snow_percent)
-					print "cloud percent: " + str(cloud_percent)
-					total_images += 1
-					
-	print "total images :" + str(total_images)
+	parser = argparse.ArgumentParser(description='Find the snow products whose snow and \
+	                                 cloud percents (read in the LIS metadata) are in the given ranges, \
+	                                 and write them as csv')
+	parser.add_argument("roots", nargs="*", default=["."], help="the directories to scan (default: .)")
+	parser.add_argument("-snow", nargs=2, type=float, metavar=("MIN", "MAX"),
+	                    default=[None, None], help="snow percent range, bounds excluded")
+	parser.add_argument("-cloud", nargs=2, type=float, metavar=("MIN", "MAX"),
+	                    default=[None, None], help="cloud percent range, bounds excluded")
+	parser.add_argument("-catalog", help="sqlite catalog of the snow products to query \
+	                    instead of scanning the directories (see snow_product_catalog.py)")
+	parser.add_argument("-tile", help="tile of the products, with a catalog only")
+	parser.add_argument("-threads", type=int, default=8, help="number of concurrent reads")
+	parser.add_argument("-output", help="output csv file (default: stdout)")
+	args = parser.parse_args(argv[1:])
+
+	start = time.time()
+	candidates = find_ref_candidates(args.roots, args.snow, args.cloud,
+	                                 args.catalog, args.tile, args.threads)
+
+	output = open(args.output, "w") if args.output else sys.stdout
+	writer = csv.writer(output)
+	writer.writerow(CSV_HEADER)
+	writer.writerows(candidates)
+	if args.output:
+		output.close()
+
+	logging.info("total images: " + str(len(candidates)) + " (" + "%.1f s" % (time.time() - start) + ")")
+	return 0
 
 if __name__ == "__main__":
-	if len(sys.argv) != 5:
-		print "Missing arguments"
-	else:
-		main(sys.argv)
+	logging.basicConfig(stream=sys.stderr, level=logging.INFO, format=\
+	    '%(asctime)s - %(filename)s:%(lineno)s - %(levelname)s - %(message)s')
+	sys.exit(main(sys.argv))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Persistent cache of the masks derived from the snow products
+
+An entry is keyed by the operation, the identity of its input files and its
+parameters. The identity of an input file is its path, size and modification
+time, except for the files restored from or stored in the cache by the same
+instance, which are identified by the key of their entry and their position
+in it: the masks derived in a temporary directory named by the processing
+id, such as the decoded masks of a season, are found in the cache from one
+run to the other, whatever their path.
+
+The cache is bounded in size, the least recently used entries being removed
+first. It can be shared by concurrent runs: the index is reloaded and saved
+under an exclusive lock of the cache directory (flock of index.lock) at each
+access, and the entries are stored under a temporary name then renamed, so
+that an entry is never read while it is written or removed.
+Layout:
+    <cache>/index.json
+    <cache>/index.lock
+    <cache>/<key>/<output files>
+"""
+import os
+import os.path as op
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+INDEX = "index.json"
+INDEX_LOCK = "index.lock"
+
+
+def split_vsizip_path(path):
+    """ Return the (zip file, member) of a GDAL /vsizip/ path
+    """
+    path = path[len("/vsizip/"):]
+    index = path.lower().find(".zip/")
+    if index < 0:
+        return path, ""
+    return path[:index + len(".zip")], path[index + len(".zip/"):]
+
+
+def file_identity(path):
+    """ Return the identity of a file as (absolute path, size, mtime),
+    None if the file does not exist
+
+    The identity of a file read through /vsizip/ is the identity of the zip
+    file and the member name.
+    """
+    if path.startswith("/vsizip/"):
+        zip_file, member = split_vsizip_path(path)
+        identity = file_identity(zip_file)
+        if identity is None:
+            return None
+        return identity + [member]
+    if not op.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [op.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+class mask_cache(object):
+    """ Size bounded LRU cache of output files
+    """
+    def __init__(self, path, max_size=4096):
+        """
+        Keyword arguments:
+        path -- the cache directory
+        max_size -- the maximum size of the cache in MB (None for no limit)
+        """
+        self.path = path
+        self.max_size = max_size
+        if not op.exists(path):
+            os.makedirs(path)
+        self.index_file = op.join(path, INDEX)
+        self.lock_file = op.join(path, INDEX_LOCK)
+        self.index = {}
+        # the files restored from or stored in the cache, by absolute path:
+        # [key, position in the entry, size, mtime]
+        self.cached_outputs = {}
+        with self.lock():
+            self.load_index()
+
+    @contextmanager
+    def lock(self):
+        """ Hold the exclusive lock of the cache directory, shared with the
+        other processes using the cache
+        """
+        with open(self.lock_file, "a") as lock_stream:
+            fcntl.flock(lock_stream.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+
+    def load_index(self):
+        """ Read the index of the cache, written by this or another process
+        (with the lock held)
+        """
+        self.index = {}
+        if op.exists(self.index_file):
+            try:
+                with open(self.index_file) as index_stream:
+                    self.index = json.load(index_stream)
+            except ValueError:
+                logging.warning("Invalid cache index " + self.index_file + ", resetting the cache")
+
+    def key(self, operation, inputs, parameters=None):
+        """ Return the key of an operation, None if one of its inputs is
+        not a file (such an operation is not cached)
+
+        Keyword arguments:
+        operation -- the operation name
+        inputs -- the input files
+        parameters -- the parameters of the operation (json serializable)
+        """
+        identities = [self.identity(input_file) for input_file in inputs]
+        if None in identities:
+            return None
+        description = json.dumps([operation, identities, parameters], sort_keys=True)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def identity(self, path):
+        """ Return the identity of an input file, the key of its entry and
+        its position in it if it was restored from or stored in the cache
+        and was not modified since, its file_identity otherwise
+        """
+        identity = file_identity(path)
+        if identity is None or path.startswith("/vsizip/"):
+            return identity
+        cached_output = self.cached_outputs.get(identity[0])
+        if cached_output is not None and cached_output[2:] == identity[1:]:
+            return ["cache"] + cached_output[:2]
+        return identity
+
+    def add_cached_outputs(self, key, outputs):
+        """ Record the outputs of an entry, so that the masks derived from
+        them are keyed by the key of the entry instead of their path
+        """
+        for position, output in enumerate(outputs):
+            identity = file_identity(output)
+            self.cached_outputs[identity[0]] = [key, position] + identity[1:]
+
+    def get(self, key, outputs):
+        """ Copy the cached files of an entry to the outputs
+
+        Return True if the entry was found.
+        """
+        with self.lock():
+            self.load_index()
+            entry = self.index.get(key)
+            if entry is None or len(entry["files"]) != len(outputs):
+                return False
+            cached_files = [op.join(self.path, key, name) for name in entry["files"]]
+            if not all(op.exists(cached_file) for cached_file in cached_files):
+                self.remove(key)
+                self.save_index()
+                return False
+
+            # copied with the lock held, so that the entry is not evicted
+            # by another process in the meantime
+            for cached_file, output in zip(cached_files, outputs):
+                if op.dirname(output) and not op.exists(op.dirname(output)):
+                    os.makedirs(op.dirname(output))
+                shutil.copy2(cached_file, output)
+            entry["last_access"] = time.time()
+            self.save_index()
+        self.add_cached_outputs(key, outputs)
+        logging.info("Restored from cache: " + ", ".join(outputs))
+        return True
+
+    def put(self, key, outputs):
+        """ Store the outputs as the entry of key and evict the least
+        recently used entries above the maximum size
+        """
+        # the files are copied without the lock, under a temporary name
+        tmp_entry_path = tempfile.mkdtemp(prefix="tmp_", dir=self.path)
+        os.chmod(tmp_entry_path, 0o755)
+        names = []
+        size = 0
+        for index, output in enumerate(outputs):
+            # keep the outputs order even for identical basenames
+            name = str(index) + "_" + op.basename(output)
+            shutil.copy2(output, op.join(tmp_entry_path, name))
+            names.append(name)
+            size += op.getsize(output)
+
+        with self.lock():
+            self.load_index()
+            self.remove(key)
+            os.rename(tmp_entry_path, op.join(self.path, key))
+            self.index[key] = {"files": names,
+                               "size": size,
+                               "last_access": time.time()}
+            self.evict()
+            self.save_index()
+        self.add_cached_outputs(key, outputs)
+
+    def remove(self, key):
+        """ Remove an entry (with the lock held)
+        """
+        self.index.pop(key, None)
+        entry_path = op.join(self.path, key)
+        if op.exists(entry_path):
+            shutil.rmtree(entry_path)
+
+    def evict(self):
+        """ Remove the least recently used entries above the maximum size
+        (with the lock held)
+        """
+        if self.max_size is None:
+            return
+        max_bytes = self.max_size * 1024 * 1024
+        total_size = sum(entry["size"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda key: self.index[key]["last_access"]):
+            if total_size <= max_bytes:
+                break
+            total_size -= self.index[key]["size"]
+            logging.debug("Evicting " + key + " from the cache")
+            self.remove(key)
+
+    def save_index(self):
+        """ Write the index of the cache (with the lock held)
+        """
+        tmp_index_file = self.index_file + ".tmp"
+        with open(tmp_index_file, "w") as index_stream:
+            json.dump(self.index, index_stream)
+        os.rename(tmp_index_file, self.index_file)
+
+    def run(self, operation, inputs, parameters, outputs, compute):
+        """ Restore the outputs of an operation from the cache, or compute
+        them and store them in the cache
+
+        Keyword arguments:
+        operation -- the operation name
+        inputs -- the input files
+        parameters -- the parameters of the operation (json serializable)
+        outputs -- the output files
+        compute -- the function computing the outputs (without arguments)
+        """
+        key = self.key(operation, inputs, parameters)
+        if key is not None and self.get(key, outputs):
+            return
+        compute()
+        if key is not None and all(op.exists(output) for output in outputs):
+            self.put(key, outputs)
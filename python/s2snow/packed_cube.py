@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Bit-packed storage of the daily binary snow masks
+
+The daily snow masks are stored time-major: the series of each pixel is
+packed 8 dates per byte (the first date in the most significant bit), and
+the pixels are interleaved by chunks of full lines compressed with zlib.
+A pixel series is read by decompressing only the chunk containing it, and
+a date is read chunk by chunk.
+
+File layout:
+    magic (8 bytes) | chunk 1 | ... | chunk n | index (json) |
+    index offset (uint64) | magic (8 bytes)
+The index gives the image size, georeferencing, dates and the offset,
+size, first line and number of lines of each chunk.
+"""
+import json
+import zlib
+import struct
+
+import numpy as np
+
+MAGIC = b"LISCUBE1"
+FOOTER = struct.Struct("<Q")
+
+
+class packed_cube_writer(object):
+    """ Write a bit-packed daily snow masks file, chunk by chunk
+    """
+    def __init__(self, path, xsize, ysize, dates, geotransform=None,
+                 projection=None, compression_level=6):
+        self.path = path
+        self.index = {"xsize": int(xsize),
+                      "ysize": int(ysize),
+                      "dates": [str(date) for date in dates],
+                      "geotransform": list(geotransform) if geotransform else None,
+                      "projection": projection,
+                      "chunks": []}
+        self.compression_level = compression_level
+        self.stream = open(path, "wb")
+        self.stream.write(MAGIC)
+
+    def write_chunk(self, yoff, masks):
+        """ Write the masks of full lines starting at line yoff
+
+        Keyword arguments:
+        yoff -- the first line of the chunk
+        masks -- the binary masks, array of shape (dates, lines, columns)
+        """
+        nb_dates, nb_lines, nb_columns = masks.shape
+        if nb_dates != len(self.index["dates"]) or nb_columns != self.index["xsize"]:
+            raise ValueError("The chunk shape " + str(masks.shape) +
+                             " does not match " + self.path)
+        # pixel interleaved, 8 dates per byte
+        packed = np.packbits(np.transpose(masks != 0, (1, 2, 0)), axis=-1)
+        data = zlib.compress(np.ascontiguousarray(packed).tobytes(),
+                             self.compression_level)
+        self.index["chunks"].append([self.stream.tell(), len(data),
+                                     int(yoff), int(nb_lines)])
+        self.stream.write(data)
+
+    def close(self):
+        """ Write the index and close the file
+        """
+        index_offset = self.stream.tell()
+        self.stream.write(json.dumps(self.index).encode("utf-8"))
+        self.stream.write(FOOTER.pack(index_offset))
+        self.stream.write(MAGIC)
+        self.stream.close()
+
+
+class packed_cube_reader(object):
+    """ Read a bit-packed daily snow masks file
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as stream:
+            if stream.read(len(MAGIC)) != MAGIC:
+                raise IOError(path + " is not a packed snow cube")
+            stream.seek(-(FOOTER.size + len(MAGIC)), 2)
+            index_end = stream.tell()
+            (index_offset,) = FOOTER.unpack(stream.read(FOOTER.size))
+            if stream.read(len(MAGIC)) != MAGIC:
+                raise IOError(path + " is incomplete (no index)")
+            stream.seek(index_offset)
+            self.index = json.loads(stream.read(index_end - index_offset).decode("utf-8"))
+
+        self.xsize = self.index["xsize"]
+        self.ysize = self.index["ysize"]
+        self.dates = self.index["dates"]
+        self.geotransform = self.index["geotransform"]
+        self.projection = self.index["projection"]
+        self.chunks = sorted(self.index["chunks"], key=lambda chunk: chunk[2])
+        self.nb_bytes = (len(self.dates) + 7) // 8
+
+    def find_chunk(self, y):
+        """ Return the chunk containing the line y
+        """
+        for chunk in self.chunks:
+            if chunk[2] <= y < chunk[2] + chunk[3]:
+                return chunk
+        raise IndexError("Line " + str(y) + " is outside " + self.path)
+
+    def read_packed_chunk(self, chunk):
+        """ Return the packed bytes of a chunk as (lines, columns, bytes)
+        """
+        offset, size, _, nb_lines = chunk
+        with open(self.path, "rb") as stream:
+            stream.seek(offset)
+            data = zlib.decompress(stream.read(size))
+        return np.frombuffer(data, dtype=np.uint8).reshape(nb_lines,
+                                                            self.xsize,
+                                                            self.nb_bytes)
+
+    def date_index(self, date):
+        """ Return the band index of a date (YYYYMMDD string or index)
+        """
+        if isinstance(date, (int, np.integer)):
+            return date
+        return self.dates.index(str(date))
+
+    def read_pixel_series(self, x, y):
+        """ Return the daily snow series of the pixel (x, y)
+        """
+        chunk = self.find_chunk(y)
+        packed = self.read_packed_chunk(chunk)[y - chunk[2], x]
+        return np.unpackbits(packed)[:len(self.dates)]
+
+    def read_date(self, date):
+        """ Return the snow mask of a date (YYYYMMDD string or index)
+        """
+        index = self.date_index(date)
+        byte, bit = divmod(index, 8)
+        mask = np.zeros((self.ysize, self.xsize), dtype=np.uint8)
+        for chunk in self.chunks:
+            packed = self.read_packed_chunk(chunk)[:, :, byte]
+            mask[chunk[2]:chunk[2] + chunk[3]] = (packed >> (7 - bit)) & 1
+        return mask
+
+    def read_chunk(self, chunk):
+        """ Return the masks of a chunk as (dates, lines, columns)
+        """
+        unpacked = np.unpackbits(self.read_packed_chunk(chunk), axis=-1)
+        return np.transpose(unpacked[:, :, :len(self.dates)], (2, 0, 1))
@@ -17,11 +17,12 @@
 #=========================================================================
 import os
 import os.path as op
+import json
 import shutil
 import logging
 import multiprocessing
-from xml.dom import minidom
 from datetime import timedelta
+from functools import partial
 
 from lxml import etree
 
@@ -36,7 +37,18 @@ from s2snow.app_wrappers import band_math, get_app_output, super_impose
 
 from s2snow.utils import str_to_datetime, datetime_to_str
 from s2snow.utils import write_list_to_file, read_list_from_file
-from s2snow.snow_product_parser import load_snow_product
+from s2snow.snow_product_parser import parse_product_name, scan_products, extract_snow_masks
+from s2snow.snow_product_parser import read_quality_indices
+from s2snow.snow_product_catalog import snow_product_catalog
+from s2snow.block_processing import process_by_blocks, process_stack_by_blocks
+from s2snow.block_processing import GDAL_CO_MASK
+from s2snow.snow_kernels import snow_product_masks_kernel, merge_masks_kernel
+from s2snow.snow_kernels import merge_snow_product_masks_kernel
+from s2snow.temporal_gap_filling import gap_filling_by_blocks, upsert_date_by_blocks
+from s2snow.temporal_gap_filling import get_gap_filling_block_lines
+from s2snow.chunked_cube import chunked_cube_writer
+from s2snow.mask_cache import mask_cache
+from s2snow.warp_plan import get_grid, get_plan_key, compute_warp_plan, apply_warp_plan
 
 # Build gdal option to generate maks of 1 byte using otb extended filename
 # syntaxx
@@ -47,9 +59,7 @@ def parse_xml(filepath):
     """ Parse an xml file to return the zs value of a snow product
     """
     logging.debug("Parsing " + filepath)
-    xmldoc = minidom.parse(filepath)
-    group = xmldoc.getElementsByTagName('Global_Index_List')[0]
-    zs = group.getElementsByTagName("QUALITY_INDEX")[0].firstChild.data
+    return read_quality_indices(filepath).get("ZS")
 
 
 #TODO move this function in app_wrappers.py along other otb applications
@@ -107,25 +117,70 @@ def merge_masks_at_same_date(snow_product_list, merged_snow_product, threshold=1
     logging.info("Merging products into " + merged_snow_product)
 
     # the merging is performed according the following selection:
-    #   if img1 < threshold use img1 data
-    #   else if img2 < threshold use img2 data
-    #   else if imgN < threshold use imgN data
+    #   if img1 <= threshold use img1 data
+    #   else if img2 <= threshold use img2 data
+    #   else use imgN data
     # the order of the images in the input list is important:
     #   we expect to have first the main input products
     #   and then the densification products
-    img_index = range(1, len(snow_product_list)+1)
-    expression_merging = "".join(["(im" + str(i) + "b1<=" + str(threshold) + "?im" + str(i) + "b1:" for i in img_index])
-    expression_merging += "im"+str(img_index[-1])+"b1"
-    expression_merging += "".join([")" for i in img_index])
-
-    img_list= [i.get_snow_mask() for i in snow_product_list]
-    bandMathApp = band_math(img_list,
-                            merged_snow_product,
-                            expression_merging,
-                            ram,
-                            otb.ImagePixelType_uint8)
-    bandMathApp.ExecuteAndWriteOutput()
-    bandMathApp = None
+    img_list = [i.get_snow_mask() for i in snow_product_list]
+    process_by_blocks([(img, 1) for img in img_list],
+                      [(merged_snow_product, gdal.GDT_Byte, None)],
+                      partial(merge_masks_kernel, threshold),
+                      ram or 512)
+
+def reproject_mask(mask_ref, mask_in, mask_out, no_data, ram=None):
+    """ Reproject a snow mask on the footprint of a reference mask
+    (nearest neighbour)
+
+    Keyword arguments:
+    mask_ref -- the reference mask
+    mask_in -- the input snow mask
+    mask_out -- the output reprojected snow mask
+    no_data -- the no-data value outside the input footprint
+    ram -- the ram limitation (not mandatory)
+    """
+    super_impose_app = super_impose(mask_ref,
+                                    mask_in,
+                                    mask_out,
+                                    "nn",
+                                    no_data,
+                                    ram,
+                                    otb.ImagePixelType_uint8)
+    super_impose_app.ExecuteAndWriteOutput()
+    super_impose_app = None
+
+def decode_snow_mask(arguments):
+    """ Extract the binary snow and cloud masks from a snow mask,
+    with a single read of the snow mask
+
+    Keyword arguments (as a tuple, to be used in a process pool):
+    mask_in -- the input snow mask, or the list of the snow masks of a
+               date merged on the fly in priority order
+    snow_out -- the output binary snow mask
+    cloud_out -- the output binary cloud mask (cloud or no-data)
+    labels -- the (snow, cloud, no-data) labels of the snow mask
+    ram -- the ram limitation
+    """
+    mask_in, snow_out, cloud_out, labels, ram = arguments
+    if isinstance(mask_in, list):
+        logging.info("Merging and decoding " + ", ".join(mask_in))
+        inputs = [(mask, 1) for mask in mask_in]
+        kernel = partial(merge_snow_product_masks_kernel,
+                         labels[0], labels[0], labels[1], labels[2])
+    else:
+        logging.info("Decoding " + mask_in)
+        inputs = [(mask_in, 1)]
+        kernel = partial(snow_product_masks_kernel,
+                         label_snow=labels[0],
+                         label_cloud=labels[1],
+                         label_no_data=labels[2])
+    process_by_blocks(inputs,
+                      [(snow_out, gdal.GDT_Byte, GDAL_CO_MASK),
+                       (cloud_out, gdal.GDT_Byte, GDAL_CO_MASK)],
+                      kernel,
+                      ram)
+    return snow_out, cloud_out
 
 """ This module provide the implementation of the snow annual map """
 class snow_annual_map():
@@ -159,6 +214,39 @@ class snow_annual_map():
 
         self.ram = params.get("ram", 512)
         self.nbThreads = params.get("nbThreads", None)
+        # number of dates decoded concurrently, sharing the ram
+        self.nb_workers = params.get("nb_workers", 1)
+        # write the binary masks as multi-date cubes instead of daily files
+        self.use_multitemp_cubes = params.get("use_multitemp_cubes", False)
+        # "otb" (ImageTimeSeriesGapFilling) or "numpy" (temporal_gap_filling)
+        self.gap_filling_engine = params.get("gap_filling_engine", "otb")
+        # write the DAILY_SNOW_MASKS output (the annual map only otherwise)
+        self.write_daily_masks = params.get("write_daily_masks", True)
+        # "gtiff" or "packed" (see packed_cube.py, numpy engine only)
+        self.daily_masks_format = params.get("daily_masks_format", "gtiff")
+        # write the snow, cloud and gap filled layers in a chunked cube
+        # (see chunked_cube.py, numpy engine only)
+        self.output_cube = params.get("output_cube", False)
+        self.cube_chunk_shape = params.get("cube_chunk_shape", [32, 256, 256])
+        # "otb" (Superimpose) or "numpy" (warp_plan.py) densification reprojection
+        self.reprojection_engine = params.get("reprojection_engine", "otb")
+        # number of product directories listed concurrently
+        self.scan_threads = params.get("scan_threads", 8)
+        # json index of the product directories, reused while they are not modified
+        self.product_index = params.get("product_index", op.join(self.path_tmp, "product_index.json"))
+        # sqlite catalog of the snow products (see snow_product_catalog.py),
+        # queried when the products lists are empty
+        self.catalog = params.get("catalog", None)
+        # "extract" to extract the snow masks of the zipped products (into
+        # the mask cache if enabled), "vsizip" to read them in place
+        self.zip_access = params.get("zip_access", "extract")
+        # persistent cache of the derived masks (see mask_cache.py)
+        self.cache = None
+        if params.get("cache_dir"):
+            self.cache = mask_cache(str(params.get("cache_dir")),
+                                    params.get("cache_max_size", 4096))
+        # binary masks and occurences kept between the incremental runs
+        self.state_dir = str(params.get("state_dir", op.join(self.path_out, "state")))
 
         self.use_densification = params.get("use_densification", False)
         if self.use_densification:
@@ -176,9 +264,16 @@ class snow_annual_map():
             self.output_dates_filename = op.join(self.path_tmp, "output_dates.txt")
         self.multitemp_snow_vrt = op.join(self.path_tmp, "multitemp_snow_mask.vrt")
         self.multitemp_cloud_vrt = op.join(self.path_tmp, "multitemp_cloud_mask.vrt")
+        self.multitemp_snow_cube = op.join(self.path_tmp, "multitemp_snow_mask.tif")
+        self.multitemp_cloud_cube = op.join(self.path_tmp, "multitemp_cloud_mask.tif")
         self.gapfilled_timeserie = op.join(self.path_tmp, "DAILY_SNOW_MASKS_" + self.processing_id + ".tif")
+        self.packed_gapfilled_timeserie = op.join(self.path_tmp, "DAILY_SNOW_MASKS_" + self.processing_id + ".lsc")
+        self.time_series_cube = op.join(self.path_tmp, "TIME_SERIES_CUBE_" + self.processing_id)
         self.annual_snow_map = op.join(self.path_tmp, "SNOW_OCCURENCE_" + self.processing_id + ".tif")
         self.cloud_occurence_img = op.join(self.path_tmp, "CLOUD_OCCURENCE_" + self.processing_id +".tif")
+        self.state_file = op.join(self.state_dir, "state.json")
+        self.state_snow_occurence = op.join(self.state_dir, op.basename(self.annual_snow_map))
+        self.state_cloud_occurence = op.join(self.state_dir, op.basename(self.cloud_occurence_img))
 
     def run(self):
         logging.info("Run snow_annual_map")
@@ -188,45 +283,357 @@ class snow_annual_map():
             os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.nbThreads)
 
         # search matching snow product
-        self.product_dict = self.load_products(self.input_path_list, self.tile_id, None)
+        if not self.load_all_products():
+            return
+
+        # re-order products according acquisition date
+        input_dates = sorted(self.product_dict.keys())
+        write_list_to_file(self.input_dates_filename, input_dates)
+
+        # compute or retrive the output dates
+        output_dates = self.get_output_dates()
+
+        shutil.copy2(self.input_dates_filename, self.path_out)
+        shutil.copy2(self.output_dates_filename, self.path_out)
+
+        # merge products at the same date, while decoding them if possible
+        self.resulting_snow_mask_dict = self.merge_products(input_dates,
+                                                            fused=not self.use_multitemp_cubes)
+
+        if self.use_multitemp_cubes:
+            # decode the snow masks directly into the multi-date cubes
+            self.decode_mask_cubes()
+            multitemp_snow = self.multitemp_snow_cube
+            multitemp_cloud = self.multitemp_cloud_cube
+        else:
+            # convert the snow masks into binary snow and cloud masks
+            (self.binary_snowmask_list,
+             self.binary_cloudmask_list) = self.decode_mask_list()
+            logging.debug("Binary snow mask list:")
+            logging.debug(self.binary_snowmask_list)
+            logging.debug("Binary cloud mask list:")
+            logging.debug(self.binary_cloudmask_list)
+
+            # build cloud mask vrt
+            logging.info("Building multitemp cloud mask vrt")
+            logging.info("cloud vrt: " + self.multitemp_cloud_vrt)
+            gdal.BuildVRT(self.multitemp_cloud_vrt,
+                          self.binary_cloudmask_list,
+                          separate=True)
+
+            # build snow mask vrt
+            logging.info("Building multitemp snow mask vrt")
+            logging.info("snow vrt: " + self.multitemp_snow_vrt)
+            gdal.BuildVRT(self.multitemp_snow_vrt,
+                          self.binary_snowmask_list,
+                          separate=True)
+            multitemp_snow = self.multitemp_snow_vrt
+            multitemp_cloud = self.multitemp_cloud_vrt
+
+        daily_masks = None
+        if self.write_daily_masks:
+            daily_masks = self.gapfilled_timeserie
+            if self.daily_masks_format == "packed":
+                if self.gap_filling_engine == "numpy":
+                    daily_masks = self.packed_gapfilled_timeserie
+                else:
+                    logging.warning("The packed daily masks format requires "
+                                    "the numpy gap filling engine, using gtiff")
+
+        if self.output_cube and self.gap_filling_engine != "numpy":
+            logging.warning("The time series cube requires the numpy gap filling engine")
+
+        if self.gap_filling_engine == "numpy":
+            cube = None
+            if self.output_cube:
+                dataset = gdal.Open(multitemp_snow, GA_ReadOnly)
+                # the chunk lines are limited to the gap filling blocks
+                chunk_shape = list(self.cube_chunk_shape)
+                block_lines = get_gap_filling_block_lines(dataset.RasterXSize,
+                                                          len(input_dates),
+                                                          len(output_dates),
+                                                          self.ram)
+                if chunk_shape[1] > block_lines:
+                    logging.warning("The chunks of " + str(chunk_shape[1]) +
+                                    " lines of the time series cube do not fit in ram, " +
+                                    "using chunks of " + str(block_lines) + " lines")
+                    chunk_shape[1] = block_lines
+                cube = chunked_cube_writer(self.time_series_cube,
+                                           dataset.RasterXSize,
+                                           dataset.RasterYSize,
+                                           chunk_shape,
+                                           dataset.GetGeoTransform(),
+                                           dataset.GetProjection())
+                dataset = None
+
+            # gap filling the snow timeserie and generate the summary and
+            # annual maps in the same pass
+            gap_filling_by_blocks(multitemp_snow,
+                                  multitemp_cloud,
+                                  input_dates,
+                                  output_dates,
+                                  snow_occurence=self.annual_snow_map,
+                                  daily_masks=daily_masks,
+                                  cloud_occurence=self.cloud_occurence_img,
+                                  ram=self.ram,
+                                  daily_masks_format=self.daily_masks_format,
+                                  cube=cube)
+            if daily_masks:
+                shutil.copy2(daily_masks, self.path_out)
+            if cube is not None:
+                dest_cube = op.join(self.path_out, op.basename(self.time_series_cube))
+                if op.exists(dest_cube):
+                    shutil.rmtree(dest_cube)
+                shutil.copytree(self.time_series_cube, dest_cube)
+        else:
+            # generate the summary map
+            band_index = range(1, len(self.resulting_snow_mask_dict)+1)
+            expression = "+".join(["im1b" + str(i) for i in band_index])
+
+            bandMathApp = band_math([multitemp_cloud],
+                                    self.cloud_occurence_img,
+                                    expression,
+                                    self.ram,
+                                    otb.ImagePixelType_uint16)
+            bandMathApp.ExecuteAndWriteOutput()
+            bandMathApp = None
+
+            # gap filling the snow timeserie
+            app_gap_filling = gap_filling(multitemp_snow,
+                                          multitemp_cloud,
+                                          self.gapfilled_timeserie+GDAL_OPT,
+                                          self.input_dates_filename,
+                                          self.output_dates_filename,
+                                          self.ram,
+                                          otb.ImagePixelType_uint8)
+
+            # the daily masks are kept in memory when they are not requested
+            if daily_masks:
+                img_in = get_app_output(app_gap_filling, "out", "DEBUG")
+                shutil.copy2(self.gapfilled_timeserie, self.path_out)
+                app_gap_filling = None
+            else:
+                img_in = get_app_output(app_gap_filling, "out", "RUNTIME")
+
+            # generate the annual map
+            band_index = range(1, len(output_dates)+1)
+            expression = "+".join(["im1b" + str(i) for i in band_index])
+
+            bandMathApp = band_math([img_in],
+                                    self.annual_snow_map,
+                                    expression,
+                                    self.ram,
+                                    otb.ImagePixelType_uint16)
+            bandMathApp.ExecuteAndWriteOutput()
+            bandMathApp = None
+
+        logging.info("Copying outputs from tmp to output folder")
+        shutil.copy2(self.cloud_occurence_img, self.path_out)
+        shutil.copy2(self.annual_snow_map, self.path_out)
+
+        logging.info("End of snow_annual_map")
+
+        if self.mode == "DEBUG":
+            dest_debug_dir = op.join(self.path_out, "tmpdir")
+            if op.exists(dest_debug_dir):
+                shutil.rmtree(dest_debug_dir)
+            shutil.copytree(self.path_tmp, dest_debug_dir)
+
+    def run_incremental(self):
+        """ Update the snow annual map with the new (or reprocessed) dates only
+
+        The binary masks of each date and the snow and cloud occurences are
+        kept in state_dir, along with the products of each date (state.json).
+        The first run processes the whole time series with the numpy gap
+        filling engine. The next runs only decode the dates whose products
+        changed, and update the occurences in place on the output dates
+        affected by each of these dates.
+        """
+        logging.info("Run snow_annual_map in incremental mode")
+
+        # Set maximum ITK threads
+        if self.nbThreads:
+            os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.nbThreads)
+
+        if not self.load_all_products():
+            return
+        output_dates = self.get_output_dates()
+
+        sources = {}
+        for key in self.product_dict.keys():
+            sources[key] = sorted([op.join(product.product_path, product.product_name)
+                                   for product in self.product_dict[key]])
+
+        state = self.load_state()
+        if state is None or state["output_dates"] != output_dates:
+            state = self.init_state(output_dates, sources)
+        else:
+            updated_dates = [date for date in sorted(sources)
+                             if date not in state["dates"] or
+                             state["dates"][date]["sources"] != sources[date]]
+            removed_dates = [date for date in state["dates"] if date not in sources]
+            if removed_dates:
+                logging.warning("Keeping the dates without product: " + str(sorted(removed_dates)))
+            logging.info("Updating " + str(len(updated_dates)) + " dates")
+            for date in updated_dates:
+                self.update_state(state, date, sources[date], output_dates)
+
+        input_dates = sorted(state["dates"])
+        write_list_to_file(self.input_dates_filename, input_dates)
+        shutil.copy2(self.input_dates_filename, self.path_out)
+        shutil.copy2(self.output_dates_filename, self.path_out)
+
+        logging.info("Copying outputs from state to output folder")
+        shutil.copy2(self.state_cloud_occurence, self.path_out)
+        shutil.copy2(self.state_snow_occurence, self.path_out)
+
+        logging.info("End of snow_annual_map")
+
+    def load_state(self):
+        """ Return the state of the incremental runs (None if missing)
+        """
+        if not op.exists(self.state_file):
+            return None
+        with open(self.state_file) as state_stream:
+            return json.load(state_stream)
+
+    def save_state(self, state):
+        """ Write the state of the incremental runs
+        """
+        tmp_state_file = self.state_file + ".tmp"
+        with open(tmp_state_file, "w") as state_stream:
+            json.dump(state, state_stream, indent=2, sort_keys=True)
+        os.rename(tmp_state_file, self.state_file)
+
+    def init_state(self, output_dates, sources):
+        """ Process the whole time series into a new state
+
+        Keyword arguments:
+        output_dates -- the output dates
+        sources -- the products of each input date
+        """
+        logging.info("Initializing the state in " + self.state_dir)
+        if op.exists(self.state_dir):
+            shutil.rmtree(self.state_dir)
+        os.makedirs(self.state_dir)
+
+        input_dates = sorted(self.product_dict.keys())
+        self.resulting_snow_mask_dict = self.merge_products(input_dates, fused=True)
+        (self.binary_snowmask_list,
+         self.binary_cloudmask_list) = self.decode_mask_list(self.state_dir)
+
+        gdal.BuildVRT(self.multitemp_cloud_vrt,
+                      self.binary_cloudmask_list,
+                      separate=True)
+        gdal.BuildVRT(self.multitemp_snow_vrt,
+                      self.binary_snowmask_list,
+                      separate=True)
+        gap_filling_by_blocks(self.multitemp_snow_vrt,
+                              self.multitemp_cloud_vrt,
+                              input_dates,
+                              output_dates,
+                              snow_occurence=self.state_snow_occurence,
+                              cloud_occurence=self.state_cloud_occurence,
+                              ram=self.ram)
+
+        state = {"output_dates": output_dates, "dates": {}}
+        for index, date in enumerate(input_dates):
+            state["dates"][date] = {"sources": sources[date],
+                                    "snow": self.binary_snowmask_list[index],
+                                    "cloud": self.binary_cloudmask_list[index]}
+        self.save_state(state)
+        return state
+
+    def update_state(self, state, date, sources, output_dates):
+        """ Add (or replace) a date of the state and update the occurences
+
+        Keyword arguments:
+        state -- the state, updated and saved
+        date -- the added or replaced date
+        sources -- the products of this date
+        output_dates -- the output dates
+        """
+        logging.info("Updating the date " + date)
+        snow_mask = self.merge_products([date], fused=True)[date]
+        snow_binary = op.join(self.path_tmp, date + "_snow_binary.tif")
+        cloud_binary = op.join(self.path_tmp, date + "_cloud_binary.tif")
+        labels = (self.label_snow, self.label_cloud, self.label_no_data)
+        self.run_cached("decode",
+                        snow_mask if isinstance(snow_mask, list) else [snow_mask],
+                        list(labels),
+                        [snow_binary, cloud_binary],
+                        partial(decode_snow_mask,
+                                (snow_mask, snow_binary, cloud_binary, labels, self.ram)))
+
+        input_dates = sorted(state["dates"])
+        upsert_date_by_blocks([state["dates"][key]["snow"] for key in input_dates],
+                              [state["dates"][key]["cloud"] for key in input_dates],
+                              input_dates,
+                              output_dates,
+                              date,
+                              snow_binary,
+                              cloud_binary,
+                              self.state_snow_occurence,
+                              self.state_cloud_occurence,
+                              self.ram)
+
+        state_snow_binary = op.join(self.state_dir, op.basename(snow_binary))
+        state_cloud_binary = op.join(self.state_dir, op.basename(cloud_binary))
+        shutil.move(snow_binary, state_snow_binary)
+        shutil.move(cloud_binary, state_cloud_binary)
+        state["dates"][date] = {"sources": sources,
+                                "snow": state_snow_binary,
+                                "cloud": state_cloud_binary}
+        self.save_state(state)
+
+    def load_all_products(self):
+        """ Load the input products and the densification products
+        (reprojected on the input tile) into self.product_dict
+
+        Return False if none of the input products were loaded.
+        """
+        if self.catalog is not None and not self.input_path_list:
+            self.product_dict = self.load_catalog_products(self.tile_id, "SENTINEL2")
+        else:
+            self.product_dict = self.load_products(self.input_path_list, self.tile_id, None)
         logging.debug("Product dictionnary:")
         logging.debug(self.product_dict)
 
         # Exiting with error if none of the input products were loaded
         if not self.product_dict:
             logging.error("Empty product list!")
-            return
+            return False
+        self.open_zip_products(self.product_dict)
 
         # Do the loading of the products to densify the timeserie
         if self.use_densification:
             # load densification snow products
-            densification_product_dict = self.load_products(self.densification_path_list, None, None)
+            if self.catalog is not None and not self.densification_path_list:
+                densification_product_dict = self.load_catalog_products(self.tile_id, "LANDSAT8")
+            else:
+                densification_product_dict = self.load_products(self.densification_path_list, None, None)
             logging.info("Densification product dict:")
             logging.info(densification_product_dict)
+            self.open_zip_products(densification_product_dict)
 
             # Get the footprint of the first snow product
             s2_footprint_ref = self.product_dict[list(self.product_dict.keys())[0]][0].get_snow_mask()
 
             if densification_product_dict:
                 # Reproject the densification products on S2 tile before going further
+                reprojections = []
                 for densifier_product_key in densification_product_dict.keys():
                     for densifier_product in densification_product_dict[densifier_product_key]:
                         original_mask = densifier_product.get_snow_mask()
                         reprojected_mask = op.join(self.path_tmp,
                                                    densifier_product.product_name + "_reprojected.tif")
                         if not os.path.exists(reprojected_mask):
-                            super_impose_app = super_impose(s2_footprint_ref,
-                                                            original_mask,
-                                                            reprojected_mask,
-                                                            "nn",
-                                                            int(self.label_no_data),
-                                                            self.ram,
-                                                            otb.ImagePixelType_uint8)
-                            super_impose_app.ExecuteAndWriteOutput()
-                            super_impose_app = None
+                            reprojections.append((original_mask, reprojected_mask))
                         densifier_product.snow_mask = reprojected_mask
                         logging.debug(densifier_product.snow_mask)
+                self.reproject_masks(s2_footprint_ref, reprojections)
 
+                for densifier_product_key in densification_product_dict.keys():
                     # Add the products to extend the self.product_dict
                     if densifier_product_key in self.product_dict.keys():
                         self.product_dict[densifier_product_key].extend(densification_product_dict[densifier_product_key])
@@ -234,12 +641,92 @@ class snow_annual_map():
                         self.product_dict[densifier_product_key] = densification_product_dict[densifier_product_key]
             else:
                 logging.warning("No Densifying candidate product found!")
+        return True
+
+    def open_zip_products(self, product_dict):
+        """ Give access to the snow masks of the zipped products, read
+        through /vsizip/ or extracted into path_tmp (see zip_access)
+        """
+        extraction_folder = op.join(self.path_tmp, "extracted")
+        to_extract = []
+        for products in product_dict.values():
+            for product in products:
+                if (product.snow_mask and op.exists(product.snow_mask)) or \
+                   not product.zip_product:
+                    continue
+                if self.zip_access == "vsizip":
+                    product.use_vsizip_snow_mask()
+                elif self.cache is not None:
+                    product.extract_snow_mask(extraction_folder, self.cache)
+                else:
+                    to_extract.append(product)
+        if to_extract:
+            extract_snow_masks(to_extract, extraction_folder, self.nb_workers)
+
+    def reproject_masks(self, mask_ref, reprojections):
+        """ Reproject the snow masks on the footprint of a reference mask
+
+        With the numpy reprojection engine, a warp plan is computed once
+        per input grid and the masks are reprojected by nb_workers processes.
+
+        Keyword arguments:
+        mask_ref -- the reference mask
+        reprojections -- the list of (input mask, output mask)
+        """
+        no_data = int(self.label_no_data)
+        parameters = ["nn", no_data, self.reprojection_engine]
+
+        # the masks found in the cache are not reprojected
+        keys = {}
+        remaining = []
+        for mask_in, mask_out in reprojections:
+            key = None
+            if self.cache is not None:
+                key = self.cache.key("reproject", [mask_ref, mask_in], parameters)
+                if key is not None and self.cache.get(key, [mask_out]):
+                    continue
+            keys[mask_out] = key
+            remaining.append((mask_in, mask_out))
+        if not remaining:
+            return
 
-        # re-order products according acquisition date
-        input_dates = sorted(self.product_dict.keys())
-        write_list_to_file(self.input_dates_filename, input_dates)
+        if self.reprojection_engine == "numpy":
+            target_grid = get_grid(mask_ref)
+            nb_workers = max(1, min(int(self.nb_workers), len(remaining)))
+            worker_ram = max(1, int(self.ram) // nb_workers)
+            plans = {}
+            tasks = []
+            for mask_in, mask_out in remaining:
+                source_grid = get_grid(mask_in)
+                plan_key = get_plan_key(source_grid, target_grid)
+                if plan_key not in plans:
+                    plans[plan_key] = op.join(self.path_tmp, "warp_plan_" + plan_key + ".npy")
+                    if not op.exists(plans[plan_key]):
+                        compute_warp_plan(source_grid, target_grid, plans[plan_key], self.ram)
+                tasks.append((mask_in, mask_ref, mask_out, plans[plan_key],
+                              no_data, worker_ram))
+            logging.info("Reprojecting " + str(len(tasks)) + " masks with " +
+                         str(len(plans)) + " warp plans and " +
+                         str(nb_workers) + " workers")
+            if nb_workers > 1:
+                pool = multiprocessing.Pool(nb_workers)
+                pool.map(apply_warp_plan, tasks)
+                pool.close()
+                pool.join()
+            else:
+                for task in tasks:
+                    apply_warp_plan(task)
+        else:
+            for mask_in, mask_out in remaining:
+                reproject_mask(mask_ref, mask_in, mask_out, no_data, self.ram)
 
-        # compute or retrive the output dates
+        for mask_in, mask_out in remaining:
+            if keys[mask_out] is not None:
+                self.cache.put(keys[mask_out], [mask_out])
+
+    def get_output_dates(self):
+        """ Compute or retrieve the output dates
+        """
         output_dates = []
         if op.exists(self.output_dates_filename):
             output_dates = read_list_from_file(self.output_dates_filename)
@@ -249,137 +736,113 @@ class snow_annual_map():
                 output_dates.append(datetime_to_str(tmp_date))
                 tmp_date += timedelta(days=1)
             write_list_to_file(self.output_dates_filename, output_dates)
-
-        shutil.copy2(self.input_dates_filename, self.path_out)
-        shutil.copy2(self.output_dates_filename, self.path_out)
-
-        # merge products at the same date
-        self.resulting_snow_mask_dict={}
-        for key in self.product_dict.keys():
-            if len(self.product_dict[key]) > 1:
+        return output_dates
+
+    def merge_products(self, dates, fused=False):
+        """ Merge the products acquired at the same date
+
+        Keyword arguments:
+        dates -- the dates to merge
+        fused -- keep the list of the snow masks of the dates with several
+                 products, to merge them while decoding (see decode_snow_mask)
+
+        Return the dictionary of the snow mask of each date.
+        """
+        snow_mask_dict = {}
+        for key in dates:
+            if len(self.product_dict[key]) > 1 and fused:
+                snow_mask_dict[key] = [product.get_snow_mask() for product in self.product_dict[key]]
+            elif len(self.product_dict[key]) > 1:
                 merged_mask = op.join(self.path_tmp, key + "_merged_snow_product.tif")
-                merge_masks_at_same_date(self.product_dict[key],
-                                         merged_mask,
-                                         self.label_snow,
-                                         self.ram)
-                self.resulting_snow_mask_dict[key] = merged_mask
+                self.run_cached("merge",
+                                [product.get_snow_mask() for product in self.product_dict[key]],
+                                [self.label_snow],
+                                [merged_mask],
+                                partial(merge_masks_at_same_date,
+                                        self.product_dict[key],
+                                        merged_mask,
+                                        self.label_snow,
+                                        self.ram))
+                snow_mask_dict[key] = merged_mask
             else:
-                self.resulting_snow_mask_dict[key] = self.product_dict[key][0].get_snow_mask()
-
-        # convert the snow masks into binary snow masks
-        expression = "(im1b1==" + self.label_snow + ")?1:0"
-        self.binary_snowmask_list = self.convert_mask_list(expression, "snow", GDAL_OPT)
-        logging.debug("Binary snow mask list:")
-        logging.debug(self.binary_snowmask_list)
-
-        # convert the snow masks into binary cloud masks
-        expression = "im1b1=="+self.label_cloud+"?1:(im1b1=="+self.label_no_data+"?1:0)"
-        self.binary_cloudmask_list = self.convert_mask_list(expression, "cloud", GDAL_OPT)
-        logging.debug("Binary cloud mask list:")
-        logging.debug(self.binary_cloudmask_list)
-
-        # build cloud mask vrt
-        logging.info("Building multitemp cloud mask vrt")
-        logging.info("cloud vrt: " + self.multitemp_cloud_vrt)
-        gdal.BuildVRT(self.multitemp_cloud_vrt,
-                      self.binary_cloudmask_list,
-                      separate=True)
-
-        # generate the summary map
-        band_index = range(1, len(self.binary_cloudmask_list)+1)
-        expression = "+".join(["im1b" + str(i) for i in band_index])
-
-        bandMathApp = band_math([self.multitemp_cloud_vrt],
-                                self.cloud_occurence_img,
-                                expression,
-                                self.ram,
-                                otb.ImagePixelType_uint16)
-        bandMathApp.ExecuteAndWriteOutput()
-        bandMathApp = None
-
-        logging.info("Copying outputs from tmp to output folder")
-        shutil.copy2(self.cloud_occurence_img, self.path_out)
-
-        # build snow mask vrt
-        logging.info("Building multitemp snow mask vrt")
-        logging.info("snow vrt: " + self.multitemp_snow_vrt)
-        gdal.BuildVRT(self.multitemp_snow_vrt,
-                      self.binary_snowmask_list,
-                      separate=True)
-
-        # gap filling the snow timeserie
-        app_gap_filling = gap_filling(self.multitemp_snow_vrt,
-                                      self.multitemp_cloud_vrt,
-                                      self.gapfilled_timeserie+GDAL_OPT,
-                                      self.input_dates_filename,
-                                      self.output_dates_filename,
-                                      self.ram,
-                                      otb.ImagePixelType_uint8)
-
-        # @TODO the mode is for now forced to DEBUG in order to generate img on disk
-        #img_in = get_app_output(app_gap_filling, "out", self.mode)
-        #if self.mode == "DEBUG":
-            #shutil.copy2(self.gapfilled_timeserie, self.path_out)
-            #app_gap_filling = None
-
-        img_in = get_app_output(app_gap_filling, "out", "DEBUG")
-        shutil.copy2(self.gapfilled_timeserie, self.path_out)
-        app_gap_filling = None
-
-        # generate the annual map
-        band_index = range(1, len(output_dates)+1)
-        expression = "+".join(["im1b" + str(i) for i in band_index])
-
-        bandMathApp = band_math([img_in],
-                                self.annual_snow_map,
-                                expression,
-                                self.ram,
-                                otb.ImagePixelType_uint16)
-        bandMathApp.ExecuteAndWriteOutput()
-        bandMathApp = None
-
-        logging.info("Copying outputs from tmp to output folder")
-        shutil.copy2(self.annual_snow_map, self.path_out)
-
-        logging.info("End of snow_annual_map")
-
-        if self.mode == "DEBUG":
-            dest_debug_dir = op.join(self.path_out, "tmpdir")
-            if op.exists(dest_debug_dir):
-                shutil.rmtree(dest_debug_dir)
-            shutil.copytree(self.path_tmp, dest_debug_dir)
+                snow_mask_dict[key] = self.product_dict[key][0].get_snow_mask()
+        return snow_mask_dict
 
     def load_products(self, snow_products_list, tile_id=None, product_type=None):
+        """ Load the snow products matching the date range, the tile and
+        the platform, filtering them on their names before listing the
+        kept product directories concurrently (see scan_products)
+
+        Return the dictionary of the products of each date.
+        """
         logging.info("Parsing provided snow products list")
         product_dict = {}
         search_start_date = self.date_start - self.date_margin
         search_stop_date = self.date_stop + self.date_margin
+        candidates = []
+        nb_discarded = 0
         for product_path in snow_products_list:
-            try:
-                product = load_snow_product(str(product_path))
-                logging.info(str(product))
-                current_day = datetime_to_str(product.acquisition_date)
-                test_result = True
-                if search_start_date > product.acquisition_date or \
-                   search_stop_date < product.acquisition_date:
-                   test_result = False
-                if (tile_id is not None) and (tile_id not in product.tile_id):
-                   test_result = False
-                if (product_type is not None) and (product_type not in product.platform):
-                   test_result = False
-                if test_result:
-                    if current_day not in product_dict.keys():
-                        product_dict[current_day] = [product]
-                    else:
-                        product_dict[current_day].append(product)
-                    logging.info("Keeping: " + str(product))
-                else:
-                    logging.warning("Discarding: " + str(product))
-            except Exception:
+            product_path = str(product_path)
+            name_info = parse_product_name(op.basename(product_path))
+            if name_info is None:
                 logging.error("Unable to load product :" + product_path)
+                continue
+            test_result = True
+            if search_start_date > name_info["acquisition_date"] or \
+               search_stop_date < name_info["acquisition_date"]:
+               test_result = False
+            if (tile_id is not None) and (tile_id not in name_info["tile_id"]):
+               test_result = False
+            if (product_type is not None) and (product_type not in name_info["platform"]):
+               test_result = False
+            if test_result:
+                candidates.append(product_path)
+            else:
+                logging.debug("Discarding: " + product_path)
+                nb_discarded += 1
+
+        products = scan_products(candidates, self.scan_threads, self.product_index)
+        for product in products:
+            if product is None:
+                continue
+            current_day = datetime_to_str(product.acquisition_date)
+            if current_day not in product_dict.keys():
+                product_dict[current_day] = [product]
+            else:
+                product_dict[current_day].append(product)
+            logging.debug("Keeping: " + str(product))
+        logging.info(str(sum(len(day_products) for day_products in product_dict.values())) +
+                     " products kept, " + str(nb_discarded) + " discarded")
         return product_dict
 
         
+    def load_catalog_products(self, tile_id=None, platform=None):
+        """ Load the snow products of the date range from the catalog
+
+        Keyword arguments:
+        tile_id -- the tile of the products (not mandatory)
+        platform -- the platform of the products, e.g. SENTINEL2 (not mandatory)
+
+        Return the dictionary of the products of each date.
+        """
+        logging.info("Querying the snow products catalog " + self.catalog)
+        catalog = snow_product_catalog(self.catalog)
+        products = catalog.get_products(tile_id,
+                                        self.date_start - self.date_margin,
+                                        self.date_stop + self.date_margin,
+                                        platform)
+        catalog.close()
+
+        product_dict = {}
+        for product in products:
+            current_day = datetime_to_str(product.acquisition_date)
+            if current_day not in product_dict.keys():
+                product_dict[current_day] = [product]
+            else:
+                product_dict[current_day].append(product)
+        logging.info(str(len(products)) + " products found in the catalog")
+        return product_dict
+
     def convert_mask_list(self, expression, type_name, mask_format=""):
         binary_mask_list = []
         for mask_date in sorted(self.resulting_snow_mask_dict):
@@ -393,11 +856,116 @@ class snow_annual_map():
         return binary_mask_list
 
 
+    def decode_mask_list(self, path=None):
+        """ Convert the snow masks into binary snow and cloud masks,
+        reading each snow mask once and processing nb_workers dates
+        concurrently
+
+        Keyword arguments:
+        path -- the directory of the binary masks (path_tmp by default)
+
+        Return the lists of binary snow and cloud masks sorted by date.
+        """
+        if path is None:
+            path = self.path_tmp
+        labels = (self.label_snow, self.label_cloud, self.label_no_data)
+        nb_workers = max(1, min(int(self.nb_workers),
+                                len(self.resulting_snow_mask_dict)))
+        # each worker gets its share of the ram
+        worker_ram = max(1, int(self.ram) // nb_workers)
+
+        tasks = []
+        for mask_date in sorted(self.resulting_snow_mask_dict):
+            tasks.append((self.resulting_snow_mask_dict[mask_date],
+                          op.join(path, mask_date + "_snow_binary.tif"),
+                          op.join(path, mask_date + "_cloud_binary.tif"),
+                          labels,
+                          worker_ram))
+
+        # the masks found in the cache are not decoded
+        keys = {}
+        remaining_tasks = []
+        for task in tasks:
+            key = None
+            if self.cache is not None:
+                inputs = task[0] if isinstance(task[0], list) else [task[0]]
+                key = self.cache.key("decode", inputs, list(labels))
+                if key is not None and self.cache.get(key, [task[1], task[2]]):
+                    continue
+            keys[task[1]] = key
+            remaining_tasks.append(task)
+
+        logging.info("Decoding " + str(len(remaining_tasks)) + " snow masks with " +
+                     str(nb_workers) + " workers")
+        if nb_workers > 1 and len(remaining_tasks) > 1:
+            pool = multiprocessing.Pool(nb_workers)
+            pool.map(decode_snow_mask, remaining_tasks)
+            pool.close()
+            pool.join()
+        else:
+            for task in remaining_tasks:
+                decode_snow_mask(task)
+
+        for task in remaining_tasks:
+            if keys[task[1]] is not None:
+                self.cache.put(keys[task[1]], [task[1], task[2]])
+
+        return ([task[1] for task in tasks],
+                [task[2] for task in tasks])
+
+    def decode_mask_cubes(self):
+        """ Convert the snow masks into the multi-date binary snow and
+        cloud cubes (one band per date), reading each snow mask once
+        """
+        mask_list = [(self.resulting_snow_mask_dict[mask_date], 1)
+                     for mask_date in sorted(self.resulting_snow_mask_dict)]
+        kernel = partial(snow_product_masks_kernel,
+                         label_snow=self.label_snow,
+                         label_cloud=self.label_cloud,
+                         label_no_data=self.label_no_data)
+        # band interleaving, so that each band block is written once
+        cube_options = GDAL_CO_MASK + ["INTERLEAVE=BAND"]
+        self.run_cached("decode_cubes",
+                        [mask for mask, _ in mask_list],
+                        [self.label_snow, self.label_cloud, self.label_no_data],
+                        [self.multitemp_snow_cube, self.multitemp_cloud_cube],
+                        partial(process_stack_by_blocks,
+                                mask_list,
+                                [(self.multitemp_snow_cube, gdal.GDT_Byte, cube_options),
+                                 (self.multitemp_cloud_cube, gdal.GDT_Byte, cube_options)],
+                                kernel,
+                                self.ram))
+
     def extract_binary_mask(self, mask_in, mask_out, expression, mask_format=""):
-        bandMathApp = band_math([mask_in],
+        self.run_cached("band_math",
+                        [mask_in],
+                        [expression, mask_format],
+                        [mask_out],
+                        partial(self.band_math_to_file,
+                                mask_in,
                                 mask_out + mask_format,
+                                expression))
+        return mask_out
+
+    def band_math_to_file(self, mask_in, mask_out, expression):
+        bandMathApp = band_math([mask_in],
+                                mask_out,
                                 expression,
                                 self.ram,
                                 otb.ImagePixelType_uint8)
         bandMathApp.ExecuteAndWriteOutput()
-        return mask_out
+
+    def run_cached(self, operation, inputs, parameters, outputs, compute):
+        """ Run compute() unless the outputs are found in the mask cache
+
+        Keyword arguments:
+        operation -- the operation name
+        inputs -- the input files
+        parameters -- the parameters of the operation
+        outputs -- the output files
+        compute -- the function computing the outputs (without arguments)
+        """
+        if self.cache is None:
+            compute()
+        else:
+            self.cache.run(operation, inputs, parameters, outputs, compute)
@@ -33,6 +33,8 @@ from s2snow.utils import get_raster_as_array, apply_color_table
 from s2snow.utils import str_to_datetime, datetime_to_str
 from s2snow.utils import write_list_to_file, read_list_from_file
 from s2snow.snow_annual_map import snow_annual_map
+from s2snow.block_processing import create_raster
+from s2snow.chunked_cube import chunked_cube_reader
 
 
 # Build gdal option to generate maks of 1 byte using otb extended filename
@@ -144,6 +146,15 @@ class snow_annual_map_evaluation(snow_annual_map):
         """
         logging.info("Run snow_annual_map_evaluation")
 
+        # the gap filled dates are read from the time series cube if any
+        gapfilled_layer = None
+        if self.output_cube and op.exists(self.time_series_cube):
+            gapfilled_layer = chunked_cube_reader(self.time_series_cube).layer("gapfilled")
+        elif not self.write_daily_masks or not op.exists(self.gapfilled_timeserie):
+            logging.error("The evaluation requires the daily snow masks as gtiff " \
+                          "(write_daily_masks and daily_masks_format) or the time series cube")
+            return
+
         # Set maximum ITK threads
         if self.nbThreads:
             os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(self.nbThreads)
@@ -206,13 +217,18 @@ class snow_annual_map_evaluation(snow_annual_map):
             s2_index, comparison_index = pair_dict[comparison_date]
 
             path_extracted = op.join(self.path_tmp, "gapfilled_s2_" + comparison_date + ".tif")
-            gdal.Translate(
-                path_extracted,
-                self.gapfilled_timeserie,
-                format='GTiff',
-                outputType=gdal.GDT_Byte,
-                noData=None,
-                bandList=[s2_index+1])
+            if gapfilled_layer is not None:
+                dataset = create_raster(path_extracted, self.annual_snow_map)
+                dataset.GetRasterBand(1).WriteArray(gapfilled_layer.read_date(s2_index))
+                dataset = None
+            else:
+                gdal.Translate(
+                    path_extracted,
+                    self.gapfilled_timeserie,
+                    format='GTiff',
+                    outputType=gdal.GDT_Byte,
+                    noData=None,
+                    bandList=[s2_index+1])
 
             expression = "im2b1==2?254:(2*im2b1+im1b1)"
             img_out = op.join(self.path_tmp, "comparision_" + comparison_date + ".tif")
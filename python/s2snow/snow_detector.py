@@ -20,6 +20,7 @@ import os
 import os.path as op
 import shutil
 import logging
+from functools import partial
 from lxml import etree
 
 import gdal
@@ -33,7 +34,14 @@ from s2snow.dem_builder import build_dem
 
 # Import python decorators for the different needed OTB applications
 from s2snow.app_wrappers import compute_snow_mask, compute_cloud_mask
-from s2snow.app_wrappers import band_math, compute_snow_line
+from s2snow.app_wrappers import band_math, compute_snow_line, get_app_output
+
+# Import numpy kernels and block processing used by the numpy engine
+from s2snow.block_processing import process_by_blocks, get_block_lines, GDAL_CO_MASK
+from s2snow.snow_kernels import cloud_masks_kernel, pass1_kernel, pass2_kernel
+from s2snow.snow_kernels import pass3_kernel, cloud_refine_kernel
+from s2snow.snow_kernels import cloud_refine_coarse_red_kernel
+from s2snow.snow_kernels import empty_kernel, final_mask_kernel
 
 # Import utilities for snow detection
 from s2snow.utils import polygonize, extract_band, burn_polygons_edges, composition_RGB
@@ -62,6 +70,33 @@ class snow_detector:
         self.nodata = general.get("nodata", -10000)
         self.multi = general.get("multi", 1)  # Multiplier to handle S2 scaling
 
+        ## Zero-copy inputs (off by default)
+        ## If set to True the Int16 input bands are referenced by vrt
+        ## files instead of being copied into pout
+        self.zero_copy_inputs = general.get("zero_copy_inputs", False)
+
+        ## Warped vrt resampling (off by default)
+        ## If set to True the bands which are not at the target resolution
+        ## are resampled on the fly through warped vrt files, instead of
+        ## being resampled on disk
+        self.warped_vrt = general.get("warped_vrt", False)
+
+        ## Fused pipeline (off by default)
+        ## If set to True the intermediate masks are chained in memory
+        ## and only the products required by later steps are written
+        self.fused = general.get("fused", False)
+        # Keep a reference on the applications executed in memory
+        # to maintain the pipeline alive until the final products are written
+        self.in_memory_apps = []
+
+        ## Processing engine of the passes: "otb" (BandMath applications)
+        ## or "numpy" (numpy kernels streamed by blocks of lines)
+        self.engine = general.get("engine", "otb")
+        # Number of lines per block for the numpy engine
+        # (if not set, it is deduced from the ram parameter)
+        self.block_lines = general.get("block_lines", None)
+        logging.info("Processing engine: " + str(self.engine))
+
         # Resolutions in meter for the snow product
         # (if -1 the target resolution is equal to the max resolution of the input band)
         self.target_resolution = general.get("target_resolution", -1)
@@ -81,6 +116,13 @@ class snow_detector:
         self.rRed_darkcloud *= self.multi
         self.rRed_backtocloud = cloud.get("red_backtocloud")
         self.rRed_backtocloud *= self.multi
+        ## Dark cloud test on the red mean of rf x rf cells computed by
+        ## blocks, without the red_coarse.tif and red_nn.tif intermediates
+        ## (numpy engine only, off by default)
+        self.coarse_red_by_blocks = cloud.get("coarse_red_by_blocks", False)
+        if self.coarse_red_by_blocks and self.engine != "numpy":
+            logging.warning("coarse_red_by_blocks requires the numpy engine, ignored")
+            self.coarse_red_by_blocks = False
         self.shadow_in_mask = cloud.get("shadow_in_mask")
         self.shadow_out_mask = cloud.get("shadow_out_mask")
         self.all_cloud_mask = cloud.get("all_cloud_mask")
@@ -95,6 +137,8 @@ class snow_detector:
         self.dilation_radius = cloud.get("rm_snow_inside_cloud_dilation_radius", 5)
         self.cloud_threshold = cloud.get("rm_snow_inside_cloud_threshold", 0.85)
         self.cloud_min_area_size = cloud.get("rm_snow_inside_cloud_min_area", 25000)
+        ## Process the snow inside cloud removal by tiles (in memory by default)
+        self.cloud_tile_size = cloud.get("rm_snow_inside_cloud_tile_size", None)
 
         # Parse input parameters
         inputs = data["inputs"]
@@ -121,9 +165,12 @@ class snow_detector:
             bandMathSlopeFlag = None
 
         # bands paths
-        gb_path_extracted = extract_band(inputs, "green_band", self.path_tmp, self.nodata)
-        rb_path_extracted = extract_band(inputs, "red_band", self.path_tmp, self.nodata)
-        sb_path_extracted = extract_band(inputs, "swir_band", self.path_tmp, self.nodata)
+        gb_path_extracted = extract_band(inputs, "green_band", self.path_tmp, self.nodata,
+                                         self.zero_copy_inputs)
+        rb_path_extracted = extract_band(inputs, "red_band", self.path_tmp, self.nodata,
+                                         self.zero_copy_inputs)
+        sb_path_extracted = extract_band(inputs, "swir_band", self.path_tmp, self.nodata,
+                                         self.zero_copy_inputs)
 
         # Keep the input product directory basename as product_id
         self.product_id = op.basename(op.dirname(inputs["green_band"]["path"]))
@@ -143,9 +190,15 @@ class snow_detector:
         sb_dataset = None
 
         # test if different reso
-        gb_path_resampled = op.join(self.path_tmp, "green_band_resampled.tif")
-        rb_path_resampled = op.join(self.path_tmp, "red_band_resampled.tif")
-        sb_path_resampled = op.join(self.path_tmp, "swir_band_resampled.tif")
+        resampled_format = "GTiff"
+        resampled_extension = ".tif"
+        if self.warped_vrt:
+            # the resampling is done on read, for the blocks actually read
+            resampled_format = "VRT"
+            resampled_extension = ".vrt"
+        gb_path_resampled = op.join(self.path_tmp, "green_band_resampled" + resampled_extension)
+        rb_path_resampled = op.join(self.path_tmp, "red_band_resampled" + resampled_extension)
+        sb_path_resampled = op.join(self.path_tmp, "swir_band_resampled" + resampled_extension)
 
         # target resolution of the snow product
         max_res = max(gb_resolution, rb_resolution, sb_resolution)
@@ -160,6 +213,7 @@ class snow_detector:
             gdal.Warp(
                 rb_path_resampled,
                 rb_path_extracted,
+                format=resampled_format,
                 resampleAlg=gdal.GRIORA_Cubic,
                 xRes=self.target_resolution,
                 yRes=self.target_resolution)
@@ -171,6 +225,7 @@ class snow_detector:
             gdal.Warp(
                 gb_path_resampled,
                 gb_path_extracted,
+                format=resampled_format,
                 resampleAlg=gdal.GRIORA_Cubic,
                 xRes=self.target_resolution,
                 yRes=self.target_resolution)
@@ -182,6 +237,7 @@ class snow_detector:
             gdal.Warp(
                 sb_path_resampled,
                 sb_path_extracted,
+                format=resampled_format,
                 resampleAlg=gdal.GRIORA_Cubic,
                 xRes=self.target_resolution,
                 yRes=self.target_resolution)
@@ -230,12 +286,25 @@ class snow_detector:
         self.pass2_path = op.join(self.path_tmp, "pass2.tif")
         self.pass3_path = op.join(self.path_tmp, "pass3.tif")
         self.redBand_path = op.join(self.path_tmp, "red.tif")
+        if self.zero_copy_inputs:
+            # the bands of lis.vrt are already Int16
+            self.redBand_path = op.join(self.path_tmp, "red.vrt")
         self.all_cloud_path = op.join(self.path_tmp, "all_cloud_mask.tif")
         self.cloud_pass1_path = op.join(self.path_tmp, "cloud_pass1.tif")
         self.cloud_refine_path = op.join(self.path_tmp, "cloud_refine.tif")
         self.nodata_path = op.join(self.path_tmp, "nodata_mask.tif")
         self.mask_backtocloud = op.join(self.path_tmp, "mask_backtocloud.tif")
 
+        # Intermediate masks, either filenames or in-memory images
+        # in fused mode (set during the passes)
+        self.nodata_mask = self.nodata_path
+        self.shadow_mask = op.join(self.path_tmp, "shadow_mask.tif")
+        self.high_clouds = op.join(self.path_tmp, "high_cloud_mask.tif")
+        self.back_to_cloud = self.mask_backtocloud
+        self.cloud_refine = self.cloud_refine_path
+        self.pass2_mask = self.pass2_path
+        self.pass3_mask = self.pass3_path
+
         # Prepare product directory
         self.product_path = op.join(self.path_tmp, "LIS_PRODUCTS")
         if not op.exists(self.product_path):
@@ -249,6 +318,17 @@ class snow_detector:
         self.histogram_path = op.join(self.product_path, "LIS_HISTO.TXT")
         self.metadata_path = op.join(self.product_path, "LIS_METADATA.XML")
 
+    def get_output(self, app, on_disk=False):
+        """ Execute the application and return its output
+
+        In fused mode the output is kept in memory, unless on_disk is
+        required, else it is written and the filename is returned.
+        """
+        if self.fused and not on_disk:
+            self.in_memory_apps.append(app)
+            return get_app_output(app, "out", "RUNTIME")
+        return get_app_output(app, "out", "DEBUG")
+
     def detect_snow(self, nbPass):
         # Set maximum ITK threads
         if self.nbThreads:
@@ -264,14 +344,16 @@ class snow_detector:
             self.dem = pout_resampled_dem
 
         # Initialize the mask
-        noDataMaskExpr = "im1b1==" + str(self.nodata) + "?1:0"
-        bandMath = band_math(
-            [self.img],
-            self.nodata_path,
-            noDataMaskExpr,
-            self.ram)
-        bandMath.ExecuteAndWriteOutput()
-        bandMath = None
+        # (the numpy engine applies the no-data mask with the final mask)
+        if self.engine != "numpy":
+            noDataMaskExpr = "im1b1==" + str(self.nodata) + "?1:0"
+            bandMath = band_math(
+                [self.img],
+                self.nodata_path,
+                noDataMaskExpr,
+                self.ram)
+            self.nodata_mask = self.get_output(bandMath)
+            bandMath = None
 
         if nbPass >= 0:
             self.pass0()
@@ -389,7 +471,7 @@ class snow_detector:
                 "(im1b1 == 3)",
                 self.ram,
                 otb.ImagePixelType_uint8)
-            bandMathShadow.ExecuteAndWriteOutput()
+            self.shadow_mask = self.get_output(bandMathShadow)
             bandMathShadow = None
         else:
             # First extract shadow wich corresponds to shadow of clouds inside the
@@ -400,7 +482,7 @@ class snow_detector:
                 str(self.shadow_in_mask),
                 self.ram,
                 otb.ImagePixelType_uint8)
-            computeCMApp.ExecuteAndWriteOutput()
+            shadow_in = self.get_output(computeCMApp)
             computeCMApp = None
 
             # Then extract shadow mask of shadows from clouds outside the image
@@ -410,19 +492,18 @@ class snow_detector:
                 str(self.shadow_out_mask),
                 self.ram,
                 otb.ImagePixelType_uint8)
-            computeCMApp.ExecuteAndWriteOutput()
+            shadow_out = self.get_output(computeCMApp)
             computeCMApp = None
 
             # The output shadow mask corresponds to a OR logic between the 2 shadow
             # masks
             bandMathShadow = band_math(
-                [op.join(self.path_tmp, "shadow_in_mask.tif"),
-                 op.join(self.path_tmp, "shadow_out_mask.tif")],
+                [shadow_in, shadow_out],
                 shadow_mask_path,
                 "(im1b1 == 1) || (im2b1 == 1)",
                 self.ram,
                 otb.ImagePixelType_uint8)
-            bandMathShadow.ExecuteAndWriteOutput()
+            self.shadow_mask = self.get_output(bandMathShadow)
             bandMathShadow = None
 
     def extract_high_clouds(self):
@@ -436,7 +517,7 @@ class snow_detector:
                 "(im1b1 == 10)",
                 self.ram,
                 otb.ImagePixelType_uint8)
-            bandMathHighClouds.ExecuteAndWriteOutput()
+            self.high_clouds = self.get_output(bandMathHighClouds)
             bandMathHighClouds = None
         else:
             computeCMApp = compute_cloud_mask(
@@ -445,7 +526,7 @@ class snow_detector:
                 str(self.high_cloud_mask),
                 self.ram,
                 otb.ImagePixelType_uint8)
-            computeCMApp.ExecuteAndWriteOutput()
+            self.high_clouds = self.get_output(computeCMApp)
             computeCMApp = None
 
     def extract_backtocloud_mask(self):
@@ -469,7 +550,8 @@ class snow_detector:
             condition_back_to_cloud + "?1:0",
             self.ram,
             otb.ImagePixelType_uint8)
-        bandMathBackToCloud.ExecuteAndWriteOutput()
+        self.back_to_cloud = self.get_output(bandMathBackToCloud)
+        bandMathBackToCloud = None
         
     def pass0(self):
         # Pass -0 : generate custom cloud mask
@@ -477,11 +559,17 @@ class snow_detector:
         gdal.Translate(
             self.redBand_path,
             self.img,
-            format='GTiff',
+            format='VRT' if self.zero_copy_inputs else 'GTiff',
             outputType=gdal.GDT_Int16,
             noData=self.nodata,
             bandList=[self.nRed])
 
+        if self.coarse_red_by_blocks:
+            # no red_coarse.tif and red_nn.tif, the coarse red band is
+            # computed by blocks in pass1
+            self.extract_cloud_masks_by_blocks()
+            return
+
         dataset = gdal.Open(self.redBand_path, GA_ReadOnly)
 
         xSize = dataset.RasterXSize
@@ -517,6 +605,10 @@ class snow_detector:
         dataset = None
 
         ## Extract layers related to the cloud mask
+        if self.engine == "numpy":
+            # Extract all the layers with a single read of the cloud mask
+            self.extract_cloud_masks_by_blocks()
+            return
 
         # Extract all cloud masks
         self.extract_all_clouds()
@@ -530,6 +622,26 @@ class snow_detector:
         # Extract also a mask for condition back to cloud
         self.extract_backtocloud_mask()
 
+    def extract_cloud_masks_by_blocks(self):
+        # Extract the all cloud, shadow, high cloud and back to cloud masks
+        # (numpy engine equivalent of the extract_* methods)
+        process_by_blocks(
+            [(self.cloud_init, 1),
+             (self.redBand_path, 1)],
+            [(self.all_cloud_path, gdal.GDT_Byte, GDAL_CO_MASK),
+             (self.shadow_mask, gdal.GDT_Byte, GDAL_CO_MASK),
+             (self.high_clouds, gdal.GDT_Byte, GDAL_CO_MASK),
+             (self.back_to_cloud, gdal.GDT_Byte, GDAL_CO_MASK)],
+            partial(cloud_masks_kernel,
+                    mode=self.mode,
+                    all_cloud_mask=self.all_cloud_mask,
+                    shadow_in_mask=self.shadow_in_mask,
+                    shadow_out_mask=self.shadow_out_mask,
+                    high_cloud_mask=self.high_cloud_mask,
+                    red_backtocloud=self.rRed_backtocloud),
+            self.ram,
+            self.block_lines)
+
     def pass1(self):
         logging.info("Start pass 1")
 
@@ -544,14 +656,27 @@ class snow_detector:
         condition_pass1 = condition_ndsi + \
             " and im1b" + str(self.nRed) + "> " + str(self.rRed_pass1) + ")"
 
-        bandMathPass1 = band_math(
-            [self.img, self.all_cloud_path],
-            self.pass1_path + GDAL_OPT,
-            condition_pass1 + "?1:0",
-            self.ram,
-            otb.ImagePixelType_uint8)
-        bandMathPass1.ExecuteAndWriteOutput()
-        bandMathPass1 = None
+        if self.engine == "numpy":
+            process_by_blocks(
+                [(self.img, self.nSWIR),
+                 (self.img, self.nRed),
+                 (self.img, self.nGreen),
+                 (self.all_cloud_path, 1)],
+                [(self.pass1_path, gdal.GDT_Byte, GDAL_CO_MASK)],
+                partial(pass1_kernel,
+                        ndsi_pass1=self.ndsi_pass1,
+                        red_pass1=self.rRed_pass1),
+                self.ram,
+                self.block_lines)
+        else:
+            bandMathPass1 = band_math(
+                [self.img, self.all_cloud_path],
+                self.pass1_path + GDAL_OPT,
+                condition_pass1 + "?1:0",
+                self.ram,
+                otb.ImagePixelType_uint8)
+            bandMathPass1.ExecuteAndWriteOutput()
+            bandMathPass1 = None
 
         # create a working copy of all cloud mask
         shutil.copy(self.all_cloud_path, self.cloud_pass1_path)
@@ -563,7 +688,8 @@ class snow_detector:
                          self.cloud_pass1_path,
                          self.dilation_radius,
                          self.cloud_threshold,
-                         self.cloud_min_area_size)
+                         self.cloud_min_area_size,
+                         self.cloud_tile_size)
 
         # The computation of cloud refine is done below,
         # because the inital cloud may be updated within pass1_5
@@ -579,91 +705,81 @@ class snow_detector:
 
         logging.info(condition_shadow)
 
-        bandMathFinalShadow = band_math(
-            [self.all_cloud_path,
-             op.join(self.path_tmp, "shadow_mask.tif"),
-             op.join(self.path_tmp, "red_nn.tif"),
-             op.join(self.path_tmp, "high_cloud_mask.tif"),
-             self.cloud_pass1_path],
-            self.cloud_refine_path + GDAL_OPT,
-            condition_shadow,
-            self.ram,
-            otb.ImagePixelType_uint8)
-        bandMathFinalShadow.ExecuteAndWriteOutput()
+        if self.coarse_red_by_blocks:
+            dataset = gdal.Open(self.img, GA_ReadOnly)
+            block_lines = self.block_lines or get_block_lines(dataset.RasterXSize, 6, self.ram)
+            dataset = None
+            # the rf x rf cells must not overlap two blocks
+            block_lines = max(self.rf, block_lines // self.rf * self.rf)
+            process_by_blocks(
+                [(self.all_cloud_path, 1),
+                 (self.shadow_mask, 1),
+                 (self.img, self.nRed),
+                 (self.high_clouds, 1),
+                 (self.cloud_pass1_path, 1)],
+                [(self.cloud_refine_path, gdal.GDT_Byte, GDAL_CO_MASK)],
+                partial(cloud_refine_coarse_red_kernel,
+                        red_darkcloud=self.rRed_darkcloud,
+                        rf=self.rf,
+                        nodata=self.nodata),
+                self.ram,
+                block_lines)
+        elif self.engine == "numpy":
+            process_by_blocks(
+                [(self.all_cloud_path, 1),
+                 (self.shadow_mask, 1),
+                 (op.join(self.path_tmp, "red_nn.tif"), 1),
+                 (self.high_clouds, 1),
+                 (self.cloud_pass1_path, 1)],
+                [(self.cloud_refine_path, gdal.GDT_Byte, GDAL_CO_MASK)],
+                partial(cloud_refine_kernel,
+                        red_darkcloud=self.rRed_darkcloud),
+                self.ram,
+                self.block_lines)
+        else:
+            bandMathFinalShadow = band_math(
+                [self.all_cloud_path,
+                 self.shadow_mask,
+                 op.join(self.path_tmp, "red_nn.tif"),
+                 self.high_clouds,
+                 self.cloud_pass1_path],
+                self.cloud_refine_path + GDAL_OPT,
+                condition_shadow,
+                self.ram,
+                otb.ImagePixelType_uint8)
+            self.cloud_refine = self.get_output(bandMathFinalShadow)
+            bandMathFinalShadow = None
 
         logging.info("End of pass 1")
 
-    def pass1_5(self, snow_mask_path, cloud_mask_path, radius=1, cloud_threshold=0.85, min_area_size=25000):
+    def pass1_5(self, snow_mask_path, cloud_mask_path, radius=1, cloud_threshold=0.85, min_area_size=25000, tile_size=None):
         logging.info("Start pass 1.5")
-        import numpy as np
-        import scipy.ndimage as nd
+        from s2snow.snow_inside_cloud import remove_snow_inside_cloud
+        from s2snow.snow_inside_cloud import remove_snow_inside_cloud_by_tiles
+
+        if tile_size:
+            # Bounded memory processing, the masks are updated in place
+            remove_snow_inside_cloud_by_tiles(snow_mask_path,
+                                              cloud_mask_path,
+                                              self.path_tmp,
+                                              radius,
+                                              cloud_threshold,
+                                              min_area_size,
+                                              tile_size,
+                                              self.nbThreads or 1)
+            logging.info("End of pass 1.5")
+            return
 
         snow_mask = get_raster_as_array(snow_mask_path)
         cloud_mask = get_raster_as_array(cloud_mask_path)
 
-        snow_mask_init = np.copy(snow_mask)
-
-        discarded_snow_area = 0
-
-        (snowlabels, nb_label) = nd.measurements.label(snow_mask)
-        logging.info("There is " + str(nb_label) + " snow areas")
-
-        # build the structuring element for dilation
-        struct = np.zeros((2*radius+1, 2*radius+1))
-        y, x = np.ogrid[-radius:radius+1, -radius:radius+1]
-        mask = x**2 + y**2 <= radius**2
-        struct[mask] = 1
-
-        # compute individual snow area size
-        (labels, label_counts)= np.unique(snowlabels, return_counts=True)
-        labels_area = dict(zip(labels, label_counts))
-        logging.debug(labels_area)
-
-        logging.debug("Start loop on snow areas")
-
-        # For each snow area
-        for lab in range(1, nb_label+1):
-            # Compute external contours
-            logging.debug("Processing area " + str(lab))
-            current_mask_area = labels_area[lab]
-            logging.debug("Current area size = " + str(current_mask_area))
-            if current_mask_area > min_area_size:
-                logging.debug("Processing snow area of size = " + str(current_mask_area))
-                current_mask = np.where(snowlabels == lab, 1, 0)
-                patch_neige_dilat = nd.binary_dilation(current_mask, struct)
-                logging.debug("Contour processing start")
-                contour = np.where((snow_mask == 0) & (patch_neige_dilat == 1))
-
-                # Compute percent of surronding cloudy pixels
-                cloud_contour = cloud_mask[contour]
-                # print cloud_contour
-                logging.debug("Contour processing done.")
-
-                result = np.bincount(cloud_contour)
-                logging.debug(result)
-                cloud_percent = 0
-                if len(result) > 1:
-                    cloud_percent = float(result[1]) / (result[0] + result[1])
-                    logging.info(result)
-                    logging.info(", " + str(cloud_percent*100) + "% of surrounding cloud")
-
-                # Discard snow area where cloud_percent > threshold
-                if cloud_percent > cloud_threshold:
-                    logging.info("Updating snow mask...")
-                    discarded_snow_area += 1
-                    snow_mask = np.where(snowlabels == lab, 0, snow_mask)
-                    logging.info("Updating snow mask...Done")
-                    logging.info("End of processing area " + str(lab))
-
-        logging.info(str(discarded_snow_area) + ' labels entoures de nuages (sur ' \
-                     + str(nb_label) + ' labels)')
-
-        (snowlabels, nb_label) = nd.measurements.label(snow_mask)
-
-        logging.info(str(nb_label) + ' labels neige apres correction')
+        (snow_mask, updated_cloud_mask) = remove_snow_inside_cloud(snow_mask,
+                                                                   cloud_mask,
+                                                                   radius,
+                                                                   cloud_threshold,
+                                                                   min_area_size)
 
         # Update cloud mask with discared snow area
-        updated_cloud_mask = np.where((snow_mask == 0) & (snow_mask_init == 1), 1, cloud_mask)
         dataset = gdal.Open(cloud_mask_path, GA_Update)
         band = dataset.GetRasterBand(1)
         band.WriteArray(updated_cloud_mask)
@@ -716,16 +832,33 @@ class snow_detector:
                                   + " and (" + ndsi_formula + "> " + str(self.ndsi_pass2) + ")" \
                                   + " and (im1b" + str(self.nRed) + ">" + str(self.rRed_pass2) + ")"
 
-                bandMathPass2 = band_math([self.img,
-                                           self.dem,
-                                           self.cloud_refine_path],
-                                          self.pass2_path + GDAL_OPT,
-                                          condition_pass2 + "?1:0",
-                                          self.ram,
-                                          otb.ImagePixelType_uint8)
-
-                bandMathPass2.ExecuteAndWriteOutput()
-                bandMathPass2 = None
+                if self.engine == "numpy":
+                    process_by_blocks(
+                        [(self.img, self.nSWIR),
+                         (self.img, self.nRed),
+                         (self.img, self.nGreen),
+                         (self.dem, 1),
+                         (self.cloud_refine_path, 1)],
+                        [(self.pass2_path, gdal.GDT_Byte, GDAL_CO_MASK)],
+                        partial(pass2_kernel,
+                                zs=self.zs,
+                                ndsi_pass2=self.ndsi_pass2,
+                                red_pass2=self.rRed_pass2),
+                        self.ram,
+                        self.block_lines)
+                else:
+                    bandMathPass2 = band_math([self.img,
+                                               self.dem,
+                                               self.cloud_refine],
+                                              self.pass2_path + GDAL_OPT,
+                                              condition_pass2 + "?1:0",
+                                              self.ram,
+                                              otb.ImagePixelType_uint8)
+
+                    # pass2 is only required on disk to generate its polygons
+                    self.pass2_mask = self.get_output(bandMathPass2,
+                                                      self.generate_intermediate_vectors)
+                    bandMathPass2 = None
 
                 if self.generate_intermediate_vectors:
                     # Generate polygons for pass2 (useful for quality check)
@@ -737,32 +870,19 @@ class snow_detector:
                                self.gdal_trace_outline_min_area,
                                self.gdal_trace_outline_dp_toler)
                 self.pass3()
-                generic_snow_path = self.pass3_path
+                generic_snow_path = self.pass3_mask
             else:
                 # No zs elevation found, take result of pass1 in the output
                 # product
                 logging.warning("did not find zs, keep pass 1 result.")
                 generic_snow_path = self.pass1_path
                 # empty image pass2 is needed for computing snow_all
-
-                bandMathEmptyPass2 = band_math([self.pass1_path],
-                                               self.pass2_path + GDAL_OPT,
-                                               "0",
-                                               self.ram,
-                                               otb.ImagePixelType_uint8)
-                bandMathEmptyPass2.ExecuteAndWriteOutput()
+                self.empty_pass2()
 
         else:
             generic_snow_path = self.pass1_path
             # empty image pass2 is needed for computing snow_all
-            # FIXME: A bit overkill to need to BandMath to create an image with
-            # 0
-            bandMathEmptyPass2 = band_math([self.pass1_path],
-                                           self.pass2_path + GDAL_OPT,
-                                           "0",
-                                           self.ram,
-                                           otb.ImagePixelType_uint8)
-            bandMathEmptyPass2.ExecuteAndWriteOutput()
+            self.empty_pass2()
 
         if self.generate_intermediate_vectors:
             # Generate polygons for pass3 (useful for quality check)
@@ -790,45 +910,114 @@ class snow_detector:
 
         logging.info("Final condition for snow masking: " + condition_final)
 
-        bandMathFinalCloud = band_math([self.cloud_refine_path,
-                                        generic_snow_path,
-                                        self.mask_backtocloud],
+        if self.engine == "numpy":
+            # The no-data mask is applied by the same kernel
+            process_by_blocks(
+                [(self.cloud_refine_path, 1),
+                 (generic_snow_path, 1),
+                 (self.mask_backtocloud, 1),
+                 (self.img, 1)],
+                [(self.final_mask_path, gdal.GDT_Byte, [])],
+                partial(final_mask_kernel,
+                        strict_cloud_mask=self.strict_cloud_mask,
+                        nodata=self.nodata,
+                        label_snow=self.label_snow,
+                        label_cloud=self.label_cloud,
+                        label_no_data=self.label_no_data),
+                self.ram,
+                self.block_lines)
+        elif self.fused:
+            # Apply the no-data mask within the same application
+            # to write the final mask only once
+            condition_final = "im4b1==1?" + str(self.label_no_data) + \
+                              ":(" + condition_final + ")"
+            logging.info("Final condition including no-data: " + condition_final)
+
+            bandMathFinalCloud = band_math([self.cloud_refine,
+                                            generic_snow_path,
+                                            self.back_to_cloud,
+                                            self.nodata_mask],
+                                           self.final_mask_path,
+                                           condition_final,
+                                           self.ram,
+                                           otb.ImagePixelType_uint8)
+            bandMathFinalCloud.ExecuteAndWriteOutput()
+            bandMathFinalCloud = None
+        else:
+            bandMathFinalCloud = band_math([self.cloud_refine,
+                                            generic_snow_path,
+                                            self.back_to_cloud],
+                                           self.final_mask_path,
+                                           condition_final,
+                                           self.ram,
+                                           otb.ImagePixelType_uint8)
+            bandMathFinalCloud.ExecuteAndWriteOutput()
+            bandMathFinalCloud = None
+
+            # Apply the no-data mask
+            bandMathNoData = band_math([self.final_mask_path,
+                                        self.nodata_mask],
                                        self.final_mask_path,
-                                       condition_final,
+                                       "im2b1==1?"+str(self.label_no_data)+":im1b1",
                                        self.ram,
                                        otb.ImagePixelType_uint8)
-        bandMathFinalCloud.ExecuteAndWriteOutput()
-        bandMathFinalCloud = None
-
-        # Apply the no-data mask
-        bandMathNoData = band_math([self.final_mask_path,
-                                    self.nodata_path],
-                                   self.final_mask_path,
-                                   "im2b1==1?"+str(self.label_no_data)+":im1b1",
-                                   self.ram,
-                                   otb.ImagePixelType_uint8)
-        bandMathNoData.ExecuteAndWriteOutput()
-        bandMathNoData = None
+            bandMathNoData.ExecuteAndWriteOutput()
+            bandMathNoData = None
 
         # Compute the complete snow mask
         app = compute_snow_mask(self.pass1_path,
-                                self.pass2_path,
+                                self.pass2_mask,
                                 self.cloud_pass1_path,
-                                self.cloud_refine_path,
+                                self.cloud_refine,
                                 self.all_cloud_path,
                                 self.snow_all_path,
                                 self.slope_mask_path,
                                 self.ram,
                                 otb.ImagePixelType_uint8)
         app.ExecuteAndWriteOutput()
+        app = None
+
+        # Release the in-memory pipeline
+        self.in_memory_apps = []
+
+    def empty_pass2(self):
+        # empty image pass2 is needed for computing snow_all
+        if self.engine == "numpy":
+            process_by_blocks([(self.pass1_path, 1)],
+                              [(self.pass2_path, gdal.GDT_Byte, GDAL_CO_MASK)],
+                              empty_kernel,
+                              self.ram,
+                              self.block_lines)
+        else:
+            # FIXME: A bit overkill to need to BandMath to create an image with
+            # 0
+            bandMathEmptyPass2 = band_math([self.pass1_path],
+                                           self.pass2_path + GDAL_OPT,
+                                           "0",
+                                           self.ram,
+                                           otb.ImagePixelType_uint8)
+            self.pass2_mask = self.get_output(bandMathEmptyPass2)
+            bandMathEmptyPass2 = None
 
     def pass3(self):
         # Fuse pass1 and pass2
         condition_pass3 = "(im1b1 == 1 or im2b1 == 1)"
+        if self.engine == "numpy":
+            process_by_blocks([(self.pass1_path, 1),
+                               (self.pass2_path, 1)],
+                              [(self.pass3_path, gdal.GDT_Byte, GDAL_CO_MASK)],
+                              pass3_kernel,
+                              self.ram,
+                              self.block_lines)
+            return
+
         bandMathPass3 = band_math([self.pass1_path,
-                                   self.pass2_path],
+                                   self.pass2_mask],
                                   self.pass3_path + GDAL_OPT,
                                   condition_pass3 + "?1:0",
                                   self.ram,
                                   otb.ImagePixelType_uint8)
-        bandMathPass3.ExecuteAndWriteOutput()
+        # pass3 is only required on disk to generate its polygons
+        self.pass3_mask = self.get_output(bandMathPass3,
+                                          self.generate_intermediate_vectors)
+        bandMathPass3 = None
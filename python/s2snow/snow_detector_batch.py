@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Run the snow detector on a list of configuration files
+
+The products are processed by a pool of worker processes which live for the
+whole batch, so that the python modules and the OTB applications registry
+are loaded once per worker instead of once per product. The ram and the
+threads of the node are shared between the workers, and an error on a
+product is reported in the summary without stopping the other products.
+"""
+import os.path as op
+import json
+import time
+import logging
+import traceback
+import multiprocessing
+
+from s2snow import snow_detector
+
+LOG_FORMAT = '%(asctime)s - %(filename)s:%(lineno)s - %(levelname)s - %(message)s'
+
+
+def read_config_list(list_file):
+    """ Return the configuration files listed in a text file (one per line,
+    empty lines and lines starting with # are ignored)
+    """
+    with open(list_file) as list_stream:
+        lines = [line.strip() for line in list_stream]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def get_worker_budget(nb_workers, ram=None, nb_threads=None):
+    """ Return the (ram, nb_threads) of each worker, sharing the ram (MB)
+    and the threads of the node (None to keep the configuration values)
+    """
+    worker_ram = None
+    if ram:
+        worker_ram = max(1, int(ram) // nb_workers)
+    worker_threads = None
+    if nb_threads:
+        worker_threads = max(1, int(nb_threads) // nb_workers)
+    return worker_ram, worker_threads
+
+
+def run_snow_detector(arguments):
+    """ Run the snow detector on a configuration file
+
+    Keyword arguments (as a tuple, to be used in a process pool):
+    config_file -- the json configuration file (see build_json.py)
+    ram -- the ram of the worker in MB (None to keep the configuration value)
+    nb_threads -- the threads of the worker (None to keep the configuration value)
+
+    Return the summary of the product as a dictionary (config, pout, status,
+    error, duration).
+    """
+    config_file, ram, nb_threads = arguments
+    start = time.time()
+    summary = {"config": config_file,
+               "pout": None,
+               "status": "failed",
+               "error": None}
+    log_handler = None
+    try:
+        with open(config_file) as json_data_file:
+            data = json.load(json_data_file)
+        general = data["general"]
+        summary["pout"] = general.get("pout")
+        if ram:
+            general["ram"] = ram
+        if nb_threads:
+            general["nb_threads"] = nb_threads
+
+        # the log of each product goes to its output directory, as with
+        # run_snow_detector.py
+        if general.get("log", True) and summary["pout"]:
+            log_handler = logging.FileHandler(op.join(summary["pout"], "stdout.log"), "w")
+            log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            logging.getLogger().addHandler(log_handler)
+
+        logging.info("Start snow detection of " + config_file)
+        snow_detector_app = snow_detector.snow_detector(data)
+        snow_detector_app.detect_snow(2)
+        summary["status"] = "done"
+        logging.info("End snow detection of " + config_file)
+    except Exception as e:
+        logging.error("Snow detection failed for " + config_file + ":\n" + traceback.format_exc())
+        summary["error"] = str(e) or e.__class__.__name__
+    finally:
+        if log_handler is not None:
+            logging.getLogger().removeHandler(log_handler)
+            log_handler.close()
+    summary["duration"] = time.time() - start
+    return summary
+
+
+def run_batch(config_files, nb_workers=1, ram=None, nb_threads=None, summary_file=None):
+    """ Run the snow detector on a list of configuration files
+
+    Keyword arguments:
+    config_files -- the json configuration files
+    nb_workers -- the number of products processed concurrently
+    ram -- the ram of the node in MB, shared between the workers
+           (None to keep the configuration values)
+    nb_threads -- the threads of the node, shared between the workers
+                  (None to keep the configuration values)
+    summary_file -- the json summary of the batch (not mandatory)
+
+    Return the summaries of the products (see run_snow_detector), in the
+    order of config_files.
+    """
+    start = time.time()
+    worker_ram, worker_threads = get_worker_budget(nb_workers, ram, nb_threads)
+    logging.info("Processing " + str(len(config_files)) + " products with " +
+                 str(nb_workers) + " workers (ram: " + str(worker_ram) +
+                 ", threads: " + str(worker_threads) + " per worker)")
+    tasks = [(config_file, worker_ram, worker_threads) for config_file in config_files]
+
+    summaries = []
+    if nb_workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(nb_workers, len(tasks)))
+        for summary in pool.imap_unordered(run_snow_detector, tasks):
+            summaries.append(summary)
+            logging.info(str(len(summaries)) + "/" + str(len(tasks)) + " " +
+                         summary["config"] + ": " + summary["status"])
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            summaries.append(run_snow_detector(task))
+            logging.info(str(len(summaries)) + "/" + str(len(tasks)) + " " +
+                         summaries[-1]["config"] + ": " + summaries[-1]["status"])
+    order = dict((config_file, index) for index, config_file in enumerate(config_files))
+    summaries.sort(key=lambda summary: order[summary["config"]])
+
+    nb_failed = len([summary for summary in summaries if summary["status"] != "done"])
+    duration = time.time() - start
+    logging.info(str(len(summaries) - nb_failed) + " products done, " +
+                 str(nb_failed) + " failed in " + "%.1f s" % duration)
+    for summary in summaries:
+        if summary["status"] != "done":
+            logging.error("Failed: " + summary["config"] + " (" + str(summary["error"]) + ")")
+
+    if summary_file is not None:
+        with open(summary_file, "w") as summary_stream:
+            json.dump({"nb_products": len(summaries),
+                       "nb_failed": nb_failed,
+                       "nb_workers": nb_workers,
+                       "worker_ram": worker_ram,
+                       "worker_threads": worker_threads,
+                       "duration": duration,
+                       "products": summaries}, summary_stream, indent=4)
+        logging.info("Batch summary written in " + summary_file)
+    return summaries
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Long running snow detection service fed by a directory queue
+
+The jobs are the json configuration files (see build_json.py) dropped in
+the incoming directory of the queue. A job is claimed by moving it to the
+running directory of the service, named after its owner (host and pid), so
+that several services, on one or several nodes, can share a queue. It is
+moved to the done or failed directory with a summary file once processed.
+The jobs of a service which is gone (dead process on the same host, or no
+heartbeat for OWNER_TIMEOUT seconds on another host) are requeued by the
+other services. The products are processed by a pool of worker processes
+which live as long as the service, the OTB and GDAL initialisation being
+paid once per worker.
+Layout:
+    <queue>/incoming/<job>.json
+    <queue>/running/<host>_<pid>/<job>.json, its modification time being
+        the heartbeat of the service
+    <queue>/done/<job>.json, <queue>/done/<job>_summary.json
+    <queue>/failed/<job>.json, <queue>/failed/<job>_summary.json
+    <queue>/stats/<host>_<pid>.json, the steady-state throughput of a service
+    <queue>/stop, created to stop all the services once their running jobs
+        are done (to be removed before starting the services again)
+    <queue>/stop_<host>_<pid>, created to stop one service
+"""
+import os
+import os.path as op
+import json
+import time
+import errno
+import socket
+import logging
+import multiprocessing
+
+from s2snow.snow_detector_batch import run_snow_detector, get_worker_budget
+
+QUEUE_DIRS = ["incoming", "running", "done", "failed", "stats"]
+STOP_FILE = "stop"
+# delay without heartbeat after which a service of another host is gone (s)
+OWNER_TIMEOUT = 600
+
+
+def get_owner():
+    """ Return the owner name of the jobs claimed by this process
+    """
+    return socket.gethostname() + "_" + str(os.getpid())
+
+
+class snow_detector_service(object):
+    """ Snow detection service processing the jobs of a directory queue
+    """
+    def __init__(self, queue_dir, nb_workers=1, ram=None, nb_threads=None, poll_interval=5):
+        """
+        Keyword arguments:
+        queue_dir -- the queue directory
+        nb_workers -- the number of jobs processed concurrently
+        ram -- the ram of the node in MB, shared between the workers
+               (None to keep the configuration values)
+        nb_threads -- the threads of the node, shared between the workers
+                      (None to keep the configuration values)
+        poll_interval -- the delay between two checks of the queue in seconds
+        """
+        self.queue_dir = queue_dir
+        self.nb_workers = nb_workers
+        self.worker_ram, self.worker_threads = get_worker_budget(nb_workers, ram, nb_threads)
+        self.poll_interval = poll_interval
+        self.owner_timeout = max(OWNER_TIMEOUT, 10 * poll_interval)
+        for queue_subdir in QUEUE_DIRS:
+            if not op.exists(op.join(queue_dir, queue_subdir)):
+                os.makedirs(op.join(queue_dir, queue_subdir))
+        self.owner = get_owner()
+        self.running_dir = self.get_path("running", self.owner)
+
+        self.pending = {}
+        self.start_time = None
+        self.nb_done = 0
+        self.nb_failed = 0
+        self.processing_time = 0.
+
+    def get_path(self, queue_subdir, name):
+        return op.join(self.queue_dir, queue_subdir, name)
+
+    def list_incoming(self):
+        """ Return the incoming jobs, oldest first
+        """
+        incoming = self.get_path("incoming", "")
+        names = [name for name in os.listdir(incoming) if name.endswith(".json")]
+        return sorted(names, key=lambda name: (os.stat(op.join(incoming, name)).st_mtime, name))
+
+    def is_alive(self, owner):
+        """ Return True if the service owning a running directory is alive
+        """
+        host, pid = owner.rsplit("_", 1)
+        if host == socket.gethostname() and pid.isdigit():
+            try:
+                os.kill(int(pid), 0)
+            except OSError as e:
+                return e.errno == errno.EPERM
+            return True
+        # the heartbeat of the services of the other hosts
+        heartbeat = os.stat(self.get_path("running", owner)).st_mtime
+        return time.time() - heartbeat < self.owner_timeout
+
+    def recover(self):
+        """ Put back in the queue the jobs left running by the services
+        which are gone
+        """
+        running = self.get_path("running", "")
+        for owner in os.listdir(running):
+            if owner == self.owner:
+                continue
+            if not op.isdir(op.join(running, owner)):
+                # a job without owner
+                logging.warning("Requeuing the interrupted job " + owner)
+                try:
+                    os.rename(op.join(running, owner), self.get_path("incoming", owner))
+                except OSError:
+                    pass
+                continue
+            try:
+                if self.is_alive(owner):
+                    continue
+                names = os.listdir(op.join(running, owner))
+            except OSError:
+                # recovered by another service
+                continue
+            for name in names:
+                logging.warning("Requeuing the job " + name + " of the interrupted service " + owner)
+                try:
+                    os.rename(op.join(running, owner, name), self.get_path("incoming", name))
+                except OSError:
+                    continue
+            try:
+                os.rmdir(op.join(running, owner))
+            except OSError:
+                pass
+
+    def claim_jobs(self, nb_jobs):
+        """ Move at most nb_jobs incoming jobs to the running directory,
+        and return their names
+        """
+        claimed = []
+        for name in self.list_incoming():
+            if len(claimed) >= nb_jobs:
+                break
+            try:
+                os.rename(self.get_path("incoming", name), op.join(self.running_dir, name))
+            except OSError:
+                # claimed by another service
+                continue
+            claimed.append(name)
+        return claimed
+
+    def finish_job(self, name, summary):
+        """ Move a processed job to the done or failed directory with its
+        summary, and update the statistics
+        """
+        queue_subdir = "done" if summary["status"] == "done" else "failed"
+        os.rename(op.join(self.running_dir, name), self.get_path(queue_subdir, name))
+        summary["config"] = self.get_path(queue_subdir, name)
+        with open(self.get_path(queue_subdir, op.splitext(name)[0] + "_summary.json"), "w") as summary_stream:
+            json.dump(summary, summary_stream, indent=4)
+
+        if summary["status"] == "done":
+            self.nb_done += 1
+        else:
+            self.nb_failed += 1
+            logging.error("Job " + name + " failed: " + str(summary["error"]))
+        self.processing_time += summary["duration"]
+        stats = self.write_stats()
+        logging.info("Job " + name + " " + summary["status"] + " in " +
+                     "%.1f s" % summary["duration"] + " (" +
+                     "%.1f products/hour" % stats["products_per_hour"] + ")")
+
+    def write_stats(self):
+        """ Write and return the statistics of the service
+        """
+        uptime = max(time.time() - self.start_time, 1e-6)
+        nb_jobs = self.nb_done + self.nb_failed
+        stats = {"nb_workers": self.nb_workers,
+                 "nb_done": self.nb_done,
+                 "nb_failed": self.nb_failed,
+                 "nb_running": len(self.pending),
+                 "uptime": uptime,
+                 "products_per_hour": 3600. * nb_jobs / uptime,
+                 "mean_duration": self.processing_time / nb_jobs if nb_jobs else None}
+        stats_file = self.get_path("stats", self.owner + ".json")
+        with open(stats_file + ".tmp", "w") as stats_stream:
+            json.dump(stats, stats_stream, indent=4)
+        os.rename(stats_file + ".tmp", stats_file)
+        return stats
+
+    def run(self, once=False):
+        """ Process the jobs of the queue until a stop file is created
+
+        Keyword arguments:
+        once -- stop when the queue is empty
+        """
+        logging.info("Start the snow detection service " + self.owner + " on " +
+                     self.queue_dir + " with " + str(self.nb_workers) + " workers")
+        self.start_time = time.time()
+        if not op.exists(self.running_dir):
+            os.mkdir(self.running_dir)
+        stop_file = op.join(self.queue_dir, STOP_FILE)
+        service_stop_file = op.join(self.queue_dir, STOP_FILE + "_" + self.owner)
+        if op.exists(stop_file):
+            logging.warning("The stop file " + stop_file + " exists, the service "
+                            "stops once the running jobs are done")
+        pool = multiprocessing.Pool(self.nb_workers)
+        try:
+            while True:
+                # heartbeat of the service
+                os.utime(self.running_dir, None)
+                self.recover()
+                for name, result in list(self.pending.items()):
+                    if result.ready():
+                        del self.pending[name]
+                        self.finish_job(name, result.get())
+
+                stopping = op.exists(stop_file) or op.exists(service_stop_file)
+                if not stopping:
+                    for name in self.claim_jobs(self.nb_workers - len(self.pending)):
+                        logging.info("Start job " + name)
+                        self.pending[name] = pool.apply_async(
+                            run_snow_detector,
+                            ((op.join(self.running_dir, name), self.worker_ram, self.worker_threads),))
+
+                if not self.pending and (stopping or (once and not self.list_incoming())):
+                    break
+                time.sleep(self.poll_interval if not self.pending else min(self.poll_interval, 1))
+        except BaseException:
+            # the running jobs are requeued by the other services
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        os.rmdir(self.running_dir)
+        # the shared stop file is left for the other services
+        if op.exists(service_stop_file):
+            os.remove(service_stop_file)
+        stats = self.write_stats()
+        logging.info("Stop the snow detection service: " + str(stats["nb_done"]) +
+                     " jobs done, " + str(stats["nb_failed"]) + " failed")
+        return stats
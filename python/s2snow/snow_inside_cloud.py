@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Simon Gascoin
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Removal of the snow areas surrounded by clouds (pass 1.5)
+
+Each snow area (4-connected component of the snow mask) larger than
+min_area_size is dilated, and it is discarded when the fraction of cloud
+pixels among the non-snow pixels of the dilated area is above the cloud
+threshold. The snow areas are processed in label order: the pixels of the
+areas already discarded are counted in the surrounding of the next ones.
+
+remove_snow_inside_cloud processes the masks in memory, while
+remove_snow_inside_cloud_by_tiles streams the mask images by tiles
+to run in bounded memory at full resolution.
+"""
+import os
+import os.path as op
+import logging
+import multiprocessing
+
+import numpy as np
+import scipy.ndimage as nd
+
+import gdal
+from gdalconst import GA_ReadOnly, GA_Update
+
+# this allows GDAL to throw Python Exceptions
+gdal.UseExceptions()
+
+
+def build_disk(radius):
+    """ Build the structuring element used for the dilation
+    """
+    struct = np.zeros((2*radius+1, 2*radius+1))
+    y, x = np.ogrid[-radius:radius+1, -radius:radius+1]
+    mask = x**2 + y**2 <= radius**2
+    struct[mask] = 1
+    return struct
+
+
+def expand_slice(object_slice, radius, shape):
+    """ Expand the bounding box of an object by the dilation radius
+    """
+    return tuple(slice(max(0, s.start - radius), min(size, s.stop + radius))
+                 for s, size in zip(object_slice, shape))
+
+
+def contour_statistics(snow_mask, cloud_mask, snowlabels, candidates,
+                       struct, core=None):
+    """ Compute the surrounding cloud statistics of the candidate labels
+
+    Each candidate area is dilated inside its bounding box only, then the
+    cloud values of the non-snow pixels of all the dilated areas are
+    gathered and counted in one bincount pass.
+
+    Keyword arguments:
+    snow_mask -- the snow mask array
+    cloud_mask -- the cloud mask array
+    snowlabels -- the labels of the snow areas (same shape)
+    candidates -- the labels of the areas to process
+    struct -- the structuring element for dilation
+    core -- boolean array restricting the counted pixels (not mandatory)
+
+    Return a tuple (clear_counts, cloud_counts, neighbours) where the
+    counts are dictionaries indexed by label, and neighbours gives for
+    each label the (labels, clear_counts, cloud_counts) of the pixels of
+    the other snow areas inside its dilated area.
+    """
+    radius = struct.shape[0] // 2
+    candidates = np.asarray(candidates)
+    if candidates.size == 0:
+        return {}, {}, {}
+
+    # Bounding box of each candidate
+    compact = np.zeros(int(snowlabels.max()) + 1, dtype=np.int64)
+    compact[candidates] = np.arange(1, candidates.size + 1)
+    objects = nd.find_objects(compact[snowlabels])
+
+    contour_labels = []
+    contour_clouds = []
+    neighbours = {}
+    for index, lab in enumerate(candidates):
+        if objects[index] is None:
+            continue
+        window = expand_slice(objects[index], radius, snowlabels.shape)
+        window_labels = snowlabels[window]
+        window_cloud = cloud_mask[window]
+
+        dilated = nd.binary_dilation(window_labels == lab, struct)
+        if core is not None:
+            dilated &= core[window]
+        contour = dilated & (snow_mask[window] == 0)
+        contour_clouds.append(window_cloud[contour])
+        contour_labels.append(np.repeat(index, contour_clouds[-1].size))
+
+        # Pixels of the other snow areas within the dilated area
+        other = dilated & (window_labels > 0) & (window_labels != lab)
+        if other.any():
+            other_labels, inverse = np.unique(window_labels[other],
+                                              return_inverse=True)
+            other_clouds = window_cloud[other]
+            neighbours[lab] = (
+                other_labels,
+                np.bincount(inverse, weights=(other_clouds == 0),
+                            minlength=other_labels.size),
+                np.bincount(inverse, weights=(other_clouds == 1),
+                            minlength=other_labels.size))
+
+    contour_labels = np.concatenate(contour_labels)
+    contour_clouds = np.concatenate(contour_clouds)
+    clear = np.bincount(contour_labels, weights=(contour_clouds == 0),
+                        minlength=candidates.size)
+    cloudy = np.bincount(contour_labels, weights=(contour_clouds == 1),
+                         minlength=candidates.size)
+
+    clear_counts = dict(zip(candidates.tolist(), clear.tolist()))
+    cloud_counts = dict(zip(candidates.tolist(), cloudy.tolist()))
+    return clear_counts, cloud_counts, neighbours
+
+
+def select_discarded(candidates, clear_counts, cloud_counts, neighbours,
+                     cloud_threshold):
+    """ Select in label order the candidate areas to discard
+
+    The pixels of the neighbour areas already discarded are counted
+    in the surrounding of the current area, as they are no longer snow.
+
+    Return the set of the discarded labels.
+    """
+    discarded = set()
+    for lab in sorted(candidates):
+        clear = clear_counts.get(lab, 0)
+        cloudy = cloud_counts.get(lab, 0)
+        if lab in neighbours:
+            other_labels, other_clear, other_cloudy = neighbours[lab]
+            for other, n_clear, n_cloudy in zip(other_labels, other_clear,
+                                                other_cloudy):
+                if other in discarded:
+                    clear += n_clear
+                    cloudy += n_cloudy
+
+        cloud_percent = 0
+        if clear + cloudy > 0:
+            cloud_percent = float(cloudy) / (clear + cloudy)
+        logging.debug("Area " + str(lab) + ", " + str(cloud_percent*100) +
+                      "% of surrounding cloud")
+
+        # Discard snow area where cloud_percent > threshold
+        if cloud_percent > cloud_threshold:
+            discarded.add(lab)
+    return discarded
+
+
+def remove_snow_inside_cloud(snow_mask, cloud_mask, radius=1,
+                             cloud_threshold=0.85, min_area_size=25000):
+    """ Discard the snow areas surrounded by clouds
+
+    The discarded snow areas are removed from the snow mask
+    and added to the cloud mask.
+
+    Keyword arguments:
+    snow_mask -- the snow mask array
+    cloud_mask -- the cloud mask array
+    radius -- the dilation radius in pixels
+    cloud_threshold -- the minimum fraction of surrounding cloud
+    min_area_size -- the minimum size of the processed snow areas
+
+    Return the updated (snow_mask, cloud_mask) arrays.
+    """
+    (snowlabels, nb_label) = nd.measurements.label(snow_mask)
+    logging.info("There is " + str(nb_label) + " snow areas")
+
+    # compute individual snow area size
+    areas = np.bincount(snowlabels.ravel(), minlength=nb_label+1)
+    candidates = np.flatnonzero(areas > min_area_size)
+    candidates = candidates[candidates > 0]
+    logging.info(str(candidates.size) + " snow areas larger than " +
+                 str(min_area_size) + " pixels")
+
+    clear_counts, cloud_counts, neighbours = contour_statistics(
+        snow_mask, cloud_mask, snowlabels, candidates, build_disk(radius))
+    discarded = select_discarded(candidates, clear_counts, cloud_counts,
+                                 neighbours, cloud_threshold)
+
+    logging.info(str(len(discarded)) + ' labels entoures de nuages (sur ' \
+                 + str(nb_label) + ' labels)')
+    logging.info(str(nb_label - len(discarded)) + ' labels neige apres correction')
+
+    discarded_lut = np.zeros(nb_label + 1, dtype=bool)
+    discarded_lut[list(discarded)] = True
+    discarded_pixels = discarded_lut[snowlabels]
+
+    snow_mask = np.where(discarded_pixels, 0, snow_mask).astype(snow_mask.dtype)
+    cloud_mask = np.where(discarded_pixels, 1, cloud_mask).astype(cloud_mask.dtype)
+    return snow_mask, cloud_mask
+
+
+def merge_statistics(statistics):
+    """ Sum the contour statistics computed on several tiles
+    """
+    clear_counts = {}
+    cloud_counts = {}
+    neighbour_counts = {}
+    for tile_clear, tile_cloudy, tile_neighbours in statistics:
+        for lab, count in tile_clear.items():
+            clear_counts[lab] = clear_counts.get(lab, 0) + count
+        for lab, count in tile_cloudy.items():
+            cloud_counts[lab] = cloud_counts.get(lab, 0) + count
+        for lab, (other_labels, other_clear, other_cloudy) in tile_neighbours.items():
+            counts = neighbour_counts.setdefault(lab, {})
+            for other, n_clear, n_cloudy in zip(other_labels, other_clear,
+                                                other_cloudy):
+                previous = counts.get(other, (0, 0))
+                counts[other] = (previous[0] + n_clear, previous[1] + n_cloudy)
+
+    neighbours = {}
+    for lab, counts in neighbour_counts.items():
+        others = sorted(counts)
+        neighbours[lab] = (others,
+                           [counts[other][0] for other in others],
+                           [counts[other][1] for other in others])
+    return clear_counts, cloud_counts, neighbours
+
+
+def iter_tiles(xsize, ysize, tile_size):
+    """ Yield the tiles (xoff, yoff, width, height) covering the image
+    """
+    for yoff in range(0, ysize, tile_size):
+        for xoff in range(0, xsize, tile_size):
+            yield (xoff, yoff,
+                   min(tile_size, xsize - xoff),
+                   min(tile_size, ysize - yoff))
+
+
+def read_window(path, xoff, yoff, width, height):
+    """ Read a window of the first band of an image
+    """
+    dataset = gdal.Open(path, GA_ReadOnly)
+    array = dataset.GetRasterBand(1).ReadAsArray(xoff, yoff, width, height)
+    dataset = None
+    return array
+
+
+def write_window(path, array, xoff, yoff):
+    """ Write a window into the first band of an image
+    """
+    dataset = gdal.Open(path, GA_Update)
+    dataset.GetRasterBand(1).WriteArray(array, xoff, yoff)
+    dataset = None
+
+
+def expand_tile(tile, halo, xsize, ysize):
+    """ Return the tile window extended by the halo and the slices
+    of the tile core within this window
+    """
+    xoff, yoff, width, height = tile
+    x0 = max(0, xoff - halo)
+    y0 = max(0, yoff - halo)
+    x1 = min(xsize, xoff + width + halo)
+    y1 = min(ysize, yoff + height + halo)
+    core = (slice(yoff - y0, yoff - y0 + height),
+            slice(xoff - x0, xoff - x0 + width))
+    return (x0, y0, x1 - x0, y1 - y0), core
+
+
+class TiledLabels(object):
+    """ Snow area labels of a tiled image
+
+    Each tile is labelled independently and its local labels are stored
+    in a memory mapped file. The local labels of the tile number i are
+    converted into compact labels by adding offsets[i], then the compact
+    labels are converted into global labels (the labels of the whole
+    image, numbered in raster order) by a lookup table.
+    """
+    def __init__(self, path, xsize, ysize, tile_size):
+        self.path = path
+        self.xsize = xsize
+        self.ysize = ysize
+        self.tile_size = tile_size
+        self.tiles_per_row = (xsize + tile_size - 1) // tile_size
+        self.offsets = None
+        self.lut = None
+
+    def memmap(self, mode="r"):
+        return np.memmap(self.path, dtype=np.int32, mode=mode,
+                         shape=(self.ysize, self.xsize))
+
+    def tile_index(self, xoff, yoff):
+        return (yoff // self.tile_size) * self.tiles_per_row + \
+            xoff // self.tile_size
+
+    def compact(self, xoff, yoff, width, height):
+        """ Return the compact labels of a window (possibly across tiles)
+        """
+        local = np.array(self.memmap()[yoff:yoff+height, xoff:xoff+width],
+                         dtype=np.int64)
+        rows = (np.arange(yoff, yoff + height) // self.tile_size)
+        cols = (np.arange(xoff, xoff + width) // self.tile_size)
+        tiles = rows[:, np.newaxis] * self.tiles_per_row + cols[np.newaxis, :]
+        return np.where(local > 0, local + self.offsets[tiles], 0)
+
+    def labels(self, xoff, yoff, width, height):
+        """ Return the global labels of a window
+        """
+        return self.lut[self.compact(xoff, yoff, width, height)]
+
+
+def label_tile(arguments):
+    """ Label the snow areas of a tile and store the local labels
+
+    Return the number of labels, the area and the first pixel
+    (flat index in the whole image) of each local label.
+    """
+    snow_mask_path, tiled, tile = arguments
+    xoff, yoff, width, height = tile
+    snow_mask = read_window(snow_mask_path, xoff, yoff, width, height)
+    (local, nb_label) = nd.measurements.label(snow_mask)
+
+    labels = tiled.memmap("r+")
+    labels[yoff:yoff+height, xoff:xoff+width] = local
+    labels.flush()
+    labels = None
+
+    areas = np.bincount(local.ravel(), minlength=nb_label+1)[1:]
+    (_, first) = np.unique(local.ravel(), return_index=True)
+    first = first[1:] if local.min() == 0 else first
+    first = (yoff + first // width).astype(np.int64) * tiled.xsize + \
+        xoff + first % width
+    return nb_label, areas, first
+
+
+def border_pairs(tiled):
+    """ Return the pairs of compact labels in contact across tile borders
+    """
+    pairs = []
+    for x in range(tiled.tile_size, tiled.xsize, tiled.tile_size):
+        columns = tiled.compact(x - 1, 0, 2, tiled.ysize)
+        pairs.append(columns[(columns[:, 0] > 0) & (columns[:, 1] > 0)])
+    for y in range(tiled.tile_size, tiled.ysize, tiled.tile_size):
+        rows = tiled.compact(0, y - 1, tiled.xsize, 2).T
+        pairs.append(rows[(rows[:, 0] > 0) & (rows[:, 1] > 0)])
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.concatenate(pairs)
+
+
+def resolve_roots(nb_label, pairs):
+    """ Union-find of the compact labels connected by pairs
+
+    Each root is hooked onto the smallest root it is connected to,
+    then the paths are compressed by pointer jumping, until all the
+    pairs share the same root.
+
+    Return the root of each compact label.
+    """
+    parent = np.arange(nb_label + 1)
+    while pairs.size:
+        roots_a = parent[pairs[:, 0]]
+        roots_b = parent[pairs[:, 1]]
+        if (roots_a == roots_b).all():
+            break
+        np.minimum.at(parent, np.maximum(roots_a, roots_b),
+                      np.minimum(roots_a, roots_b))
+        while True:
+            grand_parent = parent[parent]
+            if (grand_parent == parent).all():
+                break
+            parent = grand_parent
+    return parent
+
+
+def init_tile_worker(arguments):
+    """ Share the tiled labels and the candidates with the workers
+    """
+    global tile_context
+    tile_context = arguments
+
+
+def tile_statistics(tile):
+    """ Compute the contour statistics of the candidates on a tile,
+    the tile being read with a halo of the dilation radius
+    """
+    snow_mask_path, cloud_mask_path, tiled, candidates, radius = tile_context
+    window, core_slices = expand_tile(tile, radius, tiled.xsize, tiled.ysize)
+    snowlabels = tiled.labels(*window)
+    present = np.intersect1d(np.unique(snowlabels), candidates)
+    if present.size == 0:
+        return {}, {}, {}
+
+    core = np.zeros(snowlabels.shape, dtype=bool)
+    core[core_slices] = True
+    return contour_statistics(read_window(snow_mask_path, *window),
+                              read_window(cloud_mask_path, *window),
+                              snowlabels, present, build_disk(radius), core)
+
+
+def remove_snow_inside_cloud_by_tiles(snow_mask_path, cloud_mask_path,
+                                      path_tmp, radius=1,
+                                      cloud_threshold=0.85,
+                                      min_area_size=25000, tile_size=2048,
+                                      nb_workers=1):
+    """ Discard the snow areas surrounded by clouds, by tiles
+
+    The snow areas are labelled tile by tile and merged across the tile
+    borders, so that the results are the same than those of
+    remove_snow_inside_cloud. The snow and cloud mask images are
+    updated in place.
+
+    Keyword arguments:
+    snow_mask_path -- the snow mask image
+    cloud_mask_path -- the cloud mask image
+    path_tmp -- the directory of the temporary label file
+    radius -- the dilation radius in pixels
+    cloud_threshold -- the minimum fraction of surrounding cloud
+    min_area_size -- the minimum size of the processed snow areas
+    tile_size -- the size in pixels of the processed tiles
+    nb_workers -- the number of processes computing the tiles statistics
+                  (1 in a worker of a process pool, which cannot start
+                  processes)
+    """
+    if nb_workers > 1 and multiprocessing.current_process().daemon:
+        logging.info("Running in a daemon process (e.g. a worker of "
+                     "run_snow_detector_batch.py), processing the tiles "
+                     "in a single process")
+        nb_workers = 1
+
+    dataset = gdal.Open(snow_mask_path, GA_ReadOnly)
+    xsize = dataset.RasterXSize
+    ysize = dataset.RasterYSize
+    dataset = None
+
+    tile_size = max(int(tile_size), 2 * radius + 1)
+    tiled = TiledLabels(op.join(path_tmp, "snow_labels.dat"), xsize, ysize,
+                        tile_size)
+    tiled.memmap("w+").flush()
+    tiles = list(iter_tiles(xsize, ysize, tile_size))
+    logging.info("Processing " + str(len(tiles)) + " tiles of " +
+                 str(tile_size) + " pixels")
+
+    pool = None
+    if nb_workers > 1:
+        pool = multiprocessing.Pool(nb_workers)
+        labelled = pool.map(label_tile, [(snow_mask_path, tiled, tile)
+                                         for tile in tiles])
+        pool.close()
+        pool.join()
+    else:
+        labelled = [label_tile((snow_mask_path, tiled, tile)) for tile in tiles]
+
+    # Merge the local labels across the tile borders
+    counts = np.array([nb_label for nb_label, _, _ in labelled], dtype=np.int64)
+    tiled.offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    nb_compact = int(counts.sum())
+    compact_areas = np.concatenate([[0]] + [areas for _, areas, _ in labelled])
+    compact_first = np.concatenate([[-1]] + [first for _, _, first in labelled])
+
+    roots = resolve_roots(nb_compact, border_pairs(tiled))
+    areas = np.bincount(roots, weights=compact_areas, minlength=nb_compact+1)
+    first = np.full(nb_compact + 1, xsize * ysize, dtype=np.int64)
+    np.minimum.at(first, roots, compact_first)
+
+    # Number the snow areas in raster order, as the labelling of the
+    # whole image does
+    root_labels = np.unique(roots[1:])
+    order = root_labels[np.argsort(first[root_labels])]
+    nb_label = order.size
+    rank = np.zeros(nb_compact + 1, dtype=np.int64)
+    rank[order] = np.arange(1, nb_label + 1)
+    tiled.lut = rank[roots]
+    logging.info("There is " + str(nb_label) + " snow areas")
+
+    label_areas = np.zeros(nb_label + 1, dtype=np.int64)
+    label_areas[rank[order]] = areas[order]
+    candidates = np.flatnonzero(label_areas > min_area_size)
+    candidates = candidates[candidates > 0]
+    logging.info(str(candidates.size) + " snow areas larger than " +
+                 str(min_area_size) + " pixels")
+
+    context = (snow_mask_path, cloud_mask_path, tiled, candidates, radius)
+    if nb_workers > 1:
+        pool = multiprocessing.Pool(nb_workers, init_tile_worker, (context,))
+        statistics = pool.map(tile_statistics, tiles)
+        pool.close()
+        pool.join()
+    else:
+        init_tile_worker(context)
+        statistics = [tile_statistics(tile) for tile in tiles]
+
+    clear_counts, cloud_counts, neighbours = merge_statistics(statistics)
+    discarded = select_discarded(candidates, clear_counts, cloud_counts,
+                                 neighbours, cloud_threshold)
+
+    logging.info(str(len(discarded)) + ' labels entoures de nuages (sur ' \
+                 + str(nb_label) + ' labels)')
+    logging.info(str(nb_label - len(discarded)) + ' labels neige apres correction')
+
+    # Update the snow and cloud masks with the discarded snow areas
+    if discarded:
+        discarded_lut = np.zeros(nb_label + 1, dtype=bool)
+        discarded_lut[list(discarded)] = True
+        for tile in tiles:
+            discarded_pixels = discarded_lut[tiled.labels(*tile)]
+            if not discarded_pixels.any():
+                continue
+            snow_mask = read_window(snow_mask_path, *tile)
+            cloud_mask = read_window(cloud_mask_path, *tile)
+            snow_mask[discarded_pixels] = 0
+            cloud_mask[discarded_pixels] = 1
+            write_window(snow_mask_path, snow_mask, tile[0], tile[1])
+            write_window(cloud_mask_path, cloud_mask, tile[0], tile[1])
+
+    os.remove(tiled.path)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Simon Gascoin
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""NumPy kernels implementing the BandMath expressions of the snow detector
+
+The kernels reproduce the BandMath evaluation: input pixels are read as
+float (FloatVectorImageType) and the expression is evaluated in double
+precision, the thresholds being parsed from their string representation.
+"""
+import numpy as np
+
+
+def as_band_math(array):
+    """ Convert a block to the BandMath evaluation type
+    (float input pixels evaluated in double precision)
+    """
+    return np.asarray(array).astype(np.float32).astype(np.float64)
+
+
+def as_threshold(value):
+    """ Return the threshold value as parsed by BandMath
+    from its string representation in the expression
+    """
+    return float(str(value))
+
+
+def as_mask(condition):
+    """ Convert a boolean condition into a uint8 mask (cond?1:0)
+    """
+    return condition.astype(np.uint8)
+
+
+def ndsi(green, swir):
+    """ Compute the NDSI (green-swir)/(green+swir)
+    """
+    green = as_band_math(green)
+    swir = as_band_math(swir)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (green - swir) / (green + swir)
+
+
+def bitmask(mask, mask_value):
+    """ Equivalent of the ComputeCloudMask application:
+    1 where all the bits of mask_value are set in the mask
+    """
+    mask_value = int(mask_value)
+    return as_mask(np.bitwise_and(np.asarray(mask).astype(np.int64),
+                                  mask_value) == mask_value)
+
+
+def nodata_kernel(band, nodata):
+    """ im1b1==nodata?1:0
+    """
+    return as_mask(as_band_math(band) == as_threshold(nodata))
+
+
+def cloud_masks_kernel(cloud_init, red, mode, all_cloud_mask,
+                       shadow_in_mask, shadow_out_mask, high_cloud_mask,
+                       red_backtocloud):
+    """ Extract in a single read of the input cloud mask the all cloud,
+    shadow, high cloud and back to cloud masks (see pass0)
+    """
+    cloud = as_band_math(cloud_init)
+    if mode == 'sen2cor':
+        all_clouds = (cloud == 3) | (cloud == 8) | (cloud == 9) | (cloud == 10)
+        shadows = as_mask(cloud == 3)
+        high_clouds = as_mask(cloud == 10)
+    else:
+        all_clouds = cloud > 0
+        shadows = as_mask((bitmask(cloud_init, shadow_in_mask) == 1) |
+                          (bitmask(cloud_init, shadow_out_mask) == 1))
+        high_clouds = bitmask(cloud_init, high_cloud_mask)
+
+    if mode == 'lasrc':
+        all_cloud = bitmask(cloud_init, all_cloud_mask)
+    else:
+        all_cloud = as_mask(all_clouds)
+
+    back_to_cloud = as_mask(all_clouds &
+                            (as_band_math(red) > as_threshold(red_backtocloud)))
+    return all_cloud, shadows, high_clouds, back_to_cloud
+
+
+def pass1_kernel(swir, red, green, all_cloud, ndsi_pass1, red_pass1):
+    """ (im2b1!=1 and ndsi>ndsi_pass1 and red>red_pass1)?1:0
+    """
+    condition = (as_band_math(all_cloud) != 1) & \
+                (ndsi(green, swir) > as_threshold(ndsi_pass1)) & \
+                (as_band_math(red) > as_threshold(red_pass1))
+    return as_mask(condition)
+
+
+def cloud_refine_kernel(all_cloud, shadows, red_coarse, high_clouds,
+                        cloud_pass1, red_darkcloud):
+    """ (im1b1==1 and im3b1>red_darkcloud) or im2b1==1 or im4b1==1
+    or (im1b1!=im5b1)
+    """
+    all_cloud = as_band_math(all_cloud)
+    condition = ((all_cloud == 1) &
+                 (as_band_math(red_coarse) > as_threshold(red_darkcloud))) | \
+                (as_band_math(shadows) == 1) | \
+                (as_band_math(high_clouds) == 1) | \
+                (all_cloud != as_band_math(cloud_pass1))
+    return as_mask(condition)
+
+
+def block_mean(array, factor, nodata=None):
+    """ Return the mean of the array over cells of factor x factor pixels,
+    each pixel receiving the mean of its cell rounded to the nearest integer
+
+    The nodata pixels are excluded from the mean, a cell without valid pixel
+    is nodata. The cells are aligned on the first line and column of the
+    array, the last cells being partial. The result is not bit-identical to
+    the red_coarse.tif/red_nn.tif path of pass0, whose bilinear grid of
+    xSize/rf columns does not match exact factor x factor cells.
+    """
+    array = as_band_math(array)
+    height, width = array.shape
+    cells_height = -(-height // factor)
+    cells_width = -(-width // factor)
+    valid = np.ones(array.shape, dtype=bool)
+    if nodata is not None:
+        valid = array != as_threshold(nodata)
+
+    sums = np.zeros((cells_height * factor, cells_width * factor))
+    sums[:height, :width] = np.where(valid, array, 0)
+    counts = np.zeros(sums.shape)
+    counts[:height, :width] = valid
+    sums = sums.reshape(cells_height, factor, cells_width, factor).sum(axis=(1, 3))
+    counts = counts.reshape(cells_height, factor, cells_width, factor).sum(axis=(1, 3))
+
+    means = np.floor(sums / np.maximum(counts, 1) + 0.5)
+    if nodata is not None:
+        means[counts == 0] = as_threshold(nodata)
+    means = np.repeat(np.repeat(means, factor, axis=0), factor, axis=1)
+    return means[:height, :width]
+
+
+def cloud_refine_coarse_red_kernel(all_cloud, shadows, red, high_clouds,
+                                   cloud_pass1, red_darkcloud, rf, nodata):
+    """ cloud_refine_kernel evaluated on the mean of the red band over rf x rf
+    cells (see block_mean) instead of the red_nn.tif of pass0
+
+    The blocks must start on a multiple of rf lines.
+    """
+    return cloud_refine_kernel(all_cloud, shadows, block_mean(red, rf, nodata),
+                               high_clouds, cloud_pass1, red_darkcloud)
+
+
+def pass2_kernel(swir, red, green, dem, cloud_refine, zs, ndsi_pass2,
+                 red_pass2):
+    """ (im3b1!=1 and im2b1>zs and ndsi>ndsi_pass2 and red>red_pass2)?1:0
+    """
+    condition = (as_band_math(cloud_refine) != 1) & \
+                (as_band_math(dem) > as_threshold(zs)) & \
+                (ndsi(green, swir) > as_threshold(ndsi_pass2)) & \
+                (as_band_math(red) > as_threshold(red_pass2))
+    return as_mask(condition)
+
+
+def pass3_kernel(pass1, pass2):
+    """ (im1b1==1 or im2b1==1)?1:0
+    """
+    return as_mask((as_band_math(pass1) == 1) | (as_band_math(pass2) == 1))
+
+
+def empty_kernel(mask):
+    """ Return a mask filled with 0
+    """
+    return np.zeros(mask.shape, dtype=np.uint8)
+
+
+def final_mask_kernel(cloud_refine, snow, back_to_cloud, band,
+                      strict_cloud_mask, nodata, label_snow, label_cloud,
+                      label_no_data):
+    """ Compute the final snow/cloud mask with the no-data mask applied:
+    nodata?no_data:(snow?snow:((im1b1==1) or (im3b1==1))?cloud:0)
+    """
+    snow = as_band_math(snow) == 1
+    if strict_cloud_mask:
+        snow &= as_band_math(back_to_cloud) == 0
+    cloud = (as_band_math(cloud_refine) == 1) | \
+            (as_band_math(back_to_cloud) == 1)
+
+    result = np.zeros(snow.shape, dtype=np.uint8)
+    result[cloud] = int(label_cloud)
+    result[snow] = int(label_snow)
+    result[as_band_math(band) == as_threshold(nodata)] = int(label_no_data)
+    return result
+
+
+def snow_product_masks_kernel(mask, label_snow, label_cloud, label_no_data):
+    """ Decode a snow product into the binary snow and cloud masks:
+    (im1b1==snow)?1:0 and im1b1==cloud?1:(im1b1==no_data?1:0)
+    """
+    mask = as_band_math(mask)
+    snow = as_mask(mask == as_threshold(label_snow))
+    cloud = as_mask((mask == as_threshold(label_cloud)) |
+                    (mask == as_threshold(label_no_data)))
+    return snow, cloud
+
+
+def merge_masks_kernel(threshold, *masks):
+    """ Merge the snow products of a same date in priority order:
+    the value of the first mask <= threshold, else the value of the
+    last mask (see merge_masks_at_same_date)
+    """
+    threshold = as_threshold(threshold)
+    merged = np.array(masks[-1], dtype=np.uint8)
+    # the masks are applied from the lowest to the highest priority
+    for mask in reversed(masks[:-1]):
+        merged = np.where(as_band_math(mask) <= threshold, mask, merged)
+    return merged.astype(np.uint8)
+
+
+def merge_snow_product_masks_kernel(threshold, label_snow, label_cloud,
+                                    label_no_data, *masks):
+    """ Merge the snow products of a same date and decode the merged
+    product into the binary snow and cloud masks
+    """
+    return snow_product_masks_kernel(merge_masks_kernel(threshold, *masks),
+                                     label_snow, label_cloud, label_no_data)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""SQLite catalog of the snow products
+
+The catalog indexes the snow products found under root directories (name,
+platform, tile, acquisition date, level, version, zip and snow mask paths),
+so that the products of a tile between two dates are found with an indexed
+query instead of walking the directories. The quality indices (ZS, snow and
+cloud percents) and the footprint of the products are read once, when they
+are indexed, so that the products are filtered without parsing their
+metadata files. Indexing again a root directory
+only loads the new or modified product directories and removes the
+products which disappeared.
+
+The module only depends on sqlite3 to query the catalog (it is used by the
+HPC scripts), the snow products being loaded on demand.
+"""
+import os
+import os.path as op
+import sys
+import json
+import sqlite3
+import logging
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    path TEXT PRIMARY KEY,
+    product_name TEXT NOT NULL,
+    platform TEXT,
+    tile_id TEXT,
+    acquisition_date TEXT,
+    acquisition_day TEXT,
+    product_level TEXT,
+    product_version TEXT,
+    zip_product TEXT,
+    snow_mask TEXT,
+    metadata_file TEXT,
+    mtime REAL,
+    zs REAL,
+    snow_percent REAL,
+    cloud_percent REAL,
+    footprint TEXT);
+CREATE INDEX IF NOT EXISTS products_tile_day ON products (tile_id, acquisition_day);
+CREATE INDEX IF NOT EXISTS products_day ON products (acquisition_day);
+CREATE INDEX IF NOT EXISTS products_name ON products (product_name);
+"""
+
+COLUMNS = ["path", "product_name", "platform", "tile_id", "acquisition_date",
+           "acquisition_day", "product_level", "product_version",
+           "zip_product", "snow_mask", "metadata_file", "mtime",
+           "zs", "snow_percent", "cloud_percent", "footprint"]
+
+# columns added to the catalogs created by previous versions
+ADDED_COLUMNS = [("zs", "REAL"), ("snow_percent", "REAL"),
+                 ("cloud_percent", "REAL"), ("footprint", "TEXT")]
+
+
+def to_day(date):
+    """ Return the YYYYMMDD string of a datetime (or of a YYYYMMDD string)
+    """
+    if hasattr(date, "strftime"):
+        return date.strftime("%Y%m%d")
+    return date
+
+
+class snow_product_catalog(object):
+    """ SQLite catalog of the snow products
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(CATALOG_SCHEMA)
+        columns = [row["name"] for row in
+                   self.connection.execute("PRAGMA table_info(products)")]
+        with self.connection:
+            for column, column_type in ADDED_COLUMNS:
+                if column not in columns:
+                    self.connection.execute("ALTER TABLE products ADD COLUMN " +
+                                            column + " " + column_type)
+
+    def close(self):
+        self.connection.close()
+
+    def add_products(self, products, mtimes=None):
+        """ Insert (or replace) snow products in the catalog
+
+        Keyword arguments:
+        products -- the snow_product objects
+        mtimes -- the modification times of the product directories
+                  (not mandatory)
+        """
+        if mtimes is None:
+            mtimes = [None] * len(products)
+        rows = []
+        for product, mtime in zip(products, mtimes):
+            footprint = product.footprint
+            rows.append((op.join(product.product_path, product.product_name),
+                         product.product_name,
+                         product.platform,
+                         product.tile_id,
+                         product.acquisition_date.strftime("%Y-%m-%dT%H:%M:%S"),
+                         to_day(product.acquisition_date),
+                         product.product_level,
+                         product.product_version,
+                         product.zip_product,
+                         product.snow_mask,
+                         product.metadata_file,
+                         mtime,
+                         product.zs,
+                         product.snow_percent,
+                         product.cloud_percent,
+                         json.dumps(footprint) if footprint else None))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO products (" + ", ".join(COLUMNS) +
+                ") VALUES (" + ", ".join(["?"] * len(COLUMNS)) + ")", rows)
+
+    def index_directories(self, roots, nb_threads=8):
+        """ Index the snow products found under root directories
+
+        Keyword arguments:
+        roots -- the root directories
+        nb_threads -- the number of product directories listed concurrently
+
+        Return the number of (re)loaded products.
+        """
+        # imported here so that querying the catalog only requires sqlite3
+        from s2snow.snow_product_parser import parse_product_name, scan_products
+
+        known_mtimes = dict(self.connection.execute("SELECT path, mtime FROM products"))
+        to_load = []
+        mtimes = []
+        found = set()
+        for root in roots:
+            root = op.abspath(root)
+            for dirpath, dirnames, _ in os.walk(root):
+                product_dirs = [name for name in dirnames
+                                if parse_product_name(name) is not None]
+                # the product directories are not walked
+                dirnames[:] = [name for name in dirnames if name not in product_dirs]
+                for name in product_dirs:
+                    product_path = op.join(dirpath, name)
+                    found.add(product_path)
+                    mtime = os.stat(product_path).st_mtime
+                    if known_mtimes.get(product_path) != mtime:
+                        to_load.append(product_path)
+                        mtimes.append(mtime)
+
+            # remove the products which disappeared
+            removed = [(path,) for path in known_mtimes
+                       if path.startswith(root + os.sep) and path not in found]
+            if removed:
+                with self.connection:
+                    self.connection.executemany("DELETE FROM products WHERE path = ?", removed)
+                logging.info(str(len(removed)) + " products removed from the catalog")
+
+        products = scan_products(to_load, nb_threads)
+        loaded = [(product, mtime) for product, mtime in zip(products, mtimes)
+                  if product is not None]
+        self.add_products([product for product, _ in loaded],
+                          [mtime for _, mtime in loaded])
+        logging.info(str(len(loaded)) + " products indexed in " + self.db_path)
+        return len(loaded)
+
+    def query(self, tile_id=None, date_start=None, date_stop=None, platform=None,
+              snow_percent=None, cloud_percent=None):
+        """ Return the catalog rows (dictionaries) of the products matching
+        the tile, the date range (inclusive, datetimes or YYYYMMDD strings),
+        the platform (prefix, e.g. SENTINEL2 or LANDSAT8) and the snow and
+        cloud percent ranges ((min, max), exclusive, None for no bound),
+        sorted by date
+        """
+        conditions = []
+        values = []
+        if tile_id is not None:
+            conditions.append("tile_id = ?")
+            values.append(tile_id)
+        if date_start is not None:
+            conditions.append("acquisition_day >= ?")
+            values.append(to_day(date_start))
+        if date_stop is not None:
+            conditions.append("acquisition_day <= ?")
+            values.append(to_day(date_stop))
+        if platform is not None:
+            conditions.append("platform LIKE ?")
+            values.append(platform + "%")
+        for column, percent_range in [("snow_percent", snow_percent),
+                                      ("cloud_percent", cloud_percent)]:
+            if percent_range is None:
+                continue
+            minimum, maximum = percent_range
+            if minimum is not None:
+                conditions.append(column + " > ?")
+                values.append(minimum)
+            if maximum is not None:
+                conditions.append(column + " < ?")
+                values.append(maximum)
+        request = "SELECT * FROM products"
+        if conditions:
+            request += " WHERE " + " AND ".join(conditions)
+        request += " ORDER BY acquisition_date, path"
+        return [dict(row) for row in self.connection.execute(request, values)]
+
+    def get_products(self, tile_id=None, date_start=None, date_stop=None, platform=None):
+        """ Return the snow products matching the query (see query),
+        without accessing the product directories
+        """
+        from s2snow.snow_product_parser import snow_product
+
+        products = []
+        for row in self.query(tile_id, date_start, date_stop, platform):
+            product = snow_product(row["path"], sub_files=[])
+            product.zip_product = row["zip_product"]
+            product.snow_mask = row["snow_mask"]
+            product.is_extracted = row["snow_mask"] is not None
+            product.metadata_file = row["metadata_file"]
+            quality_indices = {}
+            for name, column in [("ZS", "zs"), ("SnowPercent", "snow_percent"),
+                                 ("CloudPercent", "cloud_percent")]:
+                if row[column] is not None:
+                    quality_indices[name] = row[column]
+            footprint = None
+            if row["footprint"]:
+                footprint = [tuple(point) for point in json.loads(row["footprint"])]
+            product.set_metadata(quality_indices, footprint)
+            products.append(product)
+        return products
+
+
+def main(argv):
+    """ Index the snow products of root directories into a catalog
+    """
+    if len(argv) < 3:
+        print("Usage: snow_product_catalog.py catalog.db root_dir [root_dir ...]")
+        return 1
+    catalog = snow_product_catalog(argv[1])
+    catalog.index_directories(argv[2:])
+    catalog.close()
+    return 0
+
+if __name__ == '__main__':
+    # Set logging level and format.
+    logging.basicConfig(level=logging.INFO, format=\
+        '%(asctime)s - %(filename)s:%(lineno)s - %(levelname)s - %(message)s')
+    sys.exit(main(sys.argv))
@@ -4,29 +4,232 @@
 import os
 import os.path as op
 from os.path import basename, dirname
+import json
+import time
+import zlib
 import zipfile
 import logging
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 from s2snow.utils import str_to_datetime
 
 MUSCATE_DATETIME_FORMAT = "%Y%m%d-%H%M%S-%f"
 METADATA_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+# metadata files written by LIS (see snow_detector.create_metadata)
+LIS_METADATA_FILES = ["LIS_METADATA.XML", "metadata.xml"]
+FOOTPRINT_POINTS = ["upperLeft", "upperRight", "lowerRight", "lowerLeft"]
+
+def get_file_crc(file_name, chunk_size=1024*1024):
+    """ Return the CRC-32 of a file, as stored in the zip files
+    """
+    crc = 0
+    with open(file_name, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            chunk = f.read(chunk_size)
+    return crc & 0xffffffff
+
+def is_member_extracted(info, extracted_file):
+    """ Return True if the zip member (ZipInfo) is already extracted
+    into extracted_file, with the same size and CRC
+    """
+    return op.isfile(extracted_file) and \
+        op.getsize(extracted_file) == info.file_size and \
+        get_file_crc(extracted_file) == info.CRC
+
+def extract_zip_members(arguments):
+    """ Extract from a zip file all the members corresponding to one of the
+    provided patterns, skipping the members already extracted
+
+    Keyword arguments (as a tuple, to be used in a process pool):
+    file_name -- the zip file
+    output_folder -- the extraction folder
+    patterns -- the patterns of the members to extract
+
+    Return a dictionary with the extracted files ("files"), the number of
+    extracted and skipped members ("extracted", "skipped") and the number of
+    extracted bytes ("bytes"), None if the zip file cannot be read.
+    """
+    file_name, output_folder, patterns = arguments
+    result = {"files": [], "extracted": 0, "skipped": 0, "bytes": 0}
+    try:
+        z = zipfile.ZipFile(file_name)
+        # the central directory is read once for all the patterns
+        for info in z.infolist():
+            if not any(pattern in info.filename for pattern in patterns):
+                continue
+            extracted_file = op.join(output_folder, info.filename)
+            if is_member_extracted(info, extracted_file):
+                logging.debug("Already extracted: " + extracted_file)
+                result["skipped"] += 1
+            else:
+                logging.debug(info.filename)
+                z.extract(info, output_folder)
+                result["extracted"] += 1
+                result["bytes"] += info.file_size
+            result["files"].append(extracted_file)
+        z.close()
+    except (zipfile.BadZipfile, IOError, OSError) as e:
+        logging.error("Unable to extract " + file_name + ": " + str(e))
+        return None
+    return result
+
 def extract_from_zipfile(file_name, output_folder, patterns=[]):
     """ Extract from the zip file all files corresponding
     to on of the provided patterns
     """
-    f = open(file_name, 'r')
-    z = zipfile.ZipFile(f)
-    extracted_files = []
-    for pattern in patterns:
-        for name in z.namelist():
-            if pattern in name:
-                logging.debug(name)
-                z.extract(name, output_folder)
-                extracted_files.append(op.join(output_folder, name))
-    f.close()
-    return extracted_files
+    result = extract_zip_members((file_name, output_folder, patterns))
+    if result is None:
+        return []
+    return result["files"]
+
+def extract_zip_files(zip_files, output_folders, patterns, nb_workers=1):
+    """ Extract the members of many zip files in a process pool, skipping
+    the members already extracted, and log the extraction throughput
+
+    Keyword arguments:
+    zip_files -- the zip files
+    output_folders -- the extraction folder of each zip file
+    patterns -- the patterns of the members to extract
+    nb_workers -- the number of zip files extracted concurrently
+
+    Return the results of extract_zip_members, in the order of zip_files.
+    """
+    start = time.time()
+    tasks = list(zip(zip_files, output_folders, [patterns] * len(zip_files)))
+    if nb_workers > 1 and len(tasks) > 1:
+        pool = Pool(min(nb_workers, len(tasks)))
+        results = pool.map(extract_zip_members, tasks)
+        pool.close()
+        pool.join()
+    else:
+        results = [extract_zip_members(task) for task in tasks]
+
+    elapsed = max(time.time() - start, 1e-6)
+    succeeded = [result for result in results if result is not None]
+    nb_extracted = sum(result["extracted"] for result in succeeded)
+    nb_skipped = sum(result["skipped"] for result in succeeded)
+    size = sum(result["bytes"] for result in succeeded) / (1024. * 1024.)
+    logging.info("Extracted " + str(nb_extracted) + " files (" +
+                 "%.1f MB" % size + ") from " + str(len(succeeded)) +
+                 " zip files in " + "%.1f s" % elapsed + " (" +
+                 "%.1f MB/s" % (size / elapsed) + ", " +
+                 "%.1f files/s" % (nb_extracted / elapsed) + "), " +
+                 str(nb_skipped) + " already extracted files skipped, " +
+                 str(len(results) - len(succeeded)) + " zip files failed")
+    return results
+
+def extract_snow_masks(products, output_folder, nb_workers=1):
+    """ Extract the snow masks of zipped snow products concurrently
+    (see extract_zip_files)
+    """
+    results = extract_zip_files([product.zip_product for product in products],
+                                [output_folder] * len(products),
+                                ["_SNW_R2.tif"],
+                                nb_workers)
+    for product, result in zip(products, results):
+        if result and result["files"]:
+            product.snow_mask = result["files"][0]
+        else:
+            logging.error("Extraction failed for " + str(product))
+
+def parse_product_name(product_name):
+    """ Parse the metadata of a snow product from its name only
+
+    Return a dictionary (platform, acquisition_date, product_level, tile_id,
+    flag, product_version), None if the name is not a supported snow product.
+    """
+    name_splitted = product_name.split("_")
+    platform = name_splitted[0]
+    try:
+        if "SENTINEL2" in platform or "LANDSAT8-OLITIRS-XS" == platform:
+            return {"platform": platform,
+                    "acquisition_date": str_to_datetime(name_splitted[1], MUSCATE_DATETIME_FORMAT),
+                    "product_level": name_splitted[2],
+                    "tile_id": name_splitted[3],
+                    "flag": name_splitted[4],
+                    "product_version": name_splitted[5]}
+        elif "LANDSAT8" in platform and "N2A" in product_name:
+            return {"platform": platform,
+                    "acquisition_date": str_to_datetime(name_splitted[3], "%Y%m%d"),
+                    "product_level": name_splitted[4],
+                    "tile_id": name_splitted[5],
+                    "flag": None,
+                    "product_version": None}
+    except (IndexError, ValueError):
+        logging.debug("Invalid product name: " + product_name)
+    return None
+
+def local_name(tag):
+    """ Return the tag of an xml element without its namespace
+    """
+    return tag.rsplit("}", 1)[-1]
+
+def read_quality_indices(metadata_file, names=None):
+    """ Return the quality indices ({name: value}, e.g. ZS, SnowPercent and
+    CloudPercent) of a LIS metadata file
+
+    The file is parsed incrementally and the parsing stops at the end of the
+    Global_Index_List element, or as soon as all the requested indices are
+    read.
+
+    Keyword arguments:
+    metadata_file -- the LIS metadata file
+    names -- the names of the requested indices (None for all of them)
+    """
+    indices = {}
+    try:
+        for _, element in iterparse(metadata_file):
+            tag = local_name(element.tag)
+            if tag == "QUALITY_INDEX":
+                name = element.get("name")
+                if names is not None and name not in names:
+                    continue
+                try:
+                    indices[name] = float(element.text)
+                except (TypeError, ValueError):
+                    logging.warning("Invalid quality index " + str(name) +
+                                    " in " + metadata_file)
+                if names is not None and len(indices) == len(names):
+                    break
+            elif tag == "Global_Index_List":
+                break
+    except Exception as e:
+        logging.warning("Unable to parse " + metadata_file + ": " + str(e))
+    return indices
+
+def read_footprint(metadata_file):
+    """ Return the footprint of a MUSCATE metadata file, as the (longitude,
+    latitude) of its upper left, upper right, lower right and lower left
+    corners, None if not found
+
+    The file is parsed incrementally and the parsing stops at the end of the
+    Global_Geopositioning element.
+    """
+    points = {}
+    try:
+        for _, element in iterparse(metadata_file):
+            tag = local_name(element.tag)
+            if tag == "Point" and element.get("name") in FOOTPRINT_POINTS:
+                coordinates = dict((local_name(child.tag), child.text) for child in element)
+                points[element.get("name")] = (float(coordinates["LON"]),
+                                               float(coordinates["LAT"]))
+            elif tag == "Global_Geopositioning":
+                break
+    except Exception as e:
+        logging.warning("Unable to parse " + metadata_file + ": " + str(e))
+        return None
+    if len(points) != len(FOOTPRINT_POINTS):
+        return None
+    return [points[name] for name in FOOTPRINT_POINTS]
 
 def load_snow_product(absolute_filename):
     pathname = dirname(absolute_filename)
@@ -40,38 +243,92 @@ def load_snow_product(absolute_filename):
 
     return loaded_snow_product
 
+def list_product_dir(product_path, index=None):
+    """ Return the files of a product directory, from the index when the
+    directory was not modified since it was indexed
+
+    Keyword arguments:
+    product_path -- the product directory
+    index -- the product index, {path: {"mtime": ..., "sub_files": [...]}}
+             updated with the listed directories (not mandatory)
+    """
+    mtime = os.stat(product_path).st_mtime
+    if index is not None:
+        entry = index.get(product_path)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry["sub_files"]
+    sub_files = os.listdir(product_path)
+    if index is not None:
+        index[product_path] = {"mtime": mtime, "sub_files": sub_files}
+    return sub_files
+
+def scan_products(product_paths, nb_threads=8, index_file=None):
+    """ Load the snow products of a list of directories, listing the
+    directories concurrently
+
+    Keyword arguments:
+    product_paths -- the product directories
+    nb_threads -- the number of directories listed concurrently
+    index_file -- the json product index, reused and updated (not mandatory)
+
+    Return the list of the loaded snow products (None for the products that
+    could not be loaded), in the order of product_paths.
+    """
+    index = None
+    if index_file is not None:
+        index = {}
+        if op.exists(index_file):
+            try:
+                with open(index_file) as index_stream:
+                    index = json.load(index_stream)
+            except ValueError:
+                logging.warning("Invalid product index " + index_file + ", rebuilding it")
+
+    def load(product_path):
+        try:
+            return snow_product(product_path, list_product_dir(product_path, index))
+        except Exception:
+            logging.error("Unable to load product :" + product_path)
+            return None
+
+    if nb_threads > 1 and len(product_paths) > 1:
+        pool = ThreadPool(min(nb_threads, len(product_paths)))
+        products = pool.map(load, product_paths)
+        pool.close()
+        pool.join()
+    else:
+        products = [load(product_path) for product_path in product_paths]
+
+    if index_file is not None:
+        tmp_index_file = index_file + ".tmp"
+        with open(tmp_index_file, "w") as index_stream:
+            json.dump(index, index_stream)
+        os.rename(tmp_index_file, index_file)
+    return products
+
 class snow_product:
-    def __init__(self, absoluteFilename):
+    def __init__(self, absoluteFilename, sub_files=None):
+        """
+        Keyword arguments:
+        absoluteFilename -- the product directory
+        sub_files -- the files of the product directory (listed if not set)
+        """
         # example 1 "SENTINEL2A_20160912-103551-370_L2B-SNOW_T32TLS_D_V1-0"
         # example 2 "LANDSAT8_OLITIRS_XS_20160812_N2A_France-MetropoleD0005H0001"
 
         self.product_name = basename(absoluteFilename)
         self.product_path = dirname(absoluteFilename)
 
-        name_splitted = self.product_name.split("_")
-
-        self.platform = name_splitted[0]
-        if "SENTINEL2" in self.platform:
-            self.acquisition_date = str_to_datetime(name_splitted[1], MUSCATE_DATETIME_FORMAT)
-            self.product_level = name_splitted[2]
-            self.tile_id = name_splitted[3]
-            self.flag = name_splitted[4]
-            self.product_version = name_splitted[5]
-        elif "LANDSAT8-OLITIRS-XS" == self.platform:
-            self.acquisition_date = str_to_datetime(name_splitted[1], MUSCATE_DATETIME_FORMAT)
-            self.product_level = name_splitted[2]
-            self.tile_id = name_splitted[3]
-            self.flag = name_splitted[4]
-            self.product_version = name_splitted[5]
-        elif "LANDSAT8" in self.platform and "N2A" in self.product_name:
-            self.acquisition_date = str_to_datetime(name_splitted[3], "%Y%m%d")
-            self.product_level = name_splitted[4]
-            self.tile_id = name_splitted[5]
-            self.flag = None
-            self.product_version = None
-        else:
-            logging.error("Unknown platform: " + self.platform)
+        name_info = parse_product_name(self.product_name)
+        if name_info is None:
+            logging.error("Unknown platform: " + self.product_name.split("_")[0])
             raise Exception()
+        self.platform = name_info["platform"]
+        self.acquisition_date = name_info["acquisition_date"]
+        self.product_level = name_info["product_level"]
+        self.tile_id = name_info["tile_id"]
+        self.flag = name_info["flag"]
+        self.product_version = name_info["product_version"]
 
         logging.debug("New snow_product:")
         logging.debug(absoluteFilename)
@@ -82,7 +339,9 @@ class snow_product:
         self.is_extracted = False
         self.snow_mask = None
 
-        self.sub_files = os.listdir(absoluteFilename)
+        if sub_files is None:
+            sub_files = os.listdir(absoluteFilename)
+        self.sub_files = sub_files
         for sub_file in self.sub_files:
             if sub_file.lower().endswith(".zip"):
                 logging.info("The snow product is stored in a zip")
@@ -103,6 +362,8 @@ class snow_product:
 
         self.metadata_file = op.join(absoluteFilename,
                                      self.product_name + "_MTD_ALL.xml")
+        # metadata read on first access (see quality_indices and footprint)
+        self._metadata = {}
 
     def __repr__(self):
         return op.join(self.product_path, self.product_name)
@@ -110,9 +371,39 @@ class snow_product:
     def __str__(self):
         return op.join(self.product_path, self.product_name)
 
-    def extract_snow_mask(self, output_folder):
+    def get_zip_member(self, pattern):
+        """ Return the name of the first file of the zip product
+        containing the pattern (None if not found)
+        """
+        zip_file = zipfile.ZipFile(self.zip_product)
+        members = [name for name in zip_file.namelist() if pattern in name]
+        zip_file.close()
+        if members:
+            return members[0]
+        return None
+
+    def extract_snow_mask(self, output_folder, cache=None):
+        """ Extract the snow mask of the zip product
+
+        Keyword arguments:
+        output_folder -- the extraction folder
+        cache -- a mask_cache of the extracted files (not mandatory)
+        """
         if self.snow_mask and op.exists(self.snow_mask):
             logging.info("The snow mask is already extracted and available")
+        elif self.zip_product and op.exists(self.zip_product) and cache is not None:
+            member = self.get_zip_member("_SNW_R2.tif")
+            if member is None:
+                logging.error("Extraction failed, no snow mask in " + self.zip_product)
+                return
+            extracted_file = op.join(output_folder, member)
+            cache.run("extract",
+                      [self.zip_product],
+                      [member],
+                      [extracted_file],
+                      partial(extract_from_zipfile, self.zip_product,
+                              output_folder, [member]))
+            self.snow_mask = extracted_file
         elif self.zip_product and op.exists(self.zip_product):
             extracted_files = extract_from_zipfile(self.zip_product,
                                                    output_folder,
@@ -121,8 +412,20 @@ class snow_product:
         else:
             logging.error("Extraction failed")
 
+    def use_vsizip_snow_mask(self):
+        """ Read the snow mask directly from the zip product,
+        through the GDAL /vsizip/ virtual file system (no extraction)
+        """
+        if self.zip_product and op.exists(self.zip_product):
+            member = self.get_zip_member("_SNW_R2.tif")
+            if member is not None:
+                self.snow_mask = "/vsizip/" + op.join(self.zip_product, member)
+                return
+        logging.error("No snow mask to read in the zip product of " + str(self))
+
     def get_snow_mask(self):
-        if self.snow_mask and op.exists(self.snow_mask):
+        if self.snow_mask and (self.snow_mask.startswith("/vsizip/") or
+                               op.exists(self.snow_mask)):
             return self.snow_mask
         else:
             logging.info("The snow mask must first be extracted")
@@ -133,6 +436,58 @@ class snow_product:
         else:
             logging.info("The metadata file was not found")
 
+    def get_lis_metadata(self):
+        """ Return the metadata file written by LIS (None if not found),
+        next to the snow mask or in the product directory
+        """
+        folders = [op.join(self.product_path, self.product_name)]
+        if self.snow_mask and not self.snow_mask.startswith("/vsizip/"):
+            folders.insert(0, dirname(self.snow_mask))
+        for folder in folders:
+            for name in LIS_METADATA_FILES:
+                if op.exists(op.join(folder, name)):
+                    return op.join(folder, name)
+        return None
+
+    def set_metadata(self, quality_indices, footprint):
+        """ Set the metadata read elsewhere (e.g. from a catalog),
+        so that the metadata files are not parsed
+        """
+        self._metadata["quality_indices"] = quality_indices
+        self._metadata["footprint"] = footprint
+
+    @property
+    def quality_indices(self):
+        """ The quality indices of the LIS metadata ({} if not found)
+        """
+        if "quality_indices" not in self._metadata:
+            lis_metadata = self.get_lis_metadata()
+            self._metadata["quality_indices"] = \
+                read_quality_indices(lis_metadata) if lis_metadata else {}
+        return self._metadata["quality_indices"]
+
+    @property
+    def zs(self):
+        return self.quality_indices.get("ZS")
+
+    @property
+    def snow_percent(self):
+        return self.quality_indices.get("SnowPercent")
+
+    @property
+    def cloud_percent(self):
+        return self.quality_indices.get("CloudPercent")
+
+    @property
+    def footprint(self):
+        """ The footprint of the MUSCATE metadata (see read_footprint)
+        """
+        if "footprint" not in self._metadata:
+            metadata_file = self.get_metadata()
+            self._metadata["footprint"] = \
+                read_footprint(metadata_file) if metadata_file else None
+        return self._metadata["footprint"]
+
 
 ###############################################################
 #   Main Test
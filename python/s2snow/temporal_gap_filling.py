@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""NumPy implementation of the temporal gap filling of the snow annual map
+
+The multi-date snow and cloud masks are streamed by blocks of lines and
+each pixel time series is linearly interpolated on the output dates from
+its nearest valid (not cloud) dates before and after, as done by the
+ImageTimeSeriesGapFilling application (it=linear). The interpolated values
+are truncated to uint8. Before the first (after the last) valid date, the
+first (last) valid value is used, and a pixel without any valid date is
+set to 0.
+
+The output dates are interpolated by chunks of OUTPUT_DATES_CHUNK dates, so
+that the float64 temporaries of the interpolation do not grow with the
+number of output dates, and the blocks are sized on the peak memory per
+pixel (see gap_filling_bytes_per_pixel).
+"""
+import logging
+
+import numpy as np
+
+import gdal
+from gdalconst import GA_ReadOnly, GA_Update
+
+from s2snow.utils import str_to_datetime
+from s2snow.block_processing import create_raster, get_block_lines, iter_windows
+from s2snow.block_processing import GDAL_CO_MASK, BYTES_PER_PIXEL
+from s2snow.packed_cube import packed_cube_writer
+
+# number of output dates interpolated at once
+OUTPUT_DATES_CHUNK = 8
+# bytes per pixel and per output date interpolated at once (indices, values,
+# ordinals, weight and intermediate results of linear_gap_filling)
+INTERPOLATION_BYTES = 160
+
+
+def date_ordinals(dates):
+    """ Convert a list of dates (YYYYMMDD) into day numbers
+    """
+    return np.array([str_to_datetime(date).toordinal() for date in dates],
+                    dtype=np.float64)
+
+
+def last_valid_index(valid):
+    """ Return for each date the index of the last valid date
+    up to this date (-1 if none), along the first axis
+    """
+    dates_index = np.arange(valid.shape[0], dtype=np.int32).reshape((-1,) + (1,) * (valid.ndim - 1))
+    return np.maximum.accumulate(np.where(valid, dates_index, -1), axis=0)
+
+
+def next_valid_index(valid):
+    """ Return for each date the index of the first valid date
+    from this date (number of dates if none), along the first axis
+    """
+    nb_dates = valid.shape[0]
+    dates_index = np.arange(nb_dates, dtype=np.int32).reshape((-1,) + (1,) * (valid.ndim - 1))
+    index = np.where(valid, dates_index, nb_dates)[::-1]
+    return np.minimum.accumulate(index, axis=0)[::-1]
+
+
+def linear_gap_filling(values, valid, input_ordinals, output_ordinals):
+    """ Interpolate the time series on the output dates
+
+    Keyword arguments:
+    values -- the input values, array of shape (input dates, pixels)
+    valid -- the validity of the input values (same shape)
+    input_ordinals -- the input day numbers (sorted)
+    output_ordinals -- the output day numbers
+
+    Return the interpolated values as uint8, array of shape
+    (output dates, pixels).
+    """
+    input_ordinals = np.asarray(input_ordinals, dtype=np.float64)
+    output_ordinals = np.asarray(output_ordinals, dtype=np.float64)
+    nb_dates = input_ordinals.size
+    pixels = np.arange(values.shape[1])
+
+    # Input dates up to and after each output date
+    date_before = np.searchsorted(input_ordinals, output_ordinals, side="right") - 1
+    date_after = date_before + 1
+
+    # An extra row stands for the missing valid dates
+    last_valid = np.vstack((last_valid_index(valid),
+                            np.full((1, values.shape[1]), -1, dtype=np.int32)))
+    next_valid = np.vstack((next_valid_index(valid),
+                            np.full((1, values.shape[1]), nb_dates, dtype=np.int32)))
+
+    result = np.empty((output_ordinals.size, values.shape[1]), dtype=np.uint8)
+    for start in range(0, output_ordinals.size, OUTPUT_DATES_CHUNK):
+        stop = start + OUTPUT_DATES_CHUNK
+        before = last_valid[np.where(date_before[start:stop] >= 0,
+                                     date_before[start:stop], nb_dates)]
+        after = next_valid[np.minimum(date_after[start:stop], nb_dates)]
+        has_before = before >= 0
+        has_after = after < nb_dates
+        before[~has_before] = 0
+        after[~has_after] = 0
+
+        value_before = values[before, pixels].astype(np.float64)
+        value_after = values[after, pixels].astype(np.float64)
+        ordinal_before = input_ordinals[before]
+        ordinal_after = input_ordinals[after]
+
+        both = has_before & has_after
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = (output_ordinals[start:stop, np.newaxis] - ordinal_before) / \
+                     (ordinal_after - ordinal_before)
+            result[start:stop] = np.where(both,
+                                          value_before + (value_after - value_before) * weight,
+                                          np.where(has_before, value_before,
+                                                   np.where(has_after, value_after, 0)))
+    return result
+
+
+def gap_filling_bytes_per_pixel(nb_input_dates, nb_output_dates):
+    """ Return the peak memory in bytes per pixel of the gap filling of a
+    block (input stacks, valid dates indices, interpolation temporaries and
+    outputs)
+    """
+    # uint8 snow, cloud and validity stacks
+    inputs = 3 * nb_input_dates
+    # int32 last and next valid dates, with their temporaries
+    indices = 16 * (nb_input_dates + 1)
+    interpolation = INTERPOLATION_BYTES * min(nb_output_dates, OUTPUT_DATES_CHUNK)
+    # uint8 daily masks and uint16 occurences
+    outputs = nb_output_dates + 4
+    return inputs + indices + interpolation + outputs
+
+
+def get_gap_filling_block_lines(xsize, nb_input_dates, nb_output_dates, ram):
+    """ Return the number of lines of a gap filling block fitting in ram (in MB)
+    """
+    nb_layers = -(-gap_filling_bytes_per_pixel(nb_input_dates, nb_output_dates) //
+                  BYTES_PER_PIXEL)
+    return get_block_lines(xsize, nb_layers, ram)
+
+
+def read_stack(dataset, xoff, yoff, width, height):
+    """ Read a window of all the bands of a dataset as (bands, lines, columns)
+    """
+    array = dataset.ReadAsArray(xoff, yoff, width, height)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    return array
+
+
+def gap_filling_by_blocks(snow_img, cloud_img, input_dates, output_dates,
+                          snow_occurence=None, daily_masks=None,
+                          cloud_occurence=None, ram=512, block_lines=None,
+                          daily_masks_format="gtiff", cube=None):
+    """ Gap fill the multi-date snow masks and accumulate the snow occurence
+
+    The snow and cloud occurences are accumulated block by block, so that
+    the daily masks are only written when requested.
+
+    Keyword arguments:
+    snow_img -- the multi-date binary snow masks (one band per input date)
+    cloud_img -- the multi-date binary cloud masks (1 for invalid dates)
+    input_dates -- the input dates (YYYYMMDD)
+    output_dates -- the output dates (YYYYMMDD)
+    snow_occurence -- the output number of snow days (not mandatory)
+    daily_masks -- the output gap filled snow masks, one band per output date
+                   (not mandatory)
+    cloud_occurence -- the output number of cloud dates (not mandatory)
+    ram -- the ram limitation in MB, used when block_lines is not set
+    block_lines -- the number of lines of a block (not mandatory)
+    daily_masks_format -- "gtiff" for a multi-band image, "packed" for the
+                          bit-packed format of s2snow.packed_cube
+    cube -- a chunked_cube_writer receiving the snow, cloud and gapfilled
+            layers (not mandatory), whose chunk lines must fit in a block
+            (see get_gap_filling_block_lines)
+    """
+    if snow_occurence is None and daily_masks is None and \
+       cloud_occurence is None and cube is None:
+        logging.error("At least one of snow_occurence, daily_masks, "
+                      "cloud_occurence and cube is required")
+        return
+
+    input_ordinals = date_ordinals(input_dates)
+    output_ordinals = date_ordinals(output_dates)
+
+    snow_dataset = gdal.Open(snow_img, GA_ReadOnly)
+    cloud_dataset = gdal.Open(cloud_img, GA_ReadOnly)
+    xsize = snow_dataset.RasterXSize
+    ysize = snow_dataset.RasterYSize
+    if snow_dataset.RasterCount != len(input_dates) or \
+       cloud_dataset.RasterCount != len(input_dates):
+        logging.error("The number of bands of " + snow_img + " and " +
+                      cloud_img + " does not match the input dates")
+        return
+
+    occurence_dataset = None
+    if snow_occurence is not None:
+        occurence_dataset = create_raster(snow_occurence, snow_dataset,
+                                          gdal.GDT_UInt16)
+    daily_dataset = None
+    daily_writer = None
+    if daily_masks is not None and daily_masks_format == "packed":
+        daily_writer = packed_cube_writer(daily_masks, xsize, ysize,
+                                          output_dates,
+                                          snow_dataset.GetGeoTransform(),
+                                          snow_dataset.GetProjection())
+    elif daily_masks is not None:
+        daily_dataset = create_raster(daily_masks, snow_dataset, gdal.GDT_Byte,
+                                      len(output_dates), GDAL_CO_MASK)
+    cloud_dataset_out = None
+    if cloud_occurence is not None:
+        cloud_dataset_out = create_raster(cloud_occurence, snow_dataset,
+                                          gdal.GDT_UInt16)
+
+    if not block_lines:
+        block_lines = get_gap_filling_block_lines(xsize, len(input_dates),
+                                                  len(output_dates), ram)
+    if cube is not None:
+        # the blocks must be aligned on the chunks of the cube
+        if block_lines < cube.chunk_lines:
+            raise ValueError("The chunks of " + str(cube.chunk_lines) +
+                             " lines of the cube do not fit in the blocks of " +
+                             str(block_lines) + " lines of the gap filling")
+        block_lines = block_lines // cube.chunk_lines * cube.chunk_lines
+        cube.add_layer("snow", input_dates)
+        cube.add_layer("cloud", input_dates)
+        cube.add_layer("gapfilled", output_dates)
+    logging.info("Gap filling " + str(len(input_dates)) + " dates on " +
+                 str(len(output_dates)) + " dates by blocks of " +
+                 str(block_lines) + " lines")
+
+    for xoff, yoff, width, height in iter_windows(xsize, ysize, block_lines):
+        snow = read_stack(snow_dataset, xoff, yoff, width, height)
+        cloud = read_stack(cloud_dataset, xoff, yoff, width, height)
+        daily = linear_gap_filling(snow.reshape(snow.shape[0], -1),
+                                   cloud.reshape(cloud.shape[0], -1) == 0,
+                                   input_ordinals,
+                                   output_ordinals)
+        daily = daily.reshape((len(output_dates), height, width))
+
+        if cloud_dataset_out is not None:
+            cloud_dataset_out.GetRasterBand(1).WriteArray(
+                cloud.sum(axis=0, dtype=np.uint16), xoff, yoff)
+        if occurence_dataset is not None:
+            occurence_dataset.GetRasterBand(1).WriteArray(
+                daily.sum(axis=0, dtype=np.uint16), xoff, yoff)
+        if daily_dataset is not None:
+            daily_dataset.WriteRaster(xoff, yoff, width, height,
+                                      np.ascontiguousarray(daily).tobytes(),
+                                      buf_type=gdal.GDT_Byte)
+        if daily_writer is not None:
+            daily_writer.write_chunk(yoff, daily)
+        if cube is not None:
+            cube.write("snow", yoff, snow)
+            cube.write("cloud", yoff, cloud)
+            cube.write("gapfilled", yoff, daily)
+
+    if daily_writer is not None:
+        daily_writer.close()
+    if cube is not None:
+        cube.close()
+
+    occurence_dataset = None
+    daily_dataset = None
+    cloud_dataset_out = None
+    snow_dataset = None
+    cloud_dataset = None
+
+
+def upsert_date_by_blocks(snow_masks, cloud_masks, input_dates, output_dates,
+                          date, new_snow, new_cloud, snow_occurence,
+                          cloud_occurence, ram=512, block_lines=None):
+    """ Add (or replace) a date of the time series and update the snow and
+    cloud occurences in place
+
+    Only the pixels whose validity or snow state changed at this date are
+    interpolated again, on the output dates between their previous and next
+    valid dates, and the difference with the former interpolation is added
+    to the snow occurence.
+
+    Keyword arguments:
+    snow_masks -- the current binary snow masks, one per input date
+    cloud_masks -- the current binary cloud masks, one per input date
+    input_dates -- the current input dates (YYYYMMDD, sorted)
+    output_dates -- the output dates (YYYYMMDD)
+    date -- the added or replaced date (YYYYMMDD)
+    new_snow -- the binary snow mask of this date
+    new_cloud -- the binary cloud mask of this date
+    snow_occurence -- the number of snow days, updated in place
+    cloud_occurence -- the number of cloud dates, updated in place
+    ram -- the ram limitation in MB, used when block_lines is not set
+    block_lines -- the number of lines of a block (not mandatory)
+
+    Return the number of updated pixels.
+    """
+    if len(snow_masks) != len(input_dates) or len(cloud_masks) != len(input_dates):
+        logging.error("The number of binary masks does not match the input dates")
+        return 0
+
+    output_ordinals = date_ordinals(output_dates)
+    date_ordinal = date_ordinals([date])[0]
+    replaced = input_dates.index(date) if date in input_dates else None
+    others = [index for index in range(len(input_dates)) if index != replaced]
+    other_ordinals = date_ordinals([input_dates[index] for index in others])
+    # the position of the date in the series of the other dates
+    position = int(np.searchsorted(other_ordinals, date_ordinal))
+    series_ordinals = np.insert(other_ordinals, position, date_ordinal)
+
+    other_snow = [gdal.Open(snow_masks[index], GA_ReadOnly) for index in others]
+    other_cloud = [gdal.Open(cloud_masks[index], GA_ReadOnly) for index in others]
+    old_snow = old_cloud = None
+    if replaced is not None:
+        old_snow = gdal.Open(snow_masks[replaced], GA_ReadOnly)
+        old_cloud = gdal.Open(cloud_masks[replaced], GA_ReadOnly)
+    new_snow_dataset = gdal.Open(new_snow, GA_ReadOnly)
+    new_cloud_dataset = gdal.Open(new_cloud, GA_ReadOnly)
+    occurence_dataset = gdal.Open(snow_occurence, GA_Update)
+    cloud_occurence_dataset = gdal.Open(cloud_occurence, GA_Update)
+    xsize = new_snow_dataset.RasterXSize
+    ysize = new_snow_dataset.RasterYSize
+
+    if not block_lines:
+        block_lines = get_block_lines(xsize, 2 * len(input_dates) + 8, ram)
+    logging.info("Updating the occurences with the date " + date +
+                 " by blocks of " + str(block_lines) + " lines")
+
+    nb_updated = 0
+    for xoff, yoff, width, height in iter_windows(xsize, ysize, block_lines):
+        snow = new_snow_dataset.ReadAsArray(xoff, yoff, width, height)
+        cloud = new_cloud_dataset.ReadAsArray(xoff, yoff, width, height)
+        if old_snow is not None:
+            previous_snow = old_snow.ReadAsArray(xoff, yoff, width, height)
+            previous_cloud = old_cloud.ReadAsArray(xoff, yoff, width, height)
+            cloud_delta = cloud.astype(np.int32) - previous_cloud
+        else:
+            # an added date is equivalent to a former cloudy date
+            previous_snow = np.zeros_like(snow)
+            previous_cloud = np.ones_like(cloud)
+            cloud_delta = cloud.astype(np.int32)
+
+        if cloud_delta.any():
+            band = cloud_occurence_dataset.GetRasterBand(1)
+            cloud_count = band.ReadAsArray(xoff, yoff, width, height).astype(np.int32)
+            band.WriteArray((cloud_count + cloud_delta).astype(np.uint16), xoff, yoff)
+
+        valid = cloud == 0
+        previous_valid = previous_cloud == 0
+        changed = (valid != previous_valid) | (valid & (snow != previous_snow))
+        if not changed.any():
+            continue
+        rows, columns = np.nonzero(changed)
+        nb_updated += rows.size
+
+        # series of the other dates on the changed pixels
+        values = np.array([dataset.ReadAsArray(xoff, yoff, width, height)[rows, columns]
+                           for dataset in other_snow], dtype=np.uint8).reshape(-1, rows.size)
+        others_valid = np.array([dataset.ReadAsArray(xoff, yoff, width, height)[rows, columns] == 0
+                                 for dataset in other_cloud], dtype=bool).reshape(-1, rows.size)
+
+        # the interpolation changes between the previous and the next
+        # valid dates around the date
+        window_start = -np.inf
+        if position > 0:
+            previous = last_valid_index(others_valid)[position - 1]
+            if (previous >= 0).all():
+                window_start = other_ordinals[previous].min()
+        window_stop = np.inf
+        if position < len(others):
+            following = next_valid_index(others_valid)[position]
+            if (following < len(others)).all():
+                window_stop = other_ordinals[following].max()
+        window = (output_ordinals >= window_start) & (output_ordinals < window_stop)
+        if not window.any():
+            continue
+
+        new_values = np.insert(values, position, snow[rows, columns], axis=0)
+        new_valid = np.insert(others_valid, position, valid[rows, columns], axis=0)
+        old_values = np.insert(values, position, previous_snow[rows, columns], axis=0)
+        old_valid = np.insert(others_valid, position, previous_valid[rows, columns], axis=0)
+        delta = linear_gap_filling(new_values, new_valid, series_ordinals,
+                                   output_ordinals[window]).sum(axis=0, dtype=np.int64) - \
+                linear_gap_filling(old_values, old_valid, series_ordinals,
+                                   output_ordinals[window]).sum(axis=0, dtype=np.int64)
+
+        band = occurence_dataset.GetRasterBand(1)
+        occurence = band.ReadAsArray(xoff, yoff, width, height).astype(np.int64)
+        occurence[rows, columns] += delta
+        band.WriteArray(occurence.astype(np.uint16), xoff, yoff)
+
+    logging.info(str(nb_updated) + " pixels updated with the date " + date)
+    other_snow = other_cloud = old_snow = old_cloud = None
+    new_snow_dataset = new_cloud_dataset = None
+    occurence_dataset = None
+    cloud_occurence_dataset = None
+    return nb_updated
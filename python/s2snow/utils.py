@@ -188,14 +188,34 @@ def burn_polygons_edges(input_img, input_vec, snow_value, cloud_value, \
     bandMathFinalShadow.ExecuteAndWriteOutput()
 
 
-def extract_band(inputs, band, path_tmp, noData):
+def extract_band(inputs, band, path_tmp, noData, zero_copy=False):
     """ Extract the required band using gdal.Translate
+
+    With zero_copy, an Int16 band is referenced by a vrt declaring the band
+    selection and the nodata value instead of being copied, the copy being
+    only required by a conversion to Int16.
     """
     data_band = inputs[band]
     path = data_band["path"]
     band_no = data_band["noBand"]
 
     dataset = gdal.Open(path, GA_ReadOnly)
+    data_type = dataset.GetRasterBand(band_no).DataType
+    dataset = None
+
+    if zero_copy:
+        if data_type == gdal.GDT_Int16:
+            path_extracted = op.join(path_tmp, band+"_extracted.vrt")
+            logging.info("referencing "+band+" (no copy)")
+            gdal.Translate(
+                    path_extracted,
+                    path,
+                    format='VRT',
+                    noData=noData,
+                    bandList=[band_no])
+            return path_extracted
+        logging.info(band+" requires a conversion to Int16")
+
     path_extracted = op.join(path_tmp, band+"_extracted.tif")
 
     logging.info("extracting "+band)
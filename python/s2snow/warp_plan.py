@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#=========================================================================
+#
+#  Program:   lis
+#  Language:  Python
+#
+#  Copyright (c) Germain Salgues
+#  Copyright (c) Manuel Grizonnet
+#
+#  See lis-copyright.txt for details.
+#
+#  This software is distributed WITHOUT ANY WARRANTY; without even
+#  the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+#  PURPOSE.  See the above copyright notices for more information.
+#
+#=========================================================================
+"""Nearest neighbour reprojection of snow masks with a reusable warp plan
+
+A warp plan gives, for each pixel of a target grid, the (line, column) of
+the source pixel containing its center, or -1 outside the source grid. It
+only depends on the source and target grids (projection, geotransform and
+size), so it is computed once and applied to every product sharing the
+same source grid (e.g. the Landsat products of a path/row).
+
+The source coordinates are computed exactly on a coarse grid of target
+pixels (every PLAN_STEP pixels) and bilinearly interpolated in between, as
+the approximate transformer of gdalwarp does.
+"""
+import json
+import hashlib
+import logging
+
+import numpy as np
+
+import gdal
+import osr
+from gdalconst import GA_ReadOnly
+
+from s2snow.block_processing import create_raster, get_block_lines, iter_windows
+
+PLAN_STEP = 16
+
+
+def get_grid(image):
+    """ Return the grid of an image as a dictionary
+    (projection, geotransform, xsize, ysize)
+    """
+    dataset = gdal.Open(image, GA_ReadOnly)
+    grid = {"projection": dataset.GetProjection(),
+            "geotransform": list(dataset.GetGeoTransform()),
+            "xsize": dataset.RasterXSize,
+            "ysize": dataset.RasterYSize}
+    dataset = None
+    return grid
+
+
+def get_plan_key(source_grid, target_grid):
+    """ Return the identifier of the warp plan between two grids
+    """
+    description = json.dumps([source_grid, target_grid], sort_keys=True)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def get_spatial_reference(projection):
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(projection)
+    # keep the x, y order with GDAL >= 3
+    if hasattr(spatial_reference, "SetAxisMappingStrategy"):
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return spatial_reference
+
+
+def source_coordinates(source_grid, target_grid, columns, lines):
+    """ Return the fractional (lines, columns) in the source grid of the
+    centers of the target pixels (columns, lines)
+    """
+    target_geotransform = target_grid["geotransform"]
+    x = target_geotransform[0] + (columns + 0.5) * target_geotransform[1] + \
+        (lines + 0.5) * target_geotransform[2]
+    y = target_geotransform[3] + (columns + 0.5) * target_geotransform[4] + \
+        (lines + 0.5) * target_geotransform[5]
+
+    if source_grid["projection"] != target_grid["projection"]:
+        transformation = osr.CoordinateTransformation(
+            get_spatial_reference(target_grid["projection"]),
+            get_spatial_reference(source_grid["projection"]))
+        points = transformation.TransformPoints(
+            np.column_stack((x.ravel(), y.ravel())).tolist())
+        points = np.array(points, dtype=np.float64)
+        x = points[:, 0].reshape(x.shape)
+        y = points[:, 1].reshape(y.shape)
+
+    inverse = gdal.InvGeoTransform(source_grid["geotransform"])
+    # GDAL 2 returns (success, geotransform)
+    if len(inverse) == 2:
+        inverse = inverse[1]
+    source_columns = inverse[0] + x * inverse[1] + y * inverse[2]
+    source_lines = inverse[3] + x * inverse[4] + y * inverse[5]
+    return source_lines, source_columns
+
+
+def compute_warp_plan(source_grid, target_grid, plan_path, ram=512):
+    """ Compute the warp plan between two grids into a .npy file of
+    shape (2, target lines, target columns), int32
+
+    Keyword arguments:
+    source_grid -- the source grid (see get_grid)
+    target_grid -- the target grid (see get_grid)
+    plan_path -- the output .npy file
+    ram -- the ram limitation in MB
+    """
+    xsize = target_grid["xsize"]
+    ysize = target_grid["ysize"]
+    logging.info("Computing the warp plan " + plan_path)
+
+    # exact source coordinates on the coarse grid
+    coarse_columns = np.arange(0, xsize + PLAN_STEP, PLAN_STEP, dtype=np.float64)
+    coarse_lines = np.arange(0, ysize + PLAN_STEP, PLAN_STEP, dtype=np.float64)
+    columns, lines = np.meshgrid(coarse_columns, coarse_lines)
+    coarse_source_lines, coarse_source_columns = source_coordinates(
+        source_grid, target_grid, columns, lines)
+
+    plan = np.lib.format.open_memmap(plan_path, mode="w+", dtype=np.int32,
+                                     shape=(2, ysize, xsize))
+    columns = np.arange(xsize)
+    node_columns = np.minimum(columns // PLAN_STEP, coarse_columns.size - 2)
+    weight_columns = (columns - coarse_columns[node_columns]) / PLAN_STEP
+    for _, yoff, width, height in iter_windows(xsize, ysize,
+                                               get_block_lines(xsize, 8, ram)):
+        lines = np.arange(yoff, yoff + height)
+        node_lines = np.minimum(lines // PLAN_STEP, coarse_lines.size - 2)
+        weight_lines = ((lines - coarse_lines[node_lines]) / PLAN_STEP)[:, np.newaxis]
+        for index, coarse in enumerate((coarse_source_lines, coarse_source_columns)):
+            top = coarse[node_lines][:, node_columns] * (1 - weight_columns) + \
+                  coarse[node_lines][:, node_columns + 1] * weight_columns
+            bottom = coarse[node_lines + 1][:, node_columns] * (1 - weight_columns) + \
+                     coarse[node_lines + 1][:, node_columns + 1] * weight_columns
+            # rounded so that the centers on a source pixel border do not
+            # depend on the interpolation error
+            plan[index, yoff:yoff + height] = np.floor(
+                np.round(top * (1 - weight_lines) + bottom * weight_lines, 6))
+
+        # -1 outside the source grid
+        outside = (plan[0, yoff:yoff + height] < 0) | \
+                  (plan[0, yoff:yoff + height] >= source_grid["ysize"]) | \
+                  (plan[1, yoff:yoff + height] < 0) | \
+                  (plan[1, yoff:yoff + height] >= source_grid["xsize"])
+        plan[0, yoff:yoff + height][outside] = -1
+        plan[1, yoff:yoff + height][outside] = -1
+    plan.flush()
+    plan = None
+    return plan_path
+
+
+def apply_warp_plan(arguments):
+    """ Reproject a mask with a warp plan
+
+    Keyword arguments (as a tuple, to be used in a process pool):
+    mask_in -- the input mask
+    mask_ref -- an image of the target grid
+    mask_out -- the output mask
+    plan_path -- the warp plan from the input grid to the target grid
+    no_data -- the value outside the input mask
+    ram -- the ram limitation in MB
+    """
+    mask_in, mask_ref, mask_out, plan_path, no_data, ram = arguments
+    logging.info("Reprojecting " + mask_in + " into " + mask_out)
+    source = gdal.Open(mask_in, GA_ReadOnly)
+    source_band = source.GetRasterBand(1)
+    plan = np.load(plan_path, mmap_mode="r")
+    ysize, xsize = plan.shape[1:]
+
+    output = create_raster(mask_out, mask_ref, gdal.GDT_Byte,
+                           options=["COMPRESS=DEFLATE"])
+    band = output.GetRasterBand(1)
+    for _, yoff, width, height in iter_windows(xsize, ysize,
+                                               get_block_lines(xsize, 4, ram)):
+        lines = np.asarray(plan[0, yoff:yoff + height])
+        columns = np.asarray(plan[1, yoff:yoff + height])
+        inside = lines >= 0
+        block = np.full((height, width), no_data, dtype=np.uint8)
+        if inside.any():
+            # only the source window referenced by the block is read
+            lines = lines[inside]
+            columns = columns[inside]
+            source_yoff = int(lines.min())
+            source_xoff = int(columns.min())
+            window = source_band.ReadAsArray(source_xoff, source_yoff,
+                                             int(columns.max()) - source_xoff + 1,
+                                             int(lines.max()) - source_yoff + 1)
+            block[inside] = window[lines - source_yoff, columns - source_xoff]
+        band.WriteArray(block, 0, yoff)
+    band = None
+    output = None
+    source_band = None
+    source = None
+    return mask_out
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import shutil
+import tempfile
+import os.path as op
+import numpy as np
+from s2snow.chunked_cube import chunked_cube_writer, chunked_cube_reader
+
+# 11 dates of 23 lines and 19 columns, chunks not dividing the shape
+rng = np.random.RandomState(0)
+masks = rng.randint(0, 3, (11, 23, 19)).astype(np.uint8)
+dates = ["201801" + str(day).zfill(2) for day in range(1, 12)]
+
+path_tmp = tempfile.mkdtemp()
+path = op.join(path_tmp, "test.cube")
+writer = chunked_cube_writer(path, 19, 23, (4, 5, 6))
+writer.add_layer("snow", dates)
+writer.write("snow", 0, masks[:, :10])
+writer.write("snow", 10, masks[:, 10:])
+# a block not starting on a chunk line is rejected
+try:
+    writer.write("snow", 3, masks[:, 3:8])
+    misaligned_rejected = False
+except ValueError:
+    misaligned_rejected = True
+writer.close()
+
+layer = chunked_cube_reader(path).layer("snow")
+keys = [(3,),
+        (slice(None), 5, 7),
+        (slice(2, 9, 3), slice(4, 20), slice(None, None, -2)),
+        (-1, slice(3, 4), 0)]
+slices_ok = all([(layer[key] == masks[key]).all() and
+                 layer[key].shape == masks[key].shape for key in keys])
+date_ok = (layer.read_date("20180105") == masks[4]).all()
+shutil.rmtree(path_tmp)
+
+if slices_ok and date_ok and layer.shape == masks.shape and misaligned_rejected:
+    sys.exit(0)
+else:
+    sys.exit(1)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import os.path as op
+
+from s2snow.findRefCandidates import find_ref_candidates, main
+from s2snow.snow_product_catalog import snow_product_catalog
+
+METADATA = """<Source_Product>
+  <Global_Index_List>
+    <QUALITY_INDEX name="ZS">1800</QUALITY_INDEX>
+    <QUALITY_INDEX name="SnowPercent">{0}</QUALITY_INDEX>
+    <QUALITY_INDEX name="CloudPercent">{1}</QUALITY_INDEX>
+  </Global_Index_List>
+</Source_Product>
+"""
+
+path_tmp = tempfile.mkdtemp()
+percents = {op.join("T31TCH", "product_1", "LIS_PRODUCTS"): (10, 5),
+            op.join("T31TCH", "product_2", "LIS_PRODUCTS"): (30, 5),
+            op.join("T31TGK", "2018", "product_3"): (30, 50),
+            op.join("T31TGK", "2018", "product_4"): (60, 10)}
+for folder, (snow_percent, cloud_percent) in percents.items():
+    os.makedirs(op.join(path_tmp, folder))
+    with open(op.join(path_tmp, folder, "LIS_METADATA.XML"), "w") as metadata:
+        metadata.write(METADATA.format(snow_percent, cloud_percent))
+# invalid metadata are skipped
+os.makedirs(op.join(path_tmp, "invalid"))
+open(op.join(path_tmp, "invalid", "metadata.xml"), "w").close()
+
+candidates = find_ref_candidates([path_tmp], (20, None), (None, 20), nb_threads=4)
+candidates_ok = candidates == [
+    (op.join(path_tmp, "T31TCH", "product_2"), 30, 5),
+    (op.join(path_tmp, "T31TGK", "2018", "product_4"), 60, 10)]
+
+output = op.join(path_tmp, "candidates.csv")
+main(["findRefCandidates.py", path_tmp, "-snow", "5", "50", "-output", output])
+with open(output) as csv_file:
+    rows = list(csv.reader(csv_file))
+csv_ok = rows[0] == ["product_folder", "snow_percent", "cloud_percent"] and \
+    len(rows) == 4 and float(rows[1][1]) == 10
+
+# the catalog gives the same product folders as the scan
+names = ["SENTINEL2A_20180101-105435-457_L2A_T31TCH_D_V1-4",
+         "SENTINEL2A_20180131-105416-437_L2A_T31TCH_D_V1-4"]
+for name, snow_percent in zip(names, [10, 30]):
+    os.makedirs(op.join(path_tmp, "products", name, "LIS_PRODUCTS"))
+    open(op.join(path_tmp, "products", name, "LIS_PRODUCTS", "LIS_SEB.TIF"), "w").close()
+    with open(op.join(path_tmp, "products", name, "LIS_PRODUCTS", "LIS_METADATA.XML"), "w") as metadata:
+        metadata.write(METADATA.format(snow_percent, 5))
+catalog = snow_product_catalog(op.join(path_tmp, "catalog.db"))
+catalog.index_directories([op.join(path_tmp, "products")])
+catalog.close()
+scanned = find_ref_candidates([op.join(path_tmp, "products")], (20, None), (None, 20), nb_threads=4)
+queried = find_ref_candidates(snow_range=(20, None), cloud_range=(None, 20),
+                              catalog_file=op.join(path_tmp, "catalog.db"), tile_id="T31TCH")
+catalog_ok = scanned == queried == [(op.join(path_tmp, "products", names[1]), 30, 5)]
+
+shutil.rmtree(path_tmp)
+
+if candidates_ok and csv_ok and catalog_ok:
+    sys.exit(0)
+else:
+    sys.exit(1)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import os.path as op
+from s2snow.mask_cache import mask_cache
+
+path_tmp = tempfile.mkdtemp()
+cache_path = op.join(path_tmp, "cache")
+mask_in = op.join(path_tmp, "mask.tif")
+mask_out = op.join(path_tmp, "binary.tif")
+with open(mask_in, "w") as stream:
+    stream.write("snow mask")
+
+computations = []
+def compute():
+    computations.append(mask_out)
+    with open(mask_out, "w") as stream:
+        stream.write("x" * 1024 * 1024)
+
+# the second run is restored from the cache, even in a new cache instance
+mask_cache(cache_path).run("decode", [mask_in], ["100"], [mask_out], compute)
+os.remove(mask_out)
+mask_cache(cache_path).run("decode", [mask_in], ["100"], [mask_out], compute)
+restored = len(computations) == 1 and op.getsize(mask_out) == 1024 * 1024
+
+# other parameters or a modified input are computed again
+cache = mask_cache(cache_path)
+cache.run("decode", [mask_in], ["205"], [mask_out], compute)
+os.utime(mask_in, (0, 0))
+cache.run("decode", [mask_in], ["100"], [mask_out], compute)
+recomputed = len(computations) == 3
+
+# 1 MB cache: only the last used entry is kept
+small_cache = mask_cache(cache_path, max_size=1)
+evicted = len(small_cache.index) == 3
+small_cache.run("decode", [mask_in], ["254"], [mask_out], compute)
+evicted = evicted and len(small_cache.index) == 1 and \
+    len(os.listdir(cache_path)) == 3
+
+# the entries stored by concurrent users of the cache are all kept
+cache_1 = mask_cache(cache_path)
+cache_2 = mask_cache(cache_path)
+cache_1.run("decode", [mask_in], ["1"], [mask_out], compute)
+cache_2.run("decode", [mask_in], ["2"], [mask_out], compute)
+shared = len(mask_cache(cache_path).index) == 3 and \
+    cache_1.get(cache_1.key("decode", [mask_in], ["2"]), [mask_out])
+
+# the masks derived from cached masks are found in the cache whatever the
+# directory of the run, a new instance for each run
+def derive(run_path):
+    decoded = op.join(run_path, "binary.tif")
+    merged = op.join(run_path, "merged.tif")
+    cache = mask_cache(cache_path)
+    cache.run("decode", [mask_in], ["3"], [decoded], lambda: shutil.copy(mask_in, decoded))
+    def merge():
+        computations.append(merged)
+        shutil.copy(decoded, merged)
+    cache.run("merge", [decoded], None, [merged], merge)
+    return cache.key("merge", [decoded])
+
+run_paths = [op.join(path_tmp, "season_1"), op.join(path_tmp, "season_2")]
+for run_path in run_paths:
+    os.makedirs(run_path)
+merge_keys = [derive(run_path) for run_path in run_paths]
+derived = computations.count(op.join(run_paths[0], "merged.tif")) == 1 and \
+    op.join(run_paths[1], "merged.tif") not in computations and \
+    merge_keys[0] == merge_keys[1]
+
+shutil.rmtree(path_tmp)
+
+if restored and recomputed and evicted and shared and derived:
+    sys.exit(0)
+else:
+    sys.exit(1)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import os.path as op
+import numpy as np
+
+import gdal
+
+def main(argv):
+    """ Compare a mask with a reference mask, allowing a maximum ratio of
+    different pixels
+    """
+    reference_path = str(argv[1])
+    tested_path = str(argv[2])
+    max_ratio = float(argv[3])
+
+    if not op.exists(tested_path):
+        print(tested_path + " does not exist")
+        return 1
+    reference = gdal.Open(reference_path).ReadAsArray()
+    tested = gdal.Open(tested_path).ReadAsArray()
+    if reference.shape != tested.shape:
+        print("The shape " + str(tested.shape) + " of " + tested_path +
+              " does not match " + str(reference.shape))
+        return 1
+
+    ratio = np.count_nonzero(reference != tested) / float(reference.size)
+    print("%.4f%% of different pixels" % (100 * ratio))
+    if ratio > max_ratio:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
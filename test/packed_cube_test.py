@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import numpy as np
+from s2snow.packed_cube import packed_cube_writer, packed_cube_reader
+
+# 13 dates (2 bytes per pixel) of 17 lines and 9 columns
+rng = np.random.RandomState(0)
+masks = (rng.rand(13, 17, 9) > 0.5).astype(np.uint8)
+dates = ["201801" + str(day).zfill(2) for day in range(1, 14)]
+
+(handle, path) = tempfile.mkstemp(suffix=".lsc")
+os.close(handle)
+
+writer = packed_cube_writer(path, 9, 17, dates)
+writer.write_chunk(0, masks[:, :5])
+writer.write_chunk(5, masks[:, 5:])
+# a chunk with missing dates is rejected
+try:
+    writer.write_chunk(0, masks[:12, :5])
+    mismatch_rejected = False
+except ValueError:
+    mismatch_rejected = True
+writer.close()
+
+reader = packed_cube_reader(path)
+series = reader.read_pixel_series(3, 7)
+date_mask = reader.read_date("20180110")
+last_date_mask = reader.read_date(12)
+chunks_ok = all([(reader.read_chunk(chunk) ==
+                  masks[:, chunk[2]:chunk[2] + chunk[3]]).all()
+                 for chunk in reader.chunks])
+os.remove(path)
+
+if ((series == masks[:, 7, 3]).all() and
+        (date_mask == masks[9]).all() and
+        (last_date_mask == masks[12]).all() and
+        reader.dates == dates and
+        chunks_ok and
+        mismatch_rejected):
+    sys.exit(0)
+else:
+    sys.exit(1)
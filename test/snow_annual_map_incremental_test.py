@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import os.path as op
+import shutil
+import logging
+
+from s2snow import snow_annual_map
+
+def main(argv):
+    logging.info("Start snow_annual_map_incremental_test")
+
+    data_path = str(argv[1])
+    out_path = str(argv[2])
+    if not op.exists(out_path):
+        os.mkdir(out_path)
+    tmp_path = str(argv[3])
+    if not op.exists(tmp_path):
+        os.mkdir(tmp_path)
+
+    # Remove the previous state, the first run must initialize it
+    target_dir = op.join(out_path, "T31TCH_20180101_20180131")
+    if op.exists(target_dir):
+        shutil.rmtree(target_dir)
+
+    params = {
+            "densification_products_list": [
+                op.join(data_path,"LANDSAT8-OLITIRS-XS_20180115-103629-617_L2A_T31TCH_D_V1-9"),
+                op.join(data_path,"LANDSAT8-OLITIRS-XS_20180131-103619-890_L2A_T31TCH_D_V1-9")
+            ],
+            "date_margin": 10,
+            "path_out": out_path,
+            "mode": "RUNTIME",
+            "input_products_list": [
+                op.join(data_path,"SENTINEL2A_20180101-105435-457_L2A_T31TCH_D_V1-4")
+            ],
+            "date_start": "01/01/2018",
+            "path_tmp": tmp_path,
+            "ram": 1024,
+            "use_densification": True,
+            "tile_id": "T31TCH",
+            "date_stop": "31/01/2018",
+            "nbThreads": 1}
+
+    # First run without the last product, then the last product lands
+    snow_annual_map.snow_annual_map(params).run_incremental()
+    params["input_products_list"].append(
+        op.join(data_path,"SENTINEL2A_20180131-105416-437_L2A_T31TCH_D_V1-4"))
+    snow_annual_map.snow_annual_map(params).run_incremental()
+
+    if not op.exists(op.join(target_dir, "SNOW_OCCURENCE_T31TCH_20180101_20180131.tif")):
+        logging.error("The target does not exists, the test has failed")
+        sys.exit(1)
+    logging.info("End snow_annual_map_incremental_test")
+
+if __name__== "__main__":
+    # Set logging level and format.
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format=\
+        '%(asctime)s - %(filename)s:%(lineno)s - %(levelname)s - %(message)s')
+    main(sys.argv)
@@ -5,6 +5,7 @@ import os
 import sys
 import os.path as op
 import logging
+import json
 
 from s2snow import snow_annual_map_evaluation
 
@@ -46,6 +47,11 @@ def main(argv):
             "date_stop": "31/01/2018",
             "nbThreads": 1}
 
+    # Optional extra parameters as key=value (json values)
+    for extra_param in argv[4:]:
+        key, value = extra_param.split("=", 1)
+        params[key] = json.loads(value)
+
     # Run the snow detector
     snow_annual_map_evaluation_app = snow_annual_map_evaluation.snow_annual_map_evaluation(params)
     snow_annual_map_evaluation_app.run()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import shutil
+import tempfile
+import os.path as op
+
+from s2snow.snow_detector_batch import run_batch, get_worker_budget, read_config_list
+
+path_tmp = tempfile.mkdtemp()
+
+budget_ok = get_worker_budget(4, 8192, 16) == (2048, 4) and \
+    get_worker_budget(4) == (None, None) and \
+    get_worker_budget(8, 4096, 4) == (512, 1)
+
+# the failures of a product do not stop the other products
+invalid_config = op.join(path_tmp, "invalid.json")
+with open(invalid_config, "w") as invalid_stream:
+    invalid_stream.write("{")
+missing_input_config = op.join(path_tmp, "missing_input.json")
+with open(missing_input_config, "w") as config_stream:
+    json.dump({"general": {"pout": path_tmp, "log": False}}, config_stream)
+config_list = op.join(path_tmp, "configs.txt")
+with open(config_list, "w") as list_stream:
+    list_stream.write("# configurations\n" + invalid_config + "\n\n" +
+                      op.join(path_tmp, "missing.json") + "\n" +
+                      missing_input_config + "\n")
+
+summary_file = op.join(path_tmp, "summary.json")
+summaries = run_batch(read_config_list(config_list), 2, 1024, 2, summary_file)
+with open(summary_file) as summary_stream:
+    summary = json.load(summary_stream)
+batch_ok = [product["config"] for product in summaries] == read_config_list(config_list) and \
+    all(product["status"] == "failed" and product["error"] for product in summaries) and \
+    summary["nb_failed"] == 3 and summary["worker_ram"] == 512
+
+shutil.rmtree(path_tmp)
+
+if budget_ok and batch_ok:
+    sys.exit(0)
+else:
+    sys.exit(1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import subprocess
+import os.path as op
+
+from s2snow.snow_detector_service import snow_detector_service, get_owner
+
+# a valid configuration built by build_json.py
+valid_config = str(sys.argv[1])
+
+queue_dir = tempfile.mkdtemp()
+service = snow_detector_service(queue_dir, nb_workers=2, ram=1024, poll_interval=0.1)
+
+def write_job(path):
+    if not op.exists(op.dirname(path)):
+        os.makedirs(op.dirname(path))
+    with open(path, "w") as job:
+        job.write("{")
+
+# the jobs left running by an interrupted service are requeued: a job
+# without owner, a job of a dead process of this host and a job of a service
+# of another host without heartbeat
+write_job(op.join(queue_dir, "running", "interrupted.json"))
+dead_process = subprocess.Popen([sys.executable, "-c", "pass"])
+dead_process.wait()
+dead_owner = socket.gethostname() + "_" + str(dead_process.pid)
+write_job(op.join(queue_dir, "running", dead_owner, "dead.json"))
+write_job(op.join(queue_dir, "running", "otherhost_2", "stale.json"))
+os.utime(op.join(queue_dir, "running", "otherhost_2"), (0, 0))
+# the job of a service of another host with a recent heartbeat is kept
+write_job(op.join(queue_dir, "running", "otherhost_1", "remote.json"))
+
+for name in ["invalid_1.json", "invalid_2.json"]:
+    write_job(op.join(queue_dir, "incoming", name))
+with open(op.join(queue_dir, "incoming", "missing_input.json"), "w") as job:
+    json.dump({"general": {"pout": queue_dir, "log": False}}, job)
+shutil.copy(valid_config, op.join(queue_dir, "incoming", "valid.json"))
+# not a job
+open(op.join(queue_dir, "incoming", "notes.txt"), "w").close()
+
+stats = service.run(once=True)
+with open(op.join(queue_dir, "failed", "missing_input_summary.json")) as summary_stream:
+    summary = json.load(summary_stream)
+with open(op.join(queue_dir, "done", "valid_summary.json")) as summary_stream:
+    valid_summary = json.load(summary_stream)
+queue_ok = sorted(os.listdir(op.join(queue_dir, "failed"))) == \
+    ["dead.json", "dead_summary.json",
+     "interrupted.json", "interrupted_summary.json",
+     "invalid_1.json", "invalid_1_summary.json",
+     "invalid_2.json", "invalid_2_summary.json",
+     "missing_input.json", "missing_input_summary.json",
+     "stale.json", "stale_summary.json"] and \
+    os.listdir(op.join(queue_dir, "running")) == ["otherhost_1"] and \
+    os.listdir(op.join(queue_dir, "running", "otherhost_1")) == ["remote.json"] and \
+    os.listdir(op.join(queue_dir, "incoming")) == ["notes.txt"] and \
+    sorted(os.listdir(op.join(queue_dir, "done"))) == ["valid.json", "valid_summary.json"] and \
+    summary["status"] == "failed" and summary["error"] and \
+    valid_summary["status"] == "done" and valid_summary["error"] is None
+stats_ok = stats["nb_failed"] == 6 and stats["nb_done"] == 1 and \
+    stats["products_per_hour"] > 0 and stats["mean_duration"] > 0 and \
+    op.exists(op.join(queue_dir, "stats", get_owner() + ".json"))
+
+# the shared stop file stops the services without claiming the new jobs,
+# and is left for the other services
+write_job(op.join(queue_dir, "incoming", "new.json"))
+open(op.join(queue_dir, "stop"), "w").close()
+snow_detector_service(queue_dir, poll_interval=0.1).run()
+stop_ok = op.exists(op.join(queue_dir, "incoming", "new.json")) and \
+    op.exists(op.join(queue_dir, "stop"))
+
+# the stop file of a service stops this service only, and is removed
+os.remove(op.join(queue_dir, "stop"))
+open(op.join(queue_dir, "stop_" + get_owner()), "w").close()
+snow_detector_service(queue_dir, poll_interval=0.1).run()
+stop_ok = stop_ok and op.exists(op.join(queue_dir, "incoming", "new.json")) and \
+    not op.exists(op.join(queue_dir, "stop_" + get_owner()))
+
+shutil.rmtree(queue_dir)
+
+if queue_ok and stats_ok and stop_ok:
+    sys.exit(0)
+else:
+    sys.exit(1)
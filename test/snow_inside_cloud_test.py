@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import shutil
+import tempfile
+import os.path as op
+import numpy as np
+import gdal
+from s2snow.snow_inside_cloud import remove_snow_inside_cloud
+from s2snow.snow_inside_cloud import remove_snow_inside_cloud_by_tiles
+
+# Two snow areas: the first one is surrounded by clouds,
+# the second one by clear pixels
+snow_mask = np.array([[0, 0, 0, 0, 0, 0, 0],
+                      [0, 1, 1, 0, 0, 0, 0],
+                      [0, 1, 1, 0, 0, 1, 1],
+                      [0, 0, 0, 0, 0, 1, 1],
+                      [0, 0, 0, 0, 0, 0, 0]], dtype=np.uint8)
+cloud_mask = np.array([[1, 1, 1, 1, 0, 0, 0],
+                       [1, 0, 0, 1, 0, 0, 0],
+                       [1, 0, 0, 1, 0, 0, 0],
+                       [1, 1, 1, 1, 0, 0, 0],
+                       [0, 0, 0, 0, 0, 0, 0]], dtype=np.uint8)
+
+snow, cloud = remove_snow_inside_cloud(snow_mask, cloud_mask, radius=1,
+                                       cloud_threshold=0.85, min_area_size=3)
+
+expected_snow = np.where(np.arange(7) < 4, 0, snow_mask)
+expected_cloud = np.where(snow_mask - expected_snow == 1, 1, cloud_mask)
+
+# The areas smaller than min_area_size are kept
+small_snow, small_cloud = remove_snow_inside_cloud(snow_mask, cloud_mask,
+                                                   radius=1,
+                                                   cloud_threshold=0.85,
+                                                   min_area_size=4)
+
+# A discarded area is counted in the surrounding of the next areas:
+# once the first area is discarded, its clear pixel within the dilated
+# second area lowers the surrounding cloud fraction from 1 to 8/9
+snow_mask_2 = np.array([[1, 1, 0, 0],
+                        [1, 1, 0, 0],
+                        [0, 0, 1, 1],
+                        [0, 0, 1, 1]], dtype=np.uint8)
+cloud_mask_2 = np.array([[0, 0, 1, 1],
+                         [0, 0, 1, 1],
+                         [1, 1, 0, 0],
+                         [1, 1, 0, 0]], dtype=np.uint8)
+snow_2, cloud_2 = remove_snow_inside_cloud(snow_mask_2, cloud_mask_2,
+                                           radius=2, cloud_threshold=0.9,
+                                           min_area_size=3)
+expected_snow_2 = np.array([[0, 0, 0, 0],
+                            [0, 0, 0, 0],
+                            [0, 0, 1, 1],
+                            [0, 0, 1, 1]], dtype=np.uint8)
+
+# The tiled processing gives the same results, with snow areas
+# crossing the tile borders
+rng = np.random.RandomState(0)
+snow_mask_3 = (rng.rand(60, 50) > 0.4).astype(np.uint8)
+cloud_mask_3 = ((rng.rand(60, 50) > 0.3) & (snow_mask_3 == 0)).astype(np.uint8)
+snow_3, cloud_3 = remove_snow_inside_cloud(snow_mask_3, cloud_mask_3,
+                                           radius=2, cloud_threshold=0.5,
+                                           min_area_size=5)
+
+path_tmp = tempfile.mkdtemp()
+driver = gdal.GetDriverByName("GTiff")
+for name, array in [("snow.tif", snow_mask_3), ("cloud.tif", cloud_mask_3)]:
+    dataset = driver.Create(op.join(path_tmp, name), 50, 60, 1, gdal.GDT_Byte)
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset = None
+
+remove_snow_inside_cloud_by_tiles(op.join(path_tmp, "snow.tif"),
+                                  op.join(path_tmp, "cloud.tif"),
+                                  path_tmp, radius=2, cloud_threshold=0.5,
+                                  min_area_size=5, tile_size=16)
+tiled_snow_3 = gdal.Open(op.join(path_tmp, "snow.tif")).ReadAsArray()
+tiled_cloud_3 = gdal.Open(op.join(path_tmp, "cloud.tif")).ReadAsArray()
+shutil.rmtree(path_tmp)
+
+if ((snow == expected_snow).all() and
+        (cloud == expected_cloud).all() and
+        (small_snow == snow_mask).all() and
+        (small_cloud == cloud_mask).all() and
+        (snow_2 == expected_snow_2).all() and
+        (cloud_2 == cloud_mask_2 + snow_mask_2 - expected_snow_2).all() and
+        (snow_3 != snow_mask_3).any() and
+        (tiled_snow_3 == snow_3).all() and
+        (tiled_cloud_3 == cloud_3).all()):
+    sys.exit(0)
+else:
+    sys.exit(1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from s2snow import snow_kernels
+
+# green, swir and red reflectances of 5 pixels:
+# snow, snow under cloud, dark snow, bright soil, nodata
+green = np.array([[5000, 5000, 1500, 3000, -10000]])
+swir = np.array([[500, 500, 600, 2800, -10000]])
+red = np.array([[4000, 4000, 1000, 3000, -10000]])
+all_cloud = np.array([[0, 1, 0, 0, 0]])
+
+pass1 = snow_kernels.pass1_kernel(swir, red, green, all_cloud, 0.4, 2000)
+expected_pass1 = np.array([[1, 0, 0, 0, 0]])
+
+# zs condition on the dem for pass2
+dem = np.array([[1500, 1500, 2500, 2500, 2500]])
+cloud_refine = np.array([[0, 1, 0, 0, 0]])
+pass2 = snow_kernels.pass2_kernel(swir, red, green, dem, cloud_refine,
+                                  2000, 0.15, 400)
+expected_pass2 = np.array([[0, 0, 1, 0, 0]])
+
+pass3 = snow_kernels.pass3_kernel(pass1, pass2)
+expected_pass3 = np.array([[1, 0, 1, 0, 0]])
+
+back_to_cloud = np.array([[0, 1, 0, 0, 0]])
+final = snow_kernels.final_mask_kernel(cloud_refine, pass3, back_to_cloud,
+                                       swir, False, -10000,
+                                       "100", "205", "254")
+expected_final = np.array([[100, 205, 100, 0, 254]])
+
+# all bits of the mask value must be set (ComputeCloudMask)
+mask = snow_kernels.bitmask(np.array([[0, 32, 64, 96, 160]]), 96)
+expected_mask = np.array([[0, 0, 0, 1, 0]])
+
+# binary snow and cloud masks of a snow product
+snow, cloud = snow_kernels.snow_product_masks_kernel(
+    np.array([[0, 100, 205, 254]]), "100", "205", "254")
+expected_snow = np.array([[0, 1, 0, 0]])
+expected_cloud = np.array([[0, 0, 1, 1]])
+
+# merge in priority order, the last product is used when none is valid
+merged = snow_kernels.merge_masks_kernel(
+    "100",
+    np.array([[0, 205, 254, 205, 254]]),
+    np.array([[100, 100, 205, 254, 205]]),
+    np.array([[205, 0, 0, 254, 205]]))
+expected_merged = np.array([[0, 100, 0, 254, 205]])
+merged_snow, merged_cloud = snow_kernels.merge_snow_product_masks_kernel(
+    "100", "100", "205", "254",
+    np.array([[0, 205, 254, 205, 254]]),
+    np.array([[100, 100, 205, 254, 205]]),
+    np.array([[205, 0, 0, 254, 205]]))
+
+# mean of the red band over 2x2 cells, nodata excluded, partial last cells
+red_block = np.array([[100, 200, 300, 301, 50],
+                      [300, 400, -10000, -10000, 60],
+                      [10, 20, -10000, -10000, 70]])
+red_mean = snow_kernels.block_mean(red_block, 2, -10000)
+expected_red_mean = np.array([[250, 250, 301, 301, 55],
+                              [250, 250, 301, 301, 55],
+                              [15, 15, -10000, -10000, 70]])
+# dark cloud test on the coarse red band
+ones = np.ones(red_block.shape)
+zeros = np.zeros(red_block.shape)
+coarse_refine = snow_kernels.cloud_refine_coarse_red_kernel(
+    ones, zeros, red_block, zeros, ones, 200, 2, -10000)
+expected_coarse_refine = (expected_red_mean > 200).astype(np.uint8)
+
+if ((pass1 == expected_pass1).all() and
+        (pass2 == expected_pass2).all() and
+        (pass3 == expected_pass3).all() and
+        (final == expected_final).all() and
+        (mask == expected_mask).all() and
+        (snow == expected_snow).all() and
+        (cloud == expected_cloud).all() and
+        (merged == expected_merged).all() and
+        (merged_snow == np.array([[0, 1, 0, 0, 0]])).all() and
+        (merged_cloud == np.array([[0, 0, 0, 1, 1]])).all() and
+        (red_mean == expected_red_mean).all() and
+        (coarse_refine == expected_coarse_refine).all()):
+    sys.exit(0)
+else:
+    sys.exit(1)
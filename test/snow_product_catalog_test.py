@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import os.path as op
+from datetime import datetime
+
+from s2snow.snow_product_catalog import snow_product_catalog
+from s2snow.snow_product_parser import snow_product
+
+METADATA = """<Source_Product>
+  <PRODUCT_ID>{0}</PRODUCT_ID>
+  <Global_Index_List>
+    <QUALITY_INDEX name="ZS">1800</QUALITY_INDEX>
+    <QUALITY_INDEX name="SnowPercent">{1}</QUALITY_INDEX>
+    <QUALITY_INDEX name="CloudPercent">{2}</QUALITY_INDEX>
+  </Global_Index_List>
+</Source_Product>
+"""
+
+MUSCATE_METADATA = """<Muscate_Metadata_Document>
+  <Geoposition_Informations>
+    <Global_Geopositioning>
+      <Point name="upperLeft"><LAT>44.2</LAT><LON>0.5</LON></Point>
+      <Point name="upperRight"><LAT>44.2</LAT><LON>1.9</LON></Point>
+      <Point name="lowerRight"><LAT>43.2</LAT><LON>1.9</LON></Point>
+      <Point name="lowerLeft"><LAT>43.2</LAT><LON>0.5</LON></Point>
+      <Point name="center"><LAT>43.7</LAT><LON>1.2</LON></Point>
+    </Global_Geopositioning>
+  </Geoposition_Informations>
+</Muscate_Metadata_Document>
+"""
+
+path_tmp = tempfile.mkdtemp()
+names = ["SENTINEL2A_20180101-105435-457_L2A_T31TCH_D_V1-4",
+         "SENTINEL2A_20180131-105416-437_L2A_T31TCH_D_V1-4",
+         "SENTINEL2B_20180105-105435-457_L2A_T31TGK_D_V1-4",
+         "LANDSAT8-OLITIRS-XS_20180115-103629-617_L2A_T31TCH_D_V1-9"]
+for name in names:
+    product_path = op.join(path_tmp, "products", name.split("_")[3], name)
+    os.makedirs(product_path)
+    open(op.join(product_path, name + "_SNW_R2.tif"), "w").close()
+    with open(op.join(product_path, "LIS_METADATA.XML"), "w") as metadata:
+        metadata.write(METADATA.format(name, 10 * (names.index(name) + 1), 25))
+    with open(op.join(product_path, name + "_MTD_ALL.xml"), "w") as metadata:
+        metadata.write(MUSCATE_METADATA)
+
+# the metadata are read on first access only
+product = snow_product(op.join(path_tmp, "products", "T31TCH", names[1]))
+quality_indices = (product.zs, product.snow_percent, product.cloud_percent)
+footprint = product.footprint
+os.remove(op.join(path_tmp, "products", "T31TCH", names[1], "LIS_METADATA.XML"))
+metadata_ok = quality_indices == (1800, 20, 25) and product.snow_percent == 20 and \
+    footprint == [(0.5, 44.2), (1.9, 44.2), (1.9, 43.2), (0.5, 43.2)]
+
+catalog = snow_product_catalog(op.join(path_tmp, "catalog.db"))
+indexed_ok = catalog.index_directories([op.join(path_tmp, "products")]) == 4 and \
+    catalog.index_directories([op.join(path_tmp, "products")]) == 0
+
+# products of a tile and a platform between two dates
+products = catalog.get_products("T31TCH", datetime(2018, 1, 1), datetime(2018, 1, 20), "SENTINEL2")
+query_ok = [product.product_name for product in products] == [names[0]] and \
+    products[0].get_snow_mask() == op.join(path_tmp, "products", "T31TCH", names[0],
+                                           names[0] + "_SNW_R2.tif") and \
+    len(catalog.query(tile_id="T31TCH")) == 3
+
+# filtering on the quality indices stored in the catalog
+percent_ok = [row["product_name"] for row in catalog.query(snow_percent=(15, None))] == \
+    [names[2], names[3]] and \
+    len(catalog.query(snow_percent=(None, 50), cloud_percent=(20, 30))) == 3 and \
+    products[0].snow_percent == 10 and products[0].footprint == footprint
+
+# the removed products are removed from the catalog
+shutil.rmtree(op.join(path_tmp, "products", "T31TGK"))
+catalog.index_directories([op.join(path_tmp, "products")])
+removed_ok = len(catalog.query()) == 3
+catalog.close()
+
+shutil.rmtree(path_tmp)
+
+if metadata_ok and indexed_ok and query_ok and percent_ok and removed_ok:
+    sys.exit(0)
+else:
+    sys.exit(1)
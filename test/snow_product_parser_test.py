@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import shutil
+import zipfile
+import tempfile
+import os.path as op
+from datetime import datetime
+
+from s2snow.snow_product_parser import parse_product_name, scan_products, snow_product, \
+    extract_zip_files
+from s2snow.mask_cache import mask_cache, file_identity
+
+# name parsing only
+s2_name = "SENTINEL2A_20180101-105435-457_L2B-SNOW_T31TCH_D_V1-4"
+l8_name = "LANDSAT8-OLITIRS-XS_20180115-103629-617_L2B-SNOW_T31TCH_D_V1-9"
+name_info = parse_product_name(s2_name)
+parsing_ok = name_info["tile_id"] == "T31TCH" and \
+    name_info["acquisition_date"].date() == datetime(2018, 1, 1).date() and \
+    parse_product_name(l8_name)["platform"] == "LANDSAT8-OLITIRS-XS" and \
+    parse_product_name("SENTINEL2A_2018") is None and \
+    parse_product_name("README") is None
+
+# scan the product directories with an index
+path_tmp = tempfile.mkdtemp()
+product_paths = []
+for name in [s2_name, l8_name]:
+    product_path = op.join(path_tmp, name)
+    os.mkdir(product_path)
+    open(op.join(product_path, name + "_SNW_R2.tif"), "w").close()
+    product_paths.append(product_path)
+index_file = op.join(path_tmp, "index.json")
+
+products = scan_products(product_paths + [op.join(path_tmp, "missing")], 2, index_file)
+scan_ok = products[2] is None and \
+    products[0].snow_mask == op.join(product_paths[0], s2_name + "_SNW_R2.tif")
+
+# the listing of the unmodified directories is read from the index
+with open(index_file) as stream:
+    index = json.load(stream)
+index[product_paths[1]]["sub_files"] = ["indexed_SNW_R2.tif"]
+with open(index_file, "w") as stream:
+    json.dump(index, stream)
+products = scan_products(product_paths, 2, index_file)
+index_ok = products[1].snow_mask == op.join(product_paths[1], "indexed_SNW_R2.tif")
+
+# zipped product, read through /vsizip/ or extracted with a cache
+zip_name = "SENTINEL2A_20180131-105416-437_L2B-SNOW_T31TCH_D_V1-4"
+zip_path = op.join(path_tmp, zip_name)
+os.mkdir(zip_path)
+zip_file = zipfile.ZipFile(op.join(zip_path, zip_name + ".zip"), "w")
+zip_file.writestr(zip_name + "/" + zip_name + "_SNW_R2.tif", "snow mask")
+zip_file.close()
+member = zip_name + "/" + zip_name + "_SNW_R2.tif"
+
+product = snow_product(zip_path)
+product.use_vsizip_snow_mask()
+vsizip_mask = "/vsizip/" + op.join(zip_path, zip_name + ".zip", member)
+vsizip_ok = product.get_snow_mask() == vsizip_mask and \
+    file_identity(vsizip_mask)[-1] == member
+
+cache = mask_cache(op.join(path_tmp, "cache"))
+for extraction in ["extracted_1", "extracted_2"]:
+    product = snow_product(zip_path)
+    product.extract_snow_mask(op.join(path_tmp, extraction), cache)
+extract_ok = product.get_snow_mask() == op.join(path_tmp, "extracted_2", member) and \
+    len(cache.index) == 1
+
+# batch extraction, the members already extracted are skipped
+zip_files = []
+for index in range(3):
+    zip_file_name = op.join(path_tmp, "batch_" + str(index) + ".zip")
+    zip_file = zipfile.ZipFile(zip_file_name, "w")
+    zip_file.writestr("batch_" + str(index) + "/mask_SNW_R2.tif", "snow mask " + str(index))
+    zip_file.writestr("batch_" + str(index) + "/other.xml", "metadata")
+    zip_file.close()
+    zip_files.append(zip_file_name)
+extraction = op.join(path_tmp, "batch")
+first = extract_zip_files(zip_files, [extraction] * 3, ["_SNW_R2.tif"], 2)
+# same size but another content, extracted again
+with open(op.join(extraction, "batch_1", "mask_SNW_R2.tif"), "w") as modified:
+    modified.write("snow_mask 1")
+second = extract_zip_files(zip_files + [op.join(path_tmp, "missing.zip")],
+                           [extraction] * 4, ["_SNW_R2.tif"], 2)
+batch_ok = [result["extracted"] for result in first] == [1, 1, 1] and \
+    [result["extracted"] for result in second[:3]] == [0, 1, 0] and \
+    [result["skipped"] for result in second[:3]] == [1, 0, 1] and \
+    second[3] is None and \
+    open(op.join(extraction, "batch_1", "mask_SNW_R2.tif")).read() == "snow mask 1" and \
+    not op.exists(op.join(extraction, "batch_0", "other.xml"))
+
+shutil.rmtree(path_tmp)
+
+if parsing_ok and scan_ok and index_ok and vsizip_ok and extract_ok and batch_ok:
+    sys.exit(0)
+else:
+    sys.exit(1)
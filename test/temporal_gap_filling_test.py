@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from s2snow.temporal_gap_filling import linear_gap_filling, date_ordinals
+from s2snow.temporal_gap_filling import OUTPUT_DATES_CHUNK
+
+input_dates = date_ordinals(["20180102", "20180104", "20180106"])
+output_dates = date_ordinals(["20180101", "20180102", "20180103",
+                              "20180104", "20180105", "20180106",
+                              "20180107"])
+
+# 4 pixels: snow at all dates, snow then cloud then no snow,
+# cloud at all dates, snow until the second date
+values = np.array([[1, 1, 0, 1],
+                   [1, 1, 0, 1],
+                   [1, 0, 0, 0]])
+valid = np.array([[True, True, False, True],
+                  [True, False, False, True],
+                  [True, True, False, True]])
+
+filled = linear_gap_filling(values, valid, input_dates, output_dates)
+
+# interpolated values are truncated, outside the valid dates
+# the nearest valid value is used
+expected = np.array([[1, 1, 0, 1],
+                     [1, 1, 0, 1],
+                     [1, 0, 0, 1],
+                     [1, 0, 0, 1],
+                     [1, 0, 0, 0],
+                     [1, 0, 0, 0],
+                     [1, 0, 0, 0]])
+
+# the output dates interpolated by chunks give the same result as each
+# output date interpolated alone
+many_output_dates = np.arange(output_dates[0], output_dates[0] + 3 * OUTPUT_DATES_CHUNK + 1)
+chunked = linear_gap_filling(values, valid, input_dates, many_output_dates)
+alone = np.vstack([linear_gap_filling(values, valid, input_dates, [output_date])
+                   for output_date in many_output_dates])
+
+if filled.dtype == np.uint8 and (filled == expected).all() and \
+        (chunked == alone).all():
+    sys.exit(0)
+else:
+    sys.exit(1)
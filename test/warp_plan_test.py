@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import shutil
+import tempfile
+import os.path as op
+import numpy as np
+
+import gdal
+import osr
+
+from s2snow.warp_plan import get_grid, compute_warp_plan, apply_warp_plan
+
+def write_image(path, array, geotransform, epsg=32631):
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(epsg)
+    dataset = gdal.GetDriverByName("GTiff").Create(path, array.shape[1], array.shape[0],
+                                                   1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(spatial_reference.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(array)
+    dataset = None
+
+path_tmp = tempfile.mkdtemp()
+
+# 30m source and 20m target grids sharing the same origin (as the Landsat
+# and Sentinel-2 products of a tile), the target exceeding the source
+rng = np.random.RandomState(0)
+source = rng.choice([0, 100, 205, 254], (40, 50)).astype(np.uint8)
+write_image(op.join(path_tmp, "source.tif"), source, [300000, 30, 0, 5000000, 0, -30])
+write_image(op.join(path_tmp, "target.tif"), np.zeros((70, 83), dtype=np.uint8),
+            [300000, 20, 0, 5000000, 0, -20])
+
+plan = compute_warp_plan(get_grid(op.join(path_tmp, "source.tif")),
+                         get_grid(op.join(path_tmp, "target.tif")),
+                         op.join(path_tmp, "plan.npy"))
+apply_warp_plan((op.join(path_tmp, "source.tif"),
+                 op.join(path_tmp, "target.tif"),
+                 op.join(path_tmp, "reprojected.tif"),
+                 plan,
+                 254,
+                 64))
+reprojected = gdal.Open(op.join(path_tmp, "reprojected.tif")).ReadAsArray()
+
+# nearest neighbour of the target pixel centers
+lines, columns = np.mgrid[0:70, 0:83]
+source_lines = (lines * 20 + 10) // 30
+source_columns = (columns * 20 + 10) // 30
+inside = (source_lines < 40) & (source_columns < 50)
+expected = np.full((70, 83), 254, dtype=np.uint8)
+expected[inside] = source[source_lines[inside], source_columns[inside]]
+
+# 30m source in the UTM zone 30 reprojected onto the 20m target grid of the
+# UTM zone 31, the source covering part of the target
+source_reference = osr.SpatialReference()
+source_reference.ImportFromEPSG(32630)
+target_reference = osr.SpatialReference()
+target_reference.ImportFromEPSG(32631)
+# keep the x, y order with GDAL >= 3
+for spatial_reference in (source_reference, target_reference):
+    if hasattr(spatial_reference, "SetAxisMappingStrategy"):
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+origin = osr.CoordinateTransformation(target_reference, source_reference).TransformPoint(300000, 5000000)
+write_image(op.join(path_tmp, "source_utm30.tif"), source,
+            [round(origin[0]) + 300, 30, 0, round(origin[1]) - 200, 0, -30], 32630)
+
+plan = compute_warp_plan(get_grid(op.join(path_tmp, "source_utm30.tif")),
+                         get_grid(op.join(path_tmp, "target.tif")),
+                         op.join(path_tmp, "plan_utm30.npy"))
+apply_warp_plan((op.join(path_tmp, "source_utm30.tif"),
+                 op.join(path_tmp, "target.tif"),
+                 op.join(path_tmp, "reprojected_utm30.tif"),
+                 plan,
+                 254,
+                 64))
+reprojected_utm30 = gdal.Open(op.join(path_tmp, "reprojected_utm30.tif")).ReadAsArray()
+
+# gdalwarp with the exact transformer onto the target grid
+write_image(op.join(path_tmp, "warped_utm30.tif"), np.full((70, 83), 254, dtype=np.uint8),
+            [300000, 20, 0, 5000000, 0, -20])
+warped = gdal.Open(op.join(path_tmp, "warped_utm30.tif"), gdal.GA_Update)
+gdal.Warp(warped, op.join(path_tmp, "source_utm30.tif"), resampleAlg="near", errorThreshold=0)
+warped = None
+expected_utm30 = gdal.Open(op.join(path_tmp, "warped_utm30.tif")).ReadAsArray()
+
+shutil.rmtree(path_tmp)
+
+# the pixels whose center falls very close to a source pixel border may
+# differ because of the interpolation of the plan between its coarse nodes
+nb_differences = np.count_nonzero(reprojected_utm30 != expected_utm30)
+covered = np.count_nonzero(expected_utm30 != 254) > 0 and \
+          np.count_nonzero(reprojected_utm30 == 254) > 0
+
+if (reprojected == expected).all() and \
+        nb_differences <= 0.001 * expected_utm30.size and covered:
+    sys.exit(0)
+else:
+    sys.exit(1)
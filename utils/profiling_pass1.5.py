@@ -15,31 +15,107 @@
 #  PURPOSE.  See the above copyright notices for more information.
 #
 #=========================================================================
+"""Benchmark of the pass 1.5 (snow inside cloud removal)
 
+Compare the label-by-label reference loop with the vectorized
+implementation of s2snow.snow_inside_cloud, on synthetic masks
+or on a pair of snow/cloud mask images.
+"""
 from __future__ import print_function
-import os
 import sys
+import time
 import argparse
-from s2snow import snow_detector
-import json
+
+import numpy as np
+import scipy.ndimage as nd
+
+from s2snow.snow_inside_cloud import remove_snow_inside_cloud, build_disk
+
+
+def reference_pass1_5(snow_mask, cloud_mask, radius, cloud_threshold,
+                      min_area_size):
+    """ Label-by-label implementation of the pass 1.5,
+    dilating each snow area over the full image
+    """
+    snow_mask_init = np.copy(snow_mask)
+    (snowlabels, nb_label) = nd.measurements.label(snow_mask)
+    struct = build_disk(radius)
+
+    (labels, label_counts) = np.unique(snowlabels, return_counts=True)
+    labels_area = dict(zip(labels, label_counts))
+
+    for lab in range(1, nb_label+1):
+        if labels_area[lab] > min_area_size:
+            current_mask = np.where(snowlabels == lab, 1, 0)
+            patch_neige_dilat = nd.binary_dilation(current_mask, struct)
+            contour = np.where((snow_mask == 0) & (patch_neige_dilat == 1))
+            result = np.bincount(cloud_mask[contour])
+            cloud_percent = 0
+            if len(result) > 1:
+                cloud_percent = float(result[1]) / (result[0] + result[1])
+            if cloud_percent > cloud_threshold:
+                snow_mask = np.where(snowlabels == lab, 0, snow_mask)
+
+    cloud_mask = np.where((snow_mask == 0) & (snow_mask_init == 1), 1, cloud_mask)
+    return snow_mask, cloud_mask
+
+
+def synthetic_masks(size, seed):
+    """ Build random snow and cloud masks made of smooth blobs
+    """
+    rng = np.random.RandomState(seed)
+    snow = nd.gaussian_filter(rng.rand(size, size), 4) > 0.52
+    cloud = nd.gaussian_filter(rng.rand(size, size), 8) > 0.5
+    snow_mask = (snow & ~cloud).astype(np.uint8)
+    cloud_mask = cloud.astype(np.uint8)
+    return snow_mask, cloud_mask
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
 
 def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark of the pass 1.5')
+    parser.add_argument("-snow", help="snow mask image (synthetic if not set)")
+    parser.add_argument("-cloud", help="cloud mask image")
+    parser.add_argument("-size", type=int, default=1000,
+                        help="size of the synthetic masks")
+    parser.add_argument("-seed", type=int, default=0)
+    parser.add_argument("-radius", type=int, default=1)
+    parser.add_argument("-threshold", type=float, default=0.85)
+    parser.add_argument("-min_area", type=int, default=25)
+    parser.add_argument("-no_reference", action='store_true',
+                        help="only time the vectorized implementation")
+    args = parser.parse_args(argv)
+
+    if args.snow:
+        from s2snow.utils import get_raster_as_array
+        snow_mask = get_raster_as_array(args.snow)
+        cloud_mask = get_raster_as_array(args.cloud)
+    else:
+        snow_mask, cloud_mask = synthetic_masks(args.size, args.seed)
+
+    parameters = (args.radius, args.threshold, args.min_area)
+
+    (snow, cloud), elapsed = timed(remove_snow_inside_cloud, snow_mask,
+                                   cloud_mask, *parameters)
+    print("vectorized: " + str(round(elapsed, 3)) + "s")
+    if args.no_reference:
+        return 0
+
+    (ref_snow, ref_cloud), ref_elapsed = timed(reference_pass1_5, snow_mask,
+                                               cloud_mask, *parameters)
+    print("reference: " + str(round(ref_elapsed, 3)) + "s")
+    print("speedup: x" + str(round(ref_elapsed / max(elapsed, 1e-6), 1)))
+
+    if (snow == ref_snow).all() and (cloud == ref_cloud).all():
+        print("outputs are identical")
+        return 0
+    print("outputs differ")
+    return 1
 
-    print(argv)
-
-    json_file = argv[0]
-    snow_mask = argv[1]
-    cloud_mask = argv[2]
-    
-    # Load json_file from json files
-    with open(json_file) as json_data_file:
-        data = json.load(json_data_file)
-    
-    #dummy json
-    sd = snow_detector.snow_detector(data)
-
-    #
-    sd.pass1_5(snow_mask, cloud_mask, 1, 0.85)
-    
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))